@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Optional catalog of the revisions and policies of a source directory. It is
+# a SQLite database in the source root that the file system keeps up to date,
+# so the revisions of a directory are known without listing it, and questions
+# about the whole tree are answered without walking it.
+#
+# Directories are stored relative to the source root, '' is the root itself.
+# A directory is only trusted when it is marked as scanned, the file system
+# lists it once and stores the result otherwise.
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import contextlib
+
+catalog_name = '.rev_catalog'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS revisions (
+    dir TEXT NOT NULL, name TEXT NOT NULL, id INTEGER NOT NULL,
+    mtime REAL NOT NULL, size INTEGER NOT NULL, kind TEXT NOT NULL, stored INTEGER NOT NULL,
+    PRIMARY KEY (dir, name, id));
+CREATE INDEX IF NOT EXISTS revisions_mtime ON revisions (mtime);
+CREATE TABLE IF NOT EXISTS policies (
+    dir TEXT NOT NULL, name TEXT NOT NULL, policy TEXT NOT NULL,
+    PRIMARY KEY (dir, name));
+CREATE TABLE IF NOT EXISTS dirs (
+    dir TEXT PRIMARY KEY, revisions INTEGER NOT NULL DEFAULT 0, policies INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+class Catalog:
+    '''
+    Changes are written at once, or collected per thread inside
+    transaction () and written together when it ends. The files are changed
+    before the catalog, so the changes are committed even if the operation
+    fails half way.
+    '''
+    def __init__ (self, root, db_path = None):
+        self.root = root
+        self.prefix = os.path.join (root, '')
+        if db_path == None:
+            db_path = os.path.join (root, catalog_name)
+        self.db = sqlite3.connect (db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute ('PRAGMA journal_mode=WAL')
+        self.db.execute ('PRAGMA synchronous=NORMAL')
+        self.db.executescript (schema)
+        self.lock = threading.Lock ()
+        self.local = threading.local ()
+
+    def close (self):
+        with self.lock:
+            if self.db != None:
+                self.db.close ()
+                self.db = None
+
+    def relDir (self, src_dir):
+        if src_dir == self.root:
+            return ''
+        return src_dir[len (self.prefix):]
+
+    def absDir (self, rel_dir):
+        if rel_dir == '':
+            return self.root
+        return os.path.join (self.root, rel_dir)
+
+    def split (self, src_path):
+        (src_dir, name) = os.path.split (src_path)
+        return (self.relDir (src_dir), name)
+
+    def query (self, sql, args = ()):
+        with self.lock:
+            return self.db.execute (sql, args).fetchall ()
+
+    def execute (self, statements):
+        with self.lock:
+            self.db.execute ('BEGIN')
+            try:
+                for (sql, args) in statements:
+                    self.db.execute (sql, args)
+            except:
+                self.db.execute ('ROLLBACK')
+                raise
+            self.db.execute ('COMMIT')
+
+    def write (self, sql, args):
+        pending = getattr (self.local, 'pending', None)
+        if pending != None:
+            pending.append ((sql, args))
+        else:
+            self.execute ([(sql, args)])
+
+    @contextlib.contextmanager
+    def transaction (self):
+        if getattr (self.local, 'pending', None) != None:
+            # nested, the outermost one writes
+            yield
+            return
+
+        self.local.pending = []
+        try:
+            yield
+        finally:
+            pending = self.local.pending
+            self.local.pending = None
+            if len (pending) > 0:
+                self.execute (pending)
+
+    def isComplete (self):
+        'Whether all directories of the tree were scanned, see --rebuild-catalog.'
+        return len (self.query ("SELECT 1 FROM meta WHERE key = 'complete' AND value = '1'")) > 0
+
+    def setComplete (self, complete):
+        self.write ("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', ?)", ('1' if complete else '0',))
+
+    def clear (self):
+        self.execute ([('DELETE FROM revisions', ()), ('DELETE FROM policies', ()),
+                       ('DELETE FROM dirs', ()), ('DELETE FROM meta', ())])
+
+    def getDir (self, src_dir):
+        '''
+        Returns the revisions of src_dir like RevisionIndex.scanDir or None
+        if the directory was not scanned yet.
+        '''
+        rel_dir = self.relDir (src_dir)
+        with self.lock:
+            if self.db.execute ('SELECT 1 FROM dirs WHERE dir = ? AND revisions = 1', (rel_dir,)).fetchone () == None:
+                return None
+
+            rows = self.db.execute ('SELECT name, id, mtime, size, kind, stored FROM revisions WHERE dir = ?', (rel_dir,)).fetchall ()
+
+        entries = {}
+        for (name, rev_id, mtime, size, kind, stored) in rows:
+            entries.setdefault (name, {})[rev_id] = (mtime, size, kind, stored)
+        return entries
+
+    def putDir (self, src_dir, entries):
+        rel_dir = self.relDir (src_dir)
+        statements = [('DELETE FROM revisions WHERE dir = ?', (rel_dir,))]
+        for (name, revisions) in entries.items ():
+            for (rev_id, (mtime, size, kind, stored)) in revisions.items ():
+                statements.append (('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (rel_dir, name, rev_id, mtime, size, kind, stored)))
+        statements.append (('INSERT OR IGNORE INTO dirs (dir) VALUES (?)', (rel_dir,)))
+        statements.append (('UPDATE dirs SET revisions = 1 WHERE dir = ?', (rel_dir,)))
+        self.execute (statements)
+
+    def addRevision (self, src_path, rev_id, mtime, size, kind, stored):
+        (rel_dir, name) = self.split (src_path)
+        self.write ('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (rel_dir, name, rev_id, mtime, size, kind, stored))
+
+    def moveRevision (self, src_path, old_id, new_id):
+        (rel_dir, name) = self.split (src_path)
+        self.write ('UPDATE revisions SET id = ? WHERE dir = ? AND name = ? AND id = ?', (new_id, rel_dir, name, old_id))
+
+    def removeRevision (self, src_path, rev_id):
+        (rel_dir, name) = self.split (src_path)
+        self.write ('DELETE FROM revisions WHERE dir = ? AND name = ? AND id = ?', (rel_dir, name, rev_id))
+
+    def getPolicies (self, src_dir):
+        '''
+        Returns the own policy of src_dir and the sidecars in it, both as
+        dictionaries, or None if the directory was not scanned yet.
+        '''
+        rel_dir = self.relDir (src_dir)
+        with self.lock:
+            if self.db.execute ('SELECT 1 FROM dirs WHERE dir = ? AND policies = 1', (rel_dir,)).fetchone () == None:
+                return None
+
+            rows = self.db.execute ('SELECT name, policy FROM policies WHERE dir = ?', (rel_dir,)).fetchall ()
+
+        policy = {}
+        overrides = {}
+        for (name, value) in rows:
+            if name == '':
+                policy = json.loads (value)
+            else:
+                overrides[name] = json.loads (value)
+        return (policy, overrides)
+
+    def putPolicies (self, src_dir, policy, overrides):
+        rel_dir = self.relDir (src_dir)
+        statements = [('DELETE FROM policies WHERE dir = ?', (rel_dir,))]
+        if len (policy) > 0:
+            statements.append (('INSERT INTO policies VALUES (?, ?, ?)', (rel_dir, '', json.dumps (policy))))
+        for (name, override) in overrides.items ():
+            statements.append (('INSERT INTO policies VALUES (?, ?, ?)', (rel_dir, name, json.dumps (override))))
+        statements.append (('INSERT OR IGNORE INTO dirs (dir) VALUES (?)', (rel_dir,)))
+        statements.append (('UPDATE dirs SET policies = 1 WHERE dir = ?', (rel_dir,)))
+        self.execute (statements)
+
+    def setPolicy (self, src_path, policy, is_dir = False):
+        'Stores the sidecar of src_path or, with is_dir, the policy of the directory.'
+        if is_dir:
+            (rel_dir, name) = (self.relDir (src_path), '')
+        else:
+            (rel_dir, name) = self.split (src_path)
+        self.write ('INSERT OR REPLACE INTO policies VALUES (?, ?, ?)', (rel_dir, name, json.dumps (policy)))
+
+    def treeCondition (self, rel_dir):
+        if rel_dir == '':
+            return ('1', ())
+        return ('(dir = ? OR substr (dir, 1, ?) = ?)', (rel_dir, len (rel_dir) + 1, rel_dir + '/'))
+
+    def invalidateTree (self, src_path):
+        'Forgets src_path and everything below it, it is scanned again when needed.'
+        (cond, args) = self.treeCondition (self.relDir (src_path))
+        for table in ['revisions', 'policies', 'dirs']:
+            self.write ('DELETE FROM {0} WHERE {1}'.format (table, cond), args)
+
+    def moveTree (self, old_path, new_path):
+        'Moves everything recorded below the directory old_path to new_path.'
+        old_rel = self.relDir (old_path)
+        new_rel = self.relDir (new_path)
+        self.invalidateTree (new_path)
+        (cond, args) = self.treeCondition (old_rel)
+        for table in ['revisions', 'policies', 'dirs']:
+            self.write ('UPDATE {0} SET dir = ? || substr (dir, ?) WHERE {1}'.format (table, cond),
+                        (new_rel, len (old_rel) + 1) + args)
+
+    def iterFiles (self, src_dir = None):
+        'Yields (src_path, revisions) for every file with revisions below src_dir.'
+        (cond, args) = ('1', ())
+        if src_dir != None:
+            (cond, args) = self.treeCondition (self.relDir (src_dir))
+        rows = self.query ('SELECT dir, name, id, mtime, size, kind, stored FROM revisions WHERE {0} ORDER BY dir, name'.format (cond), args)
+        current = None
+        revisions = {}
+        for (rel_dir, name, rev_id, mtime, size, kind, stored) in rows:
+            if current != (rel_dir, name):
+                if current != None:
+                    yield (os.path.join (self.absDir (current[0]), current[1]), revisions)
+                current = (rel_dir, name)
+                revisions = {}
+            revisions[rev_id] = (mtime, size, kind, stored)
+
+        if current != None:
+            yield (os.path.join (self.absDir (current[0]), current[1]), revisions)
+
+    def getOlderThan (self, mtime, src_dir = None):
+        'Returns (path, id, mtime, size) of all revisions older than mtime.'
+        (cond, args) = ('1', ())
+        if src_dir != None:
+            (cond, args) = self.treeCondition (self.relDir (src_dir))
+        rows = self.query ('SELECT dir, name, id, mtime, size FROM revisions WHERE mtime < ? AND {0} ORDER BY mtime'.format (cond),
+                           (mtime,) + args)
+        return [(os.path.join (self.absDir (d), name), rev_id, t, size) for (d, name, rev_id, t, size) in rows]
+
+    def getTotals (self, src_dir = None):
+        'Returns the number, the size and the stored size of the revisions below src_dir.'
+        (cond, args) = ('1', ())
+        if src_dir != None:
+            (cond, args) = self.treeCondition (self.relDir (src_dir))
+        (count, size, stored) = self.query ('SELECT count (*), sum (size), sum (stored) FROM revisions WHERE {0}'.format (cond), args)[0]
+        return (count, size or 0, stored or 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser (description='Query the revision catalog of a RevisionFS source directory.')
+    parser.add_argument ('source_dir', metavar='source',
+                         help='the source directory of the file system')
+    parser.add_argument ('path', nargs='?',
+                         help='only look at revisions below this directory of the source directory')
+    parser.add_argument ('-o', dest='older_than', type=float,
+                         help='list the revisions older than this number of days')
+
+    args = parser.parse_args ()
+
+    root = os.path.abspath (args.source_dir)
+    if not os.path.exists (os.path.join (root, catalog_name)):
+        print ("{0} has no catalog, mount it with --catalog or --rebuild-catalog".format (root))
+        sys.exit (1)
+
+    catalog = Catalog (root)
+    src_dir = None
+    if args.path != None:
+        src_dir = os.path.join (root, args.path.strip ('/')).rstrip ('/')
+
+    if args.older_than != None:
+        for (path, rev_id, mtime, size) in catalog.getOlderThan (time.time () - args.older_than * 24 * 60 * 60, src_dir):
+            print ("{0} {1:>6} {2} {3:>12}".format (time.strftime ('%Y-%m-%d %H:%M:%S', time.localtime (mtime)), rev_id, path, size))
+
+    (count, size, stored) = catalog.getTotals (src_dir)
+    print ("{0} revisions, {1} bytes, {2} bytes stored".format (count, size, stored))
+    if not catalog.isComplete ():
+        print ("catalog is incomplete, rebuild it with --rebuild-catalog")
+    catalog.close ()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Compression of revisions. A compressed revision starts with a header holding
+# the codec and the size of the uncompressed content, followed by the
+# compressed data. Compression runs in a process pool, so it does not compete
+# with the file system threads for the GIL.
+
+import os
+import sys
+import zlib
+import lzma
+import struct
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compress_magic = b'RFSCMP01'
+header_format = struct.Struct ('<8s8sQ')
+block_size = 1024 * 1024
+
+codec_zlib = 'zlib'
+codec_lzma = 'lzma'
+codec_zstd = 'zstd'
+
+codecs = [codec_zlib, codec_lzma]
+if zstandard != None:
+    codecs.append (codec_zstd)
+
+default_codec = codec_zlib
+if zstandard != None:
+    default_codec = codec_zstd
+
+def GetCompressor (codec):
+    if codec == codec_zlib:
+        return zlib.compressobj (6)
+    if codec == codec_lzma:
+        return lzma.LZMACompressor ()
+    if codec == codec_zstd and zstandard != None:
+        return zstandard.ZstdCompressor ().compressobj ()
+
+    raise ValueError ("unknown codec " + repr (codec))
+
+def GetDecompressor (codec):
+    if codec == codec_zlib:
+        return zlib.decompressobj ()
+    if codec == codec_lzma:
+        return lzma.LZMADecompressor ()
+    if codec == codec_zstd and zstandard != None:
+        return zstandard.ZstdDecompressor ().decompressobj ()
+
+    raise ValueError ("unknown codec " + repr (codec))
+
+def ReadHeader (f):
+    data = f.read (header_format.size)
+    if len (data) != header_format.size:
+        raise ValueError ("compression header too short")
+
+    (magic, codec, size) = header_format.unpack (data)
+    if magic != compress_magic:
+        raise ValueError ("no compressed file")
+
+    return (codec.rstrip (b'\0').decode ('ASCII'), size)
+
+def GetLogicalSize (path):
+    with open (path, 'rb') as f:
+        return ReadHeader (f)[1]
+
+def CompressFile (src_path, dest_path, codec):
+    '''
+    Writes a compressed copy of src_path to dest_path and returns the size of
+    dest_path. This is run in a worker process.
+    '''
+    compressor = GetCompressor (codec)
+    size = os.stat (src_path).st_size
+    with open (src_path, 'rb') as src, open (dest_path, 'wb') as dest:
+        dest.write (header_format.pack (compress_magic, codec.encode ('ASCII'), size))
+        while True:
+            data = src.read (block_size)
+            if len (data) == 0:
+                break
+            dest.write (compressor.compress (data))
+        dest.write (compressor.flush ())
+
+    return os.stat (dest_path).st_size
+
+def DecompressFile (src_path, dest_path):
+    with open (src_path, 'rb') as src, open (dest_path, 'wb') as dest:
+        (codec, size) = ReadHeader (src)
+        decompressor = GetDecompressor (codec)
+        while True:
+            data = src.read (block_size)
+            if len (data) == 0:
+                break
+            dest.write (decompressor.decompress (data))
+
+        if hasattr (decompressor, 'flush'):
+            dest.write (decompressor.flush ())
+
+class Compressor:
+    '''
+    Runs CompressFile in a pool of worker processes. The pool is only started
+    with the first job, after the file system went into the background.
+    '''
+    def __init__ (self, codec = default_codec, workers = None):
+        self.codec = codec
+        self.workers = workers
+        self.pool = None
+        self.pending = set ()
+        self.lock = threading.Lock ()
+
+    def submit (self, key, src_path, dest_path, done):
+        '''
+        Compresses src_path to dest_path in the background and calls
+        done (stored_size) when finished or done (None) on errors.
+        Jobs for a key that is still in progress are ignored.
+        '''
+        with self.lock:
+            if key in self.pending:
+                return False
+
+            if self.pool == None:
+                ctx = None
+                if 'forkserver' in multiprocessing.get_all_start_methods ():
+                    ctx = multiprocessing.get_context ('forkserver')
+                self.pool = concurrent.futures.ProcessPoolExecutor (max_workers=self.workers, mp_context=ctx)
+
+            try:
+                future = self.pool.submit (CompressFile, src_path, dest_path, self.codec)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                logging.error ("compression pool failed, restarting it: %s", e)
+                self.pool.shutdown (wait=False)
+                self.pool = None
+                return False
+
+            self.pending.add (key)
+
+        def finished (future):
+            self.pending.discard (key)
+            try:
+                stored = future.result ()
+            except Exception as e:
+                logging.error ("compression of %s failed: %s", src_path, e)
+                stored = None
+            done (stored)
+
+        future.add_done_callback (finished)
+        return True
+
+    def shutdown (self, wait = True):
+        if self.pool != None:
+            self.pool.shutdown (wait=wait)
+            self.pool = None
+
+
+if __name__ == "__main__":
+    if len (sys.argv) < 4:
+        print ("usage: {0} -c|-d source destination [codec]".format (sys.argv[0]))
+        sys.exit (1)
+
+    if sys.argv[1] == '-c':
+        codec = default_codec
+        if len (sys.argv) > 4:
+            codec = sys.argv[4]
+        print ("{0} bytes stored".format (CompressFile (sys.argv[2], sys.argv[3], codec)))
+    else:
+        DecompressFile (sys.argv[2], sys.argv[3])
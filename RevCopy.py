@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import os
+import sys
+import errno
+import fcntl
+import shutil
+import logging
+import tempfile
+import threading
+import concurrent.futures
+
+import RevDelta
+
+# ioctl number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+strategy_reflink = 'reflink'
+strategy_copy_file_range = 'copy_file_range'
+strategy_copy = 'copy'
+
+strategies = [strategy_reflink, strategy_copy_file_range, strategy_copy]
+
+# errors telling that a strategy is not supported for a pair of files,
+# in this case the next strategy is tried
+fallback_errors = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EBADF)
+
+# files of at least this size are copied in the background, if no reflink is possible
+background_copy_size = 16 * 1024 * 1024
+background_workers = 4
+# the background copy releases its lock after each block, so writers can get in between
+background_block_size = 1024 * 1024
+
+def ReflinkFile (src_fd, dst_fd):
+    fcntl.ioctl (dst_fd, FICLONE, src_fd)
+
+def CopyFileRange (src_fd, dst_fd):
+    size = os.fstat (src_fd).st_size
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range (src_fd, dst_fd, size - offset, offset, offset)
+        if n == 0:
+            break
+        offset += n
+
+class BackgroundCopy:
+    '''
+    Copies src_path to dst_path in the background while the source is
+    changed. Before a range of the source is changed, saveRange copies it
+    at once if the background copy did not reach it yet, so dst_path ends
+    up with the content src_path had when the copy was started. Writers only
+    wait for the ranges they change. It is used like a RevDelta.DeltaWriter,
+    on_close is called with the copy once it is closed.
+    '''
+    def __init__ (self, src_path, dst_path, strategy = strategy_copy, on_close = None):
+        self.dst_path = dst_path
+        self.on_close = on_close
+        self.src_fd = os.open (src_path, os.O_RDONLY)
+        try:
+            self.dst_fd = os.open (dst_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except:
+            os.close (self.src_fd)
+            raise
+
+        sr = os.fstat (self.src_fd)
+        self.size = sr.st_size
+        self.times_ns = (sr.st_atime_ns, sr.st_mtime_ns)
+        # mode and extended attributes now, the times again once it is written
+        shutil.copystat (src_path, dst_path)
+        self.use_copy_file_range = strategy != strategy_copy
+        self.copied = RevDelta.ExtentSet ()
+        self.lock = threading.Lock ()
+        self.done = threading.Event ()
+        self.closed = False
+
+    def copyRange (self, start, end):
+        pos = start
+        while pos < end:
+            if self.use_copy_file_range:
+                try:
+                    n = os.copy_file_range (self.src_fd, self.dst_fd, end - pos, pos, pos)
+                except OSError as e:
+                    if e.errno not in fallback_errors:
+                        raise
+                    self.use_copy_file_range = False
+                    continue
+            else:
+                data = os.pread (self.src_fd, min (background_block_size, end - pos), pos)
+                n = 0
+                if len (data) > 0:
+                    n = os.pwrite (self.dst_fd, data, pos)
+
+            if n == 0:
+                # the source was cut outside of the file system
+                break
+            pos += n
+
+        self.copied.add (start, end)
+
+    def saveRange (self, offset, length):
+        'Returns the number of bytes that had to be copied first.'
+        end = min (offset + length, self.size)
+        if offset >= end:
+            return 0
+
+        count = 0
+        with self.lock:
+            for (start, stop) in self.copied.missing (offset, end):
+                self.copyRange (start, stop)
+                count += stop - start
+
+        return count
+
+    def truncate (self, length):
+        'Has to be called before the file is truncated to length.'
+        return self.saveRange (length, self.size - length)
+
+    def run (self):
+        try:
+            for offset in range (0, self.size, background_block_size):
+                self.saveRange (offset, background_block_size)
+        except OSError as e:
+            # close tries the missing ranges again
+            logging.error ("background copy to %s failed: %s", self.dst_path, e)
+        finally:
+            self.done.set ()
+
+    def wait (self):
+        self.done.wait ()
+
+    def close (self):
+        'Waits until the copy is complete.'
+        self.done.wait ()
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+
+        try:
+            self.saveRange (0, self.size)
+            os.ftruncate (self.dst_fd, self.size)
+            os.utime (self.dst_fd, ns=self.times_ns)
+        finally:
+            os.close (self.src_fd)
+            os.close (self.dst_fd)
+            if self.on_close != None:
+                self.on_close (self)
+
+class CopyEngine:
+    '''
+    Copies files using the fastest method supported by the file system:
+    a reflink (btrfs, XFS) shares the data blocks and takes constant time,
+    copy_file_range copies inside the kernel and plain copying reads the data
+    through user space.
+
+    detect () finds out once which method works in a directory, copy () starts
+    with that method and falls back to the next one if it fails for a file.
+    '''
+    def __init__ (self, strategy = strategy_copy):
+        self.strategy = strategy
+        self.lock = threading.Lock ()
+        self.executor = None
+        # destination path -> BackgroundCopy
+        self.pending = {}
+
+    def detect (self, src_dir):
+        '''
+        Tries all strategies on a small temporary file in src_dir and keeps the
+        first one that works.
+        '''
+        (src_fd, src_name) = tempfile.mkstemp (prefix='.rev_probe_', dir=src_dir)
+        (dst_fd, dst_name) = tempfile.mkstemp (prefix='.rev_probe_', dir=src_dir)
+        try:
+            os.write (src_fd, b'RevisionFS copy probe\n')
+            self.strategy = strategy_copy
+            for strategy in strategies[:-1]:
+                try:
+                    self.copyFd (strategy, src_fd, dst_fd)
+                    self.strategy = strategy
+                    break
+                except (OSError, AttributeError) as e:
+                    logging.debug ("copy strategy %s not supported in %s: %s", strategy, src_dir, e)
+        finally:
+            os.close (src_fd)
+            os.close (dst_fd)
+            os.unlink (src_name)
+            os.unlink (dst_name)
+
+        logging.info ("Using %s to create revision copies in %s", self.strategy, src_dir)
+        return self.strategy
+
+    def copyFd (self, strategy, src_fd, dst_fd):
+        if strategy == strategy_reflink:
+            ReflinkFile (src_fd, dst_fd)
+        elif strategy == strategy_copy_file_range:
+            CopyFileRange (src_fd, dst_fd)
+        else:
+            raise OSError (errno.ENOSYS, "no in-kernel copy for strategy " + strategy)
+
+    def copy (self, src, dst):
+        '''
+        Copies file content and metadata like shutil.copy2 does.
+        Returns the strategy that was used.
+        '''
+        used = strategy_copy
+        if self.strategy != strategy_copy:
+            src_fd = os.open (src, os.O_RDONLY)
+            try:
+                dst_fd = os.open (dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                try:
+                    for strategy in strategies[strategies.index (self.strategy):-1]:
+                        try:
+                            self.copyFd (strategy, src_fd, dst_fd)
+                            used = strategy
+                            break
+                        except OSError as e:
+                            if e.errno not in fallback_errors:
+                                raise
+                            logging.debug ("%s failed for %s: %s", strategy, src, e)
+                            os.ftruncate (dst_fd, 0)
+                finally:
+                    os.close (dst_fd)
+            finally:
+                os.close (src_fd)
+
+        if used == strategy_copy:
+            shutil.copy2 (src, dst)
+        else:
+            shutil.copystat (src, dst)
+
+        return used
+
+    def canCopyInBackground (self, size):
+        'A reflink is always faster than waiting for a copy of a large file.'
+        return self.strategy != strategy_reflink and size >= background_copy_size
+
+    def copyInBackground (self, src, dst):
+        '''
+        Starts copying src to dst on a worker thread and returns the
+        BackgroundCopy, which has to be closed.
+        '''
+        copy = BackgroundCopy (src, dst, self.strategy, self.closed)
+        with self.lock:
+            if self.executor == None:
+                self.executor = concurrent.futures.ThreadPoolExecutor (background_workers, thread_name_prefix='RevisionCopy')
+            self.pending[dst] = copy
+            self.executor.submit (copy.run)
+        return copy
+
+    def closed (self, copy):
+        with self.lock:
+            if self.pending.get (copy.dst_path) is copy:
+                del self.pending[copy.dst_path]
+
+    def isPending (self, dst):
+        return dst in self.pending
+
+    def wait (self, dst):
+        '''
+        Waits until the background copy to dst, if any, has copied
+        everything. It is only closed with the file it copies.
+        '''
+        copy = self.pending.get (dst)
+        if copy != None:
+            copy.wait ()
+
+    def shutdown (self):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor != None:
+            executor.shutdown (wait=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig (level=logging.DEBUG)
+    if len (sys.argv) < 2:
+        print ("usage: {0} directory [source destination]".format (sys.argv[0]))
+        sys.exit (1)
+
+    engine = CopyEngine ()
+    print ("{0}: {1}".format (sys.argv[1], engine.detect (sys.argv[1])))
+
+    if len (sys.argv) >= 4:
+        print ("copied {0} to {1} using {2}".format (sys.argv[2], sys.argv[3], engine.copy (sys.argv[2], sys.argv[3])))
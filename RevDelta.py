@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Delta revisions only store the parts of a file that were changed in a write
+# session. A delta file starts with a header holding the length the file had
+# before the session, followed by records of (offset, length, original data).
+#
+# A delta revision describes its content relative to the next newer state of
+# the file, which is either the next newer revision or the current file:
+# the newer state is cut or extended to the original length and the saved
+# ranges are written back.
+
+import os
+import sys
+import bisect
+import struct
+import threading
+
+delta_magic = b'RFSDLT01'
+header_format = struct.Struct ('<8sQ')
+record_format = struct.Struct ('<QQ')
+copy_block_size = 1024 * 1024
+
+class ExtentSet:
+    'A set of non overlapping byte ranges [start, end).'
+
+    def __init__ (self):
+        self.starts = []
+        self.ends = []
+
+    def __len__ (self):
+        return len (self.starts)
+
+    def __iter__ (self):
+        return zip (self.starts, self.ends)
+
+    def add (self, start, end):
+        if start >= end:
+            return
+
+        i = bisect.bisect_left (self.ends, start)
+        j = bisect.bisect_right (self.starts, end)
+        if i < j:
+            start = min (start, self.starts[i])
+            end = max (end, self.ends[j-1])
+
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def missing (self, start, end):
+        'Returns the parts of [start, end) which are not in the set.'
+        res = []
+        i = bisect.bisect_right (self.ends, start)
+        while start < end:
+            if i >= len (self.starts) or self.starts[i] >= end:
+                res.append ((start, end))
+                break
+
+            if self.starts[i] > start:
+                res.append ((start, self.starts[i]))
+
+            start = self.ends[i]
+            i += 1
+
+        return res
+
+def ReadHeader (f):
+    data = f.read (header_format.size)
+    if len (data) != header_format.size:
+        raise ValueError ("delta header too short")
+
+    (magic, orig_len) = header_format.unpack (data)
+    if magic != delta_magic:
+        raise ValueError ("no delta file")
+
+    return orig_len
+
+def GetOriginalLength (delta_path):
+    with open (delta_path, 'rb') as f:
+        return ReadHeader (f)
+
+def ReadExtents (f):
+    '''
+    Returns the original length and the list of (offset, length, position of
+    the data in the delta file) of an open delta file.
+    '''
+    f.seek (0)
+    orig_len = ReadHeader (f)
+    extents = []
+    pos = header_format.size
+    while True:
+        data = f.read (record_format.size)
+        if len (data) < record_format.size:
+            break
+
+        (offset, length) = record_format.unpack (data)
+        pos += record_format.size
+        extents.append ((offset, length, pos))
+        pos += length
+        f.seek (pos)
+
+    return (orig_len, extents)
+
+def ApplyDelta (delta_path, fd):
+    '''
+    Turns the content of fd, which has to hold the next newer state of the
+    file, into the state stored in the delta.
+    '''
+    with open (delta_path, 'rb') as f:
+        (orig_len, extents) = ReadExtents (f)
+        os.ftruncate (fd, orig_len)
+        for (offset, length, pos) in extents:
+            f.seek (pos)
+            done = 0
+            while done < length:
+                data = f.read (min (copy_block_size, length - done))
+                os.pwrite (fd, data, offset + done)
+                done += len (data)
+
+def CopyRange (f, pos, writer, offset, length):
+    f.seek (pos)
+    while length > 0:
+        data = f.read (min (copy_block_size, length))
+        if len (data) == 0:
+            break
+
+        writer.appendRange (offset, data)
+        offset += len (data)
+        length -= len (data)
+
+def MergeDeltas (older_path, newer_path, dest_path):
+    '''
+    Writes a delta to dest_path that gives the state of older_path when applied
+    to the base of newer_path. Used when the revision stored in newer_path is
+    deleted while older_path still refers to it.
+    '''
+    with open (older_path, 'rb') as older, open (newer_path, 'rb') as newer:
+        (orig_len, older_extents) = ReadExtents (older)
+        (newer_len, newer_extents) = ReadExtents (newer)
+
+        writer = DeltaWriter (dest_path, orig_len)
+        try:
+            for (offset, length, pos) in older_extents:
+                CopyRange (older, pos, writer, offset, length)
+
+            for (offset, length, pos) in newer_extents:
+                for (start, end) in writer.saved.missing (offset, min (offset + length, orig_len)):
+                    CopyRange (newer, pos + start - offset, writer, start, end - start)
+        finally:
+            writer.close ()
+
+class DeltaWriter:
+    '''
+    Collects the original content of a file during a write session.
+    saveRange () has to be called before a range of the file is overwritten,
+    only the parts that were not saved before are read from the file. It can
+    be called from several threads writing to the same file.
+    '''
+    def __init__ (self, delta_path, orig_len, src_path = None, times_ns = None):
+        self.delta_path = delta_path
+        self.orig_len = orig_len
+        self.times_ns = times_ns
+        self.saved = ExtentSet ()
+        self.lock = threading.Lock ()
+        self.src_fd = None
+        if src_path != None:
+            self.src_fd = os.open (src_path, os.O_RDONLY)
+
+        self.fd = os.open (delta_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.write (self.fd, header_format.pack (delta_magic, orig_len))
+        self.size = header_format.size
+
+    def appendRange (self, offset, data):
+        os.write (self.fd, record_format.pack (offset, len (data)) + data)
+        self.size += record_format.size + len (data)
+        self.saved.add (offset, offset + len (data))
+
+    def saveRange (self, offset, length):
+        'Returns the number of bytes that were saved.'
+        end = min (offset + length, self.orig_len)
+        if offset >= end:
+            return 0
+
+        count = 0
+        with self.lock:
+            for (start, stop) in self.saved.missing (offset, end):
+                while start < stop:
+                    data = os.pread (self.src_fd, min (copy_block_size, stop - start), start)
+                    if len (data) == 0:
+                        break
+
+                    self.appendRange (start, data)
+                    start += len (data)
+                    count += len (data)
+
+        return count
+
+    def truncate (self, length):
+        'Has to be called before the file is truncated to length.'
+        return self.saveRange (length, self.orig_len - length)
+
+    def close (self):
+        with self.lock:
+            if self.src_fd != None:
+                os.close (self.src_fd)
+                self.src_fd = None
+
+            if self.fd != None:
+                os.close (self.fd)
+                self.fd = None
+
+                # the revision keeps the times of the content it stores
+                if self.times_ns != None:
+                    os.utime (self.delta_path, ns=self.times_ns)
+
+
+if __name__ == "__main__":
+    if len (sys.argv) < 2:
+        print ("usage: {0} delta_file".format (sys.argv[0]))
+        sys.exit (1)
+
+    with open (sys.argv[1], 'rb') as f:
+        (orig_len, extents) = ReadExtents (f)
+
+    print ("original length {0}, {1} saved ranges".format (orig_len, len (extents)))
+    for (offset, length, pos) in extents:
+        print ("  {0:>12} {1:>10}".format (offset, length))
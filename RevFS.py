@@ -4,12 +4,21 @@
 
 import os
 import re
+import json
+import errno
 import datetime
+import concurrent.futures
 
 xattr_max_revisions_name = "user.revfs_max_revisions"
 xattr_revisions_name     = "user.revfs_revisions"
+xattr_revisions_stored_name = "user.revfs_revisions_stored"
 xattr_max_revision_age   = "user.revfs_max_age"
 xattr_min_revisions_age  = "user.revfs_min_revisions"
+xattr_storage_name       = "user.revfs_storage"
+xattr_coalesce_name      = "user.revfs_coalesce"
+xattr_restore_name       = "user.revfs_restore"
+xattr_info_name          = "user.revfs_info"
+xattr_space_name         = "user.revfs_space"
 
 def SplitRevisionString (revisions):
     s_pattern = r"\(([^,]+,[^,]+,[^,]+)\)"
@@ -70,11 +79,35 @@ def GetMinRevisionsAge (fname):
 def SetMinRevisionsAge (fname, min_revisions_age):
     os.setxattr (fname, xattr_min_revisions_age, str (min_revisions_age).encode ('ASCII'), follow_symlinks=False)
 
+def GetStorage (fname):
+    return os.getxattr (fname, xattr_storage_name, follow_symlinks=False).decode ('ASCII')
+
+def SetStorage (fname, storage):
+    os.setxattr (fname, xattr_storage_name, storage.encode ('ASCII'), follow_symlinks=False)
+
+def GetCoalesce (fname):
+    s_coalesce = os.getxattr (fname, xattr_coalesce_name, follow_symlinks=False)
+    coalesce = 0
+    try:
+        coalesce = int (s_coalesce)
+    except ValueError:
+        pass
+    return coalesce
+
+def SetCoalesce (fname, coalesce):
+    os.setxattr (fname, xattr_coalesce_name, str (coalesce).encode ('ASCII'), follow_symlinks=False)
+
+def RestoreRevision (fname, revision):
+    os.setxattr (fname, xattr_restore_name, str (revision).encode ('ASCII'), follow_symlinks=False)
+
 class RevisionInfo:
+    __slots__ = ('revision', 'size', 'date', 'stored_size')
+
     def __init__ (self, revision, size, date):
         self.revision = revision
         self.size = size
         self.date = date
+        self.stored_size = size
 
 def GetRevisionInfos (fname):
     rev_list = []
@@ -96,8 +129,131 @@ def GetRevisionInfos (fname):
         except ValueError:
             pass
         
+    try:
+        stored = os.getxattr (fname, xattr_revisions_stored_name, follow_symlinks=False)
+    except OSError:
+        # mounted by a version without compression
+        return rev_list
+
+    stored_sizes = {}
+    for rev in re.findall (r"\((\d+),(\d+)\)", stored.decode ('ASCII')):
+        stored_sizes[int (rev[0])] = int (rev[1])
+
+    for rev in rev_list:
+        rev.stored_size = stored_sizes.get (rev.revision, rev.size)
+
     return rev_list
 
+class RevisionFSInfo:
+    'The revision settings and the revisions of a file, see GetInfo.'
+    __slots__ = ('max_revisions', 'max_age', 'min_revisions', 'storage', 'coalesce', 'revisions')
+
+def ParseInfo (data):
+    '''
+    Parses the value of user.revfs_info, a JSON object with the settings and
+    the revisions as [revision, mtime, size, stored size], newest first.
+    '''
+    info = json.loads (data)
+    res = RevisionFSInfo ()
+    res.max_revisions = info['max_revisions']
+    res.max_age = info['max_age']
+    res.min_revisions = info['min_revisions']
+    res.storage = info['storage']
+    # not sent by older versions
+    res.coalesce = info.get ('coalesce', 0)
+    res.revisions = []
+    for (revision, mtime, size, stored_size) in info['revisions']:
+        rev = RevisionInfo (revision, size, datetime.datetime.fromtimestamp (mtime))
+        rev.stored_size = stored_size
+        res.revisions.append (rev)
+
+    return res
+
+def GetInfo (fname):
+    '''
+    Returns the RevisionFSInfo of fname with a single getxattr or None if
+    fname is not on a RevisionFS. Mounts of older versions without
+    user.revfs_info are asked for the single attributes instead.
+    '''
+    try:
+        return ParseInfo (os.getxattr (fname, xattr_info_name, follow_symlinks=False))
+    except OSError as e:
+        if e.errno not in (errno.ENODATA, errno.ENOTSUP):
+            raise
+
+    if not IsOnRevisionFS (fname):
+        return None
+
+    res = RevisionFSInfo ()
+    res.max_revisions = GetMaxRevisions (fname)
+    res.max_age = GetMaxRevisionAge (fname)
+    res.min_revisions = GetMinRevisionsAge (fname)
+    try:
+        res.storage = GetStorage (fname)
+    except OSError:
+        res.storage = 'full'
+    try:
+        res.coalesce = GetCoalesce (fname)
+    except OSError:
+        res.coalesce = 0
+    res.revisions = GetRevisionInfos (fname)
+    return res
+
+def GetSpaceUsage (mount_dir):
+    '''
+    Returns the space used by all revisions of the mount with a space
+    budget as dictionary: used and limit in bytes, headroom (limit - used),
+    complete (False while the first scan runs) and the eviction policy.
+    '''
+    return json.loads (os.getxattr (mount_dir, xattr_space_name, follow_symlinks=False))
+
+def WalkTree (path):
+    '''
+    Yields path and, for a directory, everything below it. A directory is
+    yielded before its entries are listed, so changes made to it when it is
+    yielded are seen by its entries.
+    '''
+    yield path
+    if os.path.islink (path) or not os.path.isdir (path):
+        return
+
+    dirs = [path]
+    while len (dirs) > 0:
+        try:
+            it = os.scandir (dirs.pop ())
+        except OSError:
+            continue
+
+        with it:
+            for entry in it:
+                yield entry.path
+                if entry.is_dir (follow_symlinks=False):
+                    dirs.append (entry.path)
+
+def MapParallel (func, items, workers):
+    '''
+    Calls func (item) for all items in a pool of threads and yields
+    (item, result, error) in the order the calls finish. Only a few items per
+    thread are taken ahead, so items can be a walk over a large tree.
+    '''
+    with concurrent.futures.ThreadPoolExecutor (max_workers=workers) as pool:
+        pending = {}
+
+        def finished (futures):
+            for future in futures:
+                item = pending.pop (future)
+                try:
+                    yield (item, future.result (), None)
+                except OSError as e:
+                    yield (item, None, e)
+
+        for item in items:
+            pending[pool.submit (func, item)] = item
+            if len (pending) >= workers * 4:
+                (done, not_done) = concurrent.futures.wait (pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from finished (done)
+
+        yield from finished (concurrent.futures.as_completed (list (pending)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Rules for the files that get no revisions, like editor swap files, object
+# files or downloads in progress. A rule file holds one rule per line:
+#
+#   exclude *.o
+#   exclude .*.swp
+#   exclude __pycache__/
+#   exclude /build/
+#   exclude *.iso >100M
+#   include /build/release/
+#
+# A pattern without '/' is matched against the file name, any other against
+# the path below the mount root, where '*' does not match '/' but '**' does
+# and '**/' matches any number of directories, also none.
+# A pattern ending in '/' matches directories and the rule applies to all
+# files below them. A size (>N or <N, with K, M, G or T) restricts the rule
+# to larger or smaller files. The last rule that matches a file wins. Empty
+# lines and lines starting with '#' are ignored.
+
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+import threading
+
+size_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+dir_cache_size = 16 * 1024
+
+def ParseSize (s):
+    m = re.fullmatch (r'(\d+)([KMGT]?)B?', s.upper ())
+    if m == None:
+        raise ValueError ("invalid size {0!r}".format (s))
+    return int (m.group (1)) * size_units[m.group (2)]
+
+def GlobToRegex (pattern):
+    'Translates a glob pattern, * and ? do not match /, ** matches everything, **/ also nothing.'
+    res = []
+    i = 0
+    while i < len (pattern):
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if pattern[i:i+2] == '*/':
+                # also no directory at all
+                i += 2
+                res.append ('(?:.*/)?')
+            elif pattern[i:i+1] == '*':
+                i += 1
+                res.append ('.*')
+            else:
+                res.append ('[^/]*')
+        elif c == '?':
+            res.append ('[^/]')
+        elif c == '[':
+            j = pattern.find (']', i + 1 if pattern[i:i+1] in ('!', ']') else i)
+            if j < 0:
+                res.append ('\\[')
+                continue
+            chars = pattern[i:j].replace ('\\', '\\\\')
+            if chars.startswith ('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith ('^'):
+                chars = '\\' + chars
+            res.append ('[' + chars + ']')
+            i = j + 1
+        else:
+            res.append (re.escape (c))
+
+    return ''.join (res)
+
+class Rule:
+    __slots__ = ('index', 'exclude', 'pattern', 'regex', 'on_path', 'dir_only', 'size_op', 'size')
+
+    def __init__ (self, index, exclude, pattern, size_op = None, size = 0):
+        self.index = index
+        self.exclude = exclude
+        self.pattern = pattern
+        self.dir_only = pattern.endswith ('/')
+        pattern = pattern.rstrip ('/')
+        self.on_path = '/' in pattern
+        self.regex = GlobToRegex (pattern.lstrip ('/'))
+        self.size_op = size_op
+        self.size = size
+
+    def matchesSize (self, size):
+        if self.size_op == '>':
+            return size > self.size
+        return size < self.size
+
+def ParseRules (lines, name = '<rules>'):
+    'Returns the list of Rule, raises ValueError for an invalid line.'
+    rules = []
+    for (n, line) in enumerate (lines, 1):
+        words = line.split ()
+        if len (words) == 0 or words[0].startswith ('#'):
+            continue
+
+        if words[0] not in ('include', 'exclude') or len (words) not in (2, 3) or words[1] in ('/', ''):
+            raise ValueError ("{0}:{1}: expected include|exclude PATTERN [>SIZE|<SIZE]".format (name, n))
+
+        size_op = None
+        size = 0
+        if len (words) == 3:
+            if words[2][:1] not in ('<', '>') or words[1].endswith ('/'):
+                raise ValueError ("{0}:{1}: a size needs >SIZE or <SIZE and a file pattern".format (name, n))
+            size_op = words[2][0]
+            try:
+                size = ParseSize (words[2][1:])
+            except ValueError as e:
+                raise ValueError ("{0}:{1}: {2}".format (name, n, e))
+
+        rules.append (Rule (len (rules), words[0] == 'exclude', words[1], size_op, size))
+
+    return rules
+
+def CompileAlternatives (rules):
+    '''
+    Compiles the patterns of rules into one regular expression, the newest
+    rule first, so the group that matches is the rule that wins.
+    '''
+    if len (rules) == 0:
+        return None
+    return re.compile ('|'.join ('(?P<r{0}>{1})\\Z'.format (rule.index, rule.regex)
+                                 for rule in sorted (rules, key=lambda rule: -rule.index)), re.S)
+
+def MatchIndex (regex, s):
+    if regex == None:
+        return -1
+    m = regex.match (s)
+    if m == None:
+        return -1
+    return int (m.lastgroup[1:])
+
+class Matcher:
+    '''
+    The compiled rules. Directory rules are evaluated once per directory,
+    the result is kept for the files in it and the directories below it.
+    '''
+    def __init__ (self, rules):
+        self.rules = rules
+        dir_rules = [rule for rule in rules if rule.dir_only]
+        file_rules = [rule for rule in rules if not rule.dir_only and rule.size_op == None]
+        self.dir_name_regex = CompileAlternatives ([rule for rule in dir_rules if not rule.on_path])
+        self.dir_path_regex = CompileAlternatives ([rule for rule in dir_rules if rule.on_path])
+        self.name_regex = CompileAlternatives ([rule for rule in file_rules if not rule.on_path])
+        self.path_regex = CompileAlternatives ([rule for rule in file_rules if rule.on_path])
+        self.size_rules = [(rule, re.compile (rule.regex + '\\Z', re.S))
+                           for rule in reversed (rules) if rule.size_op != None]
+        # relative directory -> index of the last directory rule that applies
+        self.dirs = {}
+
+    def dirRule (self, rel_dir):
+        if rel_dir == '':
+            return -1
+
+        res = self.dirs.get (rel_dir)
+        if res != None:
+            return res
+
+        (parent, name) = os.path.split (rel_dir)
+        res = max (self.dirRule (parent), MatchIndex (self.dir_name_regex, name), MatchIndex (self.dir_path_regex, rel_dir))
+        if len (self.dirs) >= dir_cache_size:
+            self.dirs.clear ()
+        self.dirs[rel_dir] = res
+        return res
+
+    def match (self, rel_path, get_size):
+        '''
+        Returns the rule that decides about the file rel_path or None.
+        get_size is only called when a size has to be compared.
+        '''
+        (rel_dir, name) = os.path.split (rel_path)
+        best = max (self.dirRule (rel_dir), MatchIndex (self.name_regex, name), MatchIndex (self.path_regex, rel_path))
+        for (rule, regex) in self.size_rules:
+            if rule.index <= best:
+                break
+            if regex.match (rel_path if rule.on_path else name) and rule.matchesSize (get_size ()):
+                best = rule.index
+                break
+
+        if best < 0:
+            return None
+        return self.rules[best]
+
+class Rules:
+    '''
+    The rules of a rule file for the files below root. The file is checked
+    for changes every check_interval seconds and read again, an invalid file
+    keeps the rules read before.
+    '''
+    def __init__ (self, path, root, check_interval = 1.0):
+        self.path = path
+        self.prefix = os.path.join (root, '')
+        self.check_interval = check_interval
+        self.lock = threading.Lock ()
+        self.file_id = None
+        self.matcher = Matcher ([])
+        self.next_check = 0
+        self.load ()
+
+    def getFileId (self):
+        try:
+            sr = os.stat (self.path)
+        except FileNotFoundError:
+            return None
+        return (sr.st_ino, sr.st_size, sr.st_mtime_ns)
+
+    def load (self):
+        'Reads the rule file, raises ValueError or OSError if it cannot be used.'
+        file_id = self.getFileId ()
+        with open (self.path, 'r') as f:
+            rules = ParseRules (f, self.path)
+        self.matcher = Matcher (rules)
+        self.file_id = file_id
+        logging.info ("%d revision rules read from %s", len (rules), self.path)
+
+    def checkReload (self):
+        now = time.monotonic ()
+        if now < self.next_check or not self.lock.acquire (blocking=False):
+            return
+
+        try:
+            self.next_check = now + self.check_interval
+            if self.getFileId () != self.file_id:
+                self.load ()
+        except (OSError, ValueError) as e:
+            logging.error ("Keeping the old revision rules, %s cannot be used: %s", self.path, e)
+            self.file_id = self.getFileId ()
+        finally:
+            self.lock.release ()
+
+    def getRule (self, src_path, get_size):
+        self.checkReload ()
+        if not src_path.startswith (self.prefix):
+            return None
+        return self.matcher.match (src_path[len (self.prefix):], get_size)
+
+    def isExcluded (self, src_path):
+        'Whether the file src_path gets no revisions.'
+        def getSize ():
+            try:
+                return os.lstat (src_path).st_size
+            except FileNotFoundError:
+                return 0
+
+        rule = self.getRule (src_path, getSize)
+        return rule != None and rule.exclude
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser (description='Show which files get no revisions with a rule file.')
+    parser.add_argument ('rules_file', metavar='rules',
+                         help='the rule file')
+    parser.add_argument ('root',
+                         help='the source directory the rules apply to')
+    parser.add_argument ('paths', nargs='*',
+                         help='show the rule for these files. Default: list all excluded files below root')
+    args = parser.parse_args ()
+
+    try:
+        rules = Rules (args.rules_file, os.path.abspath (args.root))
+    except (OSError, ValueError) as e:
+        print (e, file=sys.stderr)
+        sys.exit (1)
+
+    if len (args.paths) > 0:
+        for path in args.paths:
+            path = os.path.abspath (path)
+            rule = rules.getRule (path, lambda: os.lstat (path).st_size)
+            if rule == None:
+                print ("{0}: no rule".format (path))
+            else:
+                print ("{0}: {1} {2}".format (path, 'exclude' if rule.exclude else 'include', rule.pattern))
+        sys.exit (0)
+
+    count = 0
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk (os.path.abspath (args.root)):
+        for name in filenames:
+            path = os.path.join (dirpath, name)
+            if not name.startswith ('.rev_') and rules.isExcluded (path):
+                count += 1
+                total += os.lstat (path).st_size
+                print (path)
+    print ("{0} files excluded, {1} bytes".format (count, total))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Counters of a running file system: calls, errors and a latency histogram for
+# each operation and named counters for the work done on revisions. Latencies
+# are counted in buckets of powers of two microseconds, so recording a call
+# is only a few additions.
+
+import time
+import json
+import logging
+import threading
+import collections
+
+histogram_buckets = 32
+
+def GetBucket (ns):
+    'Bucket b counts latencies below 2**b us, bucket 0 those below 1 us.'
+    return min ((ns // 1000).bit_length (), histogram_buckets - 1)
+
+def GetPercentile (buckets, calls, p, max_us):
+    '''
+    Returns the upper bound of the bucket holding percentile p in us, but
+    not more than the longest call took.
+    '''
+    needed = calls * p / 100
+    count = 0
+    for (b, n) in enumerate (buckets):
+        count += n
+        if count >= needed and n > 0:
+            return min (1 << b, max_us)
+    return 0
+
+class Stats:
+    '''
+    Each thread counts in its own tables, so no lock is taken for a call.
+    The tables of all threads are added up when a snapshot is taken, those
+    of finished threads are merged into one, when a new thread starts.
+    '''
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.start = time.time ()
+        self.local = threading.local ()
+        # (thread, ops, counters) of each thread that counted something
+        self.threads = []
+        self.retired = ({}, collections.Counter ())
+        self.log_thread = None
+
+    def register (self):
+        # ops: op -> [calls, errors, total ns, max ns, buckets]
+        ops = {}
+        counters = collections.Counter ()
+        self.local.ops = ops
+        self.local.counters = counters
+        with self.lock:
+            alive = []
+            for entry in self.threads:
+                if entry[0].is_alive ():
+                    alive.append (entry)
+                else:
+                    self.merge (self.retired, entry[1], entry[2])
+            alive.append ((threading.current_thread (), ops, counters))
+            self.threads = alive
+        return (ops, counters)
+
+    @staticmethod
+    def merge (dest, ops, counters):
+        for (op, (calls, errors, total, max_ns, buckets)) in list (ops.items ()):
+            entry = dest[0].get (op)
+            if entry == None:
+                entry = [0, 0, 0, 0, [0] * histogram_buckets]
+                dest[0][op] = entry
+            entry[0] += calls
+            entry[1] += errors
+            entry[2] += total
+            entry[3] = max (entry[3], max_ns)
+            for (b, n) in enumerate (list (buckets)):
+                entry[4][b] += n
+        dest[1].update (dict (counters))
+
+    def addCall (self, op, ns, error = False):
+        try:
+            ops = self.local.ops
+        except AttributeError:
+            ops = self.register ()[0]
+
+        entry = ops.get (op)
+        if entry == None:
+            entry = [0, 0, 0, 0, [0] * histogram_buckets]
+            ops[op] = entry
+        entry[0] += 1
+        if error:
+            entry[1] += 1
+        entry[2] += ns
+        if ns > entry[3]:
+            entry[3] = ns
+        entry[4][GetBucket (ns)] += 1
+
+    def add (self, name, value = 1):
+        try:
+            counters = self.local.counters
+        except AttributeError:
+            counters = self.register ()[1]
+        counters[name] += value
+
+    def snapshot (self):
+        total = ({}, collections.Counter ())
+        with self.lock:
+            self.merge (total, self.retired[0], self.retired[1])
+            for (thread, thread_ops, thread_counters) in self.threads:
+                self.merge (total, thread_ops, thread_counters)
+        (ops, counters) = (total[0], dict (total[1]))
+
+        res = {'uptime': time.time () - self.start, 'operations': {}, 'counters': counters}
+        for (op, (calls, errors, total, max_ns, buckets)) in sorted (ops.items ()):
+            res['operations'][op] = {
+                'calls': calls,
+                'errors': errors,
+                'total_us': total / 1000,
+                'max_us': max_ns / 1000,
+                'p50_us': GetPercentile (buckets, calls, 50, max_ns / 1000),
+                'p99_us': GetPercentile (buckets, calls, 99, max_ns / 1000),
+                # upper bound in us -> calls
+                'histogram_us': dict ((1 << b, n) for (b, n) in enumerate (buckets) if n > 0),
+            }
+        return res
+
+    def toJSON (self):
+        return json.dumps (self.snapshot (), indent=1) + '\n'
+
+    def toText (self):
+        snapshot = self.snapshot ()
+        lines = ['uptime {0:.0f} s'.format (snapshot['uptime']), '',
+                 '{0:<12} {1:>10} {2:>8} {3:>12} {4:>9} {5:>9} {6:>10}'.format ('operation', 'calls', 'errors', 'total ms',
+                                                                                  'p50 us', 'p99 us', 'max us')]
+        for (op, s) in snapshot['operations'].items ():
+            lines.append ('{0:<12} {1:>10} {2:>8} {3:>12.1f} {4:>9.0f} {5:>9.0f} {6:>10.0f}'.format (op, s['calls'], s['errors'], s['total_us'] / 1000,
+                                                                                                s['p50_us'], s['p99_us'], s['max_us']))
+        lines.append ('')
+        for (name, value) in sorted (snapshot['counters'].items ()):
+            lines.append ('{0:<28} {1:>14}'.format (name, value))
+        return '\n'.join (lines) + '\n'
+
+    def startLogging (self, interval):
+        'Writes the counters to the log every interval seconds.'
+        if interval <= 0 or self.log_thread != None:
+            return
+
+        def run ():
+            while True:
+                time.sleep (interval)
+                logging.info ("statistics:\n%s", self.toText ())
+
+        self.log_thread = threading.Thread (target=run, name='RevisionStats', daemon=True)
+        self.log_thread.start ()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Content addressed storage for revisions. Files are split into chunks at
+# content defined positions, so inserting or removing bytes only changes the
+# chunks around the change. Every chunk is stored once under its hash, a
+# revision is a manifest listing the chunks of the file.
+
+import os
+import re
+import dbm
+import sys
+import zlib
+import hashlib
+import logging
+import threading
+
+manifest_magic = 'RFSMAN01'
+
+chunk_min_size = 2 * 1024
+chunk_max_size = 64 * 1024
+read_size = 1024 * 1024
+
+# Boundaries are only considered directly after one of the anchor bytes.
+# The newline makes text files split at line ends, the other bytes are
+# frequent enough in binary data. A candidate becomes a boundary if the crc
+# of the bytes before it has all bits of boundary_mask cleared.
+anchor_pattern = re.compile (b'[\n\x8f\xb3\xe5]')
+boundary_window = 32
+boundary_mask = (1 << 7) - 1
+
+def FindBoundary (buf, start):
+    '''
+    Returns the end of the chunk starting at start or None if buf does not
+    contain a boundary before the maximal chunk size.
+    '''
+    limit = min (start + chunk_max_size, len (buf))
+    pos = start + chunk_min_size
+    while pos < limit:
+        m = anchor_pattern.search (buf, pos, limit)
+        if m == None:
+            break
+
+        pos = m.end ()
+        if zlib.crc32 (buf[pos-boundary_window:pos]) & boundary_mask == 0:
+            return pos
+
+    if limit - start >= chunk_max_size:
+        return limit
+
+    return None
+
+def ChunkFile (f):
+    'Yields the content defined chunks of an open file.'
+    buf = b''
+    eof = False
+    while not eof:
+        data = f.read (read_size)
+        if len (data) == 0:
+            eof = True
+        buf += data
+
+        pos = 0
+        while pos < len (buf):
+            end = FindBoundary (buf, pos)
+            if end == None:
+                if not eof:
+                    break
+                end = len (buf)
+
+            yield buf[pos:end]
+            pos = end
+
+        buf = buf[pos:]
+
+def ChunkHash (data):
+    return hashlib.blake2b (data, digest_size=20).hexdigest ()
+
+def ReadManifest (manifest_path):
+    'Returns the file size and the list of (hash, length) of a manifest.'
+    with open (manifest_path, 'r') as f:
+        if f.readline ().strip () != manifest_magic:
+            raise ValueError ("no revision manifest")
+
+        size = int (f.readline ())
+        chunks = []
+        for line in f:
+            (h, length) = line.split ()
+            chunks.append ((h, int (length)))
+
+    return (size, chunks)
+
+def GetManifestSize (manifest_path):
+    with open (manifest_path, 'r') as f:
+        if f.readline ().strip () != manifest_magic:
+            raise ValueError ("no revision manifest")
+
+        return int (f.readline ())
+
+class ChunkStore:
+    '''
+    Stores chunks as <store>/<first two hex digits>/<hash> and counts the
+    references from manifests in a dbm database. A chunk is deleted when its
+    last reference is dropped. The database is only accessed while holding
+    the lock, dbm modules are not thread safe.
+    '''
+    def __init__ (self, store_dir = None):
+        self.store_dir = store_dir
+        self.refs = None
+        self.lock = threading.RLock ()
+
+    def open (self, store_dir):
+        self.close ()
+        self.store_dir = store_dir
+
+    def close (self):
+        with self.lock:
+            if self.refs != None:
+                self.refs.close ()
+                self.refs = None
+
+    def getRefs (self):
+        if self.refs == None:
+            os.makedirs (self.store_dir, exist_ok=True)
+            self.refs = dbm.open (os.path.join (self.store_dir, 'refs'), 'c')
+        return self.refs
+
+    def getChunkPath (self, h):
+        return os.path.join (self.store_dir, h[:2], h)
+
+    def putChunk (self, data):
+        'Returns the hash of the chunk and whether it had to be written.'
+        h = ChunkHash (data)
+        with self.lock:
+            refs = self.getRefs ()
+            count = refs.get (h)
+            if count != None:
+                refs[h] = str (int (count) + 1)
+                return (h, False)
+
+            chunk_path = self.getChunkPath (h)
+            os.makedirs (os.path.dirname (chunk_path), exist_ok=True)
+            tmp_path = chunk_path + '.tmp'
+            with open (tmp_path, 'wb') as f:
+                f.write (data)
+            os.rename (tmp_path, chunk_path)
+            refs[h] = '1'
+            return (h, True)
+
+    def getChunk (self, h):
+        with open (self.getChunkPath (h), 'rb') as f:
+            return f.read ()
+
+    def releaseChunk (self, h):
+        with self.lock:
+            refs = self.getRefs ()
+            count = refs.get (h)
+            if count == None:
+                logging.error ("chunk %s has no references", h)
+                return 0
+
+            count = int (count) - 1
+            if count > 0:
+                refs[h] = str (count)
+                return 0
+
+            del refs[h]
+            chunk_path = self.getChunkPath (h)
+            size = os.lstat (chunk_path).st_size
+            os.unlink (chunk_path)
+            return size
+
+    def getStoredSize (self):
+        'Returns the number of bytes of all stored chunks.'
+        total = 0
+        try:
+            subdirs = os.scandir (self.store_dir)
+        except FileNotFoundError:
+            return 0
+
+        with subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir (follow_symlinks=False):
+                    continue
+                with os.scandir (subdir.path) as it:
+                    for entry in it:
+                        if not entry.name.endswith ('.tmp'):
+                            total += entry.stat (follow_symlinks=False).st_size
+        return total
+
+    def sync (self):
+        with self.lock:
+            if self.refs != None and hasattr (self.refs, 'sync'):
+                self.refs.sync ()
+
+    def storeFile (self, src_path, manifest_path):
+        '''
+        Writes the manifest of src_path and stores all chunks that are not yet
+        known. Returns the file size and the number of bytes newly stored.
+        '''
+        lines = []
+        size = 0
+        stored = 0
+        with open (src_path, 'rb') as f:
+            for data in ChunkFile (f):
+                (h, new) = self.putChunk (data)
+                lines.append ("{0} {1}\n".format (h, len (data)))
+                size += len (data)
+                if new:
+                    stored += len (data)
+
+        with open (manifest_path, 'w') as f:
+            f.write (manifest_magic + '\n')
+            f.write (str (size) + '\n')
+            f.writelines (lines)
+
+        self.sync ()
+        return (size, stored)
+
+    def restoreFile (self, manifest_path, dest_path):
+        (size, chunks) = ReadManifest (manifest_path)
+        with open (dest_path, 'wb') as f:
+            for (h, length) in chunks:
+                f.write (self.getChunk (h))
+
+    def removeManifest (self, manifest_path):
+        'Deletes a manifest and returns the number of bytes freed in the store.'
+        freed = 0
+        (size, chunks) = ReadManifest (manifest_path)
+        for (h, length) in chunks:
+            freed += self.releaseChunk (h)
+
+        os.unlink (manifest_path)
+        self.sync ()
+        return freed
+
+
+if __name__ == "__main__":
+    if len (sys.argv) < 2:
+        print ("usage: {0} file".format (sys.argv[0]))
+        sys.exit (1)
+
+    count = 0
+    hashes = set ()
+    total = 0
+    unique = 0
+    with open (sys.argv[1], 'rb') as f:
+        for data in ChunkFile (f):
+            count += 1
+            total += len (data)
+            h = ChunkHash (data)
+            if h not in hashes:
+                hashes.add (h)
+                unique += len (data)
+
+    print ("{0} bytes in {1} chunks, {2} unique bytes".format (total, count, unique))
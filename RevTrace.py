@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Binary trace of the file system operations. Each record holds the operation,
+# the paths, handle, offset, size and flags of the request, the result and
+# the time it took, the data of writes only if asked for. A trace is written
+# to a file as it is recorded or kept in a ring buffer of the last records
+# and written when the file system is unmounted.
+#
+# Run this module to print a trace or to replay it against a new RevisionFS
+# over a source directory, at the original or at full speed.
+
+import os
+import sys
+import time
+import errno
+import struct
+import argparse
+import importlib
+import threading
+import collections
+
+trace_magic = b'RFSTRC01'
+header_format = struct.Struct ('<8sQ')
+# op, thread, start, duration, status, fh, offset, size, flags, result,
+# length of path, path2 and payload
+record_format = struct.Struct ('<BxxxIQQiqqqqqHHI')
+
+# how the arguments of each operation are stored:
+# path, path2, fh, offset, size, flags as is, data as size and payload,
+# value as payload, times as offset and size in ns, fi is not stored
+op_args = {
+    'access': ('path', 'flags'),
+    'chmod': ('path', 'flags'),
+    'chown': ('path', 'offset', 'size'),
+    'create': ('path', 'flags', 'fi'),
+    'destroy': ('path',),
+    'flush': ('path', 'fh'),
+    'fsync': ('path', 'size', 'fh'),
+    'fsyncdir': ('path', 'size', 'fh'),
+    'getattr': ('path', 'fh'),
+    'getxattr': ('path', 'path2', 'offset'),
+    'init': ('path',),
+    'link': ('path', 'path2'),
+    'listxattr': ('path',),
+    'mkdir': ('path', 'flags'),
+    'mknod': ('path', 'flags', 'offset'),
+    'open': ('path', 'flags'),
+    'opendir': ('path',),
+    'read': ('path', 'size', 'offset', 'fh'),
+    'readdir': ('path', 'fh', 'offset'),
+    'readlink': ('path',),
+    'release': ('path', 'fh'),
+    'releasedir': ('path', 'fh'),
+    'removexattr': ('path', 'path2'),
+    'rename': ('path', 'path2'),
+    'rmdir': ('path',),
+    'setxattr': ('path', 'path2', 'value', 'flags', 'offset'),
+    'statfs': ('path',),
+    'symlink': ('path', 'path2'),
+    'truncate': ('path', 'size', 'fh'),
+    'unlink': ('path',),
+    'utimens': ('path', 'times'),
+    'write': ('path', 'data', 'offset', 'fh'),
+}
+op_names = sorted (op_args)
+op_codes = dict ((name, code) for (code, name) in enumerate (op_names))
+
+# operations that return a new handle
+handle_ops = ['create', 'open', 'opendir']
+
+def EncodePath (path):
+    return path.encode ('utf-8', 'surrogateescape')
+
+def DecodePath (data):
+    return data.decode ('utf-8', 'surrogateescape')
+
+class Record:
+    __slots__ = ('op', 'tid', 'start', 'duration', 'status', 'fh', 'offset', 'size', 'flags', 'result',
+                 'path', 'path2', 'payload')
+
+    def __init__ (self, op):
+        self.op = op
+        self.tid = 0
+        self.start = 0
+        self.duration = 0
+        self.status = 0
+        self.fh = -1
+        self.offset = 0
+        self.size = 0
+        self.flags = 0
+        self.result = 0
+        self.path = ''
+        self.path2 = ''
+        self.payload = b''
+
+    def setArgs (self, args, payloads):
+        for (kind, value) in zip (op_args[self.op], args):
+            if kind == 'path':
+                self.path = value
+            elif kind == 'path2':
+                self.path2 = value
+            elif kind == 'fh':
+                self.fh = -1 if value == None else value
+            elif kind == 'data':
+                self.size = len (value)
+                if payloads:
+                    self.payload = bytes (value)
+            elif kind == 'value':
+                self.payload = bytes (value)
+            elif kind == 'times':
+                if value == None:
+                    (self.offset, self.size) = (-1, -1)
+                else:
+                    (self.offset, self.size) = (int (value[0] * 1e9), int (value[1] * 1e9))
+            elif kind != 'fi':
+                setattr (self, kind, int (value))
+
+    def getArgs (self, handles):
+        'Returns the arguments for a replay, handles maps traced to new handles.'
+        args = []
+        for kind in op_args[self.op]:
+            if kind == 'path':
+                args.append (self.path)
+            elif kind == 'path2':
+                args.append (self.path2)
+            elif kind == 'fh':
+                args.append (None if self.fh < 0 else handles.get (self.fh, self.fh))
+            elif kind == 'data':
+                args.append (self.payload if len (self.payload) == self.size else bytes (self.size))
+            elif kind == 'value':
+                args.append (self.payload)
+            elif kind == 'times':
+                args.append (None if self.offset < 0 else (self.offset / 1e9, self.size / 1e9))
+            elif kind == 'fi':
+                args.append (None)
+            else:
+                args.append (getattr (self, kind))
+        return args
+
+    def pack (self):
+        path = EncodePath (self.path)
+        path2 = EncodePath (self.path2)
+        return record_format.pack (op_codes[self.op], self.tid, self.start, self.duration, self.status,
+                                   self.fh, self.offset, self.size, self.flags, self.result,
+                                   len (path), len (path2), len (self.payload)) + path + path2 + self.payload
+
+def ReadTrace (path):
+    'Yields the records of a trace file.'
+    with open (path, 'rb') as f:
+        (magic, wall_start) = header_format.unpack (f.read (header_format.size))
+        if magic != trace_magic:
+            raise ValueError ("{0} is no trace".format (path))
+
+        while True:
+            data = f.read (record_format.size)
+            if len (data) < record_format.size:
+                return
+
+            fields = record_format.unpack (data)
+            rec = Record (op_names[fields[0]])
+            (rec.tid, rec.start, rec.duration, rec.status, rec.fh, rec.offset, rec.size, rec.flags, rec.result) = fields[1:10]
+            rec.path = DecodePath (f.read (fields[10]))
+            rec.path2 = DecodePath (f.read (fields[11]))
+            rec.payload = f.read (fields[12])
+            yield rec
+
+class Tracer:
+    '''
+    Records the calls going through call (). With ring_size the last
+    ring_size records are kept in memory and only written by close (),
+    otherwise they are written to the buffered file at once.
+    '''
+    def __init__ (self, path, ring_size = 0, payloads = False):
+        self.path = path
+        self.payloads = payloads
+        self.lock = threading.Lock ()
+        self.base = time.perf_counter_ns ()
+        self.header = header_format.pack (trace_magic, time.time_ns ())
+        self.ring = None
+        self.file = None
+        if ring_size > 0:
+            self.ring = collections.deque (maxlen=ring_size)
+        else:
+            self.file = open (path, 'wb', buffering=1024 * 1024)
+            self.file.write (self.header)
+
+    def call (self, func, op, args):
+        'Calls func (op, *args) and records it.'
+        rec = Record (op)
+        start = time.perf_counter_ns ()
+        try:
+            res = func (op, *args)
+        except OSError as e:
+            rec.status = e.errno or errno.EIO
+            self.record (rec, args, start)
+            raise
+
+        if op == 'readdir':
+            # the entries are read later, the record is written when done
+            return self.traceEntries (rec, args, start, res)
+
+        if op in handle_ops or op in ('read', 'write'):
+            rec.result = res if isinstance (res, int) else len (res)
+        self.record (rec, args, start)
+        return res
+
+    def traceEntries (self, rec, args, start, entries):
+        try:
+            for entry in entries:
+                rec.result += 1
+                yield entry
+        finally:
+            self.record (rec, args, start)
+
+    def record (self, rec, args, start):
+        if op_args.get (rec.op) == None:
+            return
+
+        end = time.perf_counter_ns ()
+        rec.tid = threading.get_native_id () & 0xffffffff
+        rec.start = start - self.base
+        rec.duration = end - start
+        rec.setArgs (args, self.payloads)
+        data = rec.pack ()
+        if self.ring != None:
+            self.ring.append (data)
+            return
+
+        with self.lock:
+            if self.file != None:
+                self.file.write (data)
+
+    def close (self):
+        with self.lock:
+            if self.ring != None:
+                with open (self.path, 'wb') as f:
+                    f.write (self.header)
+                    f.writelines (list (self.ring))
+                self.ring = None
+
+            if self.file != None:
+                self.file.close ()
+                self.file = None
+
+def PrepareSource (records, src_dir):
+    '''
+    Creates the files and directories the trace uses but never creates
+    itself, files with the size the reads of the trace need.
+    '''
+    known = set (['/'])
+    dirs = set ()
+    files = {}
+    for rec in records:
+        if rec.op in ('create', 'mkdir', 'mknod', 'symlink'):
+            known.add (rec.path)
+        elif rec.op in ('link', 'rename'):
+            known.add (rec.path2)
+        elif rec.status == 0 and rec.path not in known:
+            if rec.op in ('opendir', 'readdir', 'releasedir', 'fsyncdir', 'rmdir'):
+                dirs.add (rec.path)
+            else:
+                files.setdefault (rec.path, 0)
+                if rec.op == 'read':
+                    files[rec.path] = max (files[rec.path], rec.offset + rec.result)
+
+    for path in dirs:
+        os.makedirs (src_dir + path, exist_ok=True)
+    for (path, size) in files.items ():
+        if path in dirs:
+            continue
+        os.makedirs (os.path.dirname (src_dir + path), exist_ok=True)
+        if not os.path.exists (src_dir + path):
+            with open (src_dir + path, 'wb') as f:
+                f.truncate (size)
+
+def Replay (records, src_dir, original_speed = False):
+    '''
+    Replays the records in the order they started against a new RevisionFS
+    over src_dir and returns (elapsed seconds, number of calls whose status
+    differs from the trace, {op: ([replay latencies], [traced latencies])}).
+    '''
+    sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+    RevisionFS = importlib.import_module ('Revision-FS')
+
+    records = sorted ([rec for rec in records if rec.op not in ('init', 'destroy')], key=lambda rec: rec.start)
+    PrepareSource (records, src_dir)
+    fs = RevisionFS.RevisionFS (src_dir)
+    fs ('init', '/')
+
+    handles = {}
+    latencies = {}
+    mismatches = 0
+    start = time.perf_counter_ns ()
+    first = records[0].start if len (records) > 0 else 0
+    for rec in records:
+        if original_speed:
+            delay = (rec.start - first) - (time.perf_counter_ns () - start)
+            if delay > 0:
+                time.sleep (delay / 1e9)
+
+        args = rec.getArgs (handles)
+        status = 0
+        t = time.perf_counter_ns ()
+        try:
+            res = fs (rec.op, *args)
+            if rec.op == 'readdir':
+                res = list (res)
+            if rec.op in handle_ops:
+                handles[rec.result] = res
+        except OSError as e:
+            status = e.errno
+        duration = time.perf_counter_ns () - t
+
+        if status != rec.status:
+            mismatches += 1
+        entry = latencies.setdefault (rec.op, ([], []))
+        entry[0].append (duration)
+        entry[1].append (rec.duration)
+
+    elapsed = (time.perf_counter_ns () - start) / 1e9
+    fs ('destroy', '/')
+    return (elapsed, mismatches, latencies)
+
+def Percentile (values, p):
+    values = sorted (values)
+    return values[min (len (values) - 1, int (len (values) * p / 100))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser (description='Print or replay a trace recorded by Revision-FS.py --trace.')
+    parser.add_argument ('trace', help='the trace file')
+    parser.add_argument ('source_dir', nargs='?',
+                         help='replay the trace against a RevisionFS over this directory, which should be empty')
+    parser.add_argument ('--original-speed', dest='original_speed', action='store_true',
+                         help='keep the time between the calls of the trace instead of replaying at full speed')
+
+    args = parser.parse_args ()
+
+    if args.source_dir == None:
+        for rec in ReadTrace (args.trace):
+            print ("{0:12.6f} {1:>8} {2:<11} {3} {4} fh={5} offset={6} size={7} flags={8:#o} result={9} status={10} {11:.1f} us" \
+                   .format (rec.start / 1e9, rec.tid, rec.op, rec.path, rec.path2, rec.fh, rec.offset, rec.size,
+                            rec.flags, rec.result, rec.status, rec.duration / 1e3))
+        sys.exit (0)
+
+    (elapsed, mismatches, latencies) = Replay (list (ReadTrace (args.trace)), args.source_dir, args.original_speed)
+    calls = sum ([len (replayed) for (replayed, traced) in latencies.values ()])
+    print ("{0} calls in {1:.2f} s, {2:.0f} calls/s, {3} with a different result".format (calls, elapsed, calls / max (elapsed, 1e-9), mismatches))
+    for (op, (replayed, traced)) in sorted (latencies.items ()):
+        print ("  {0:<11} {1:>8} calls  p50 {2:9.1f} us (traced {3:9.1f})  p99 {4:9.1f} us (traced {5:9.1f})" \
+               .format (op, len (replayed), Percentile (replayed, 50) / 1e3, Percentile (traced, 50) / 1e3,
+                        Percentile (replayed, 99) / 1e3, Percentile (traced, 99) / 1e3))
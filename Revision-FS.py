@@ -13,20 +13,85 @@ import logging
 import argparse
 import datetime
 import re
+import collections
+import time
+import heapq
+import threading
+import contextlib
+import itertools
+import json
 #from numpy import s_
 import RevFS
+import RevCopy
+import RevDelta
+import RevStore
+import RevCompress
+import RevCatalog
+import RevTrace
+import RevStats
+import RevRules
+import tempfile
 
 revision_prefix = '.rev_'
 revision_escape_prefix = revision_prefix + 'e_'
 revision_info_prefix = revision_prefix + 'i_'
+revision_tmp_prefix = revision_prefix + 'tmp_'
+revision_store_name = revision_prefix + 'chunks'
+revision_policy_name = revision_prefix + 'policy'
+stats_file_name = '/.revfs_stats'
+stats_json_name = '/.revfs_stats.json'
+stats_names = frozenset ([stats_file_name, stats_json_name])
+revision_kind_full = 'r'
+revision_kind_delta = 'd'
+revision_kind_manifest = 'm'
+revision_kind_compressed = 'z'
+revision_kinds = revision_kind_full + revision_kind_delta + revision_kind_manifest + revision_kind_compressed
+storage_full = 'full'
+storage_delta = 'delta'
+storage_dedup = 'dedup'
+storage_modes = [storage_full, storage_delta, storage_dedup]
 max_revisions = 10
 max_revision_age = 185
 min_revisions_age = 1
+revision_storage = storage_full
+revision_coalesce = 0
+compress_rank = 0
+compress_age = 0
+purge_rate = 10
+purge_scan_pause = 0.05
+purge_idle_interval = 60 * 60
+budget_rescan_interval = 60 * 60
+# pause after an eviction that could not get below the budget
+budget_evict_pause = 60
+# eviction stops when the revisions use this part of the budget
+budget_low_water = 0.95
+stats_interval = 0
+revision_index_size = 1024
+handle_stripes = 16
+attr_timeout = 1.0
+negative_timeout = 1.0
+attr_cache_size = 64 * 1024
+policy_cache_size = 4096
+recent_revisions_size = 64 * 1024
+policy_keywords = ['revisions', 'max_age', 'min_revisions', 'storage', 'coalesce']
+# open flags of FUSE requests that are passed on to the source file
+open_flags_passed = os.O_ACCMODE | os.O_CREAT | os.O_EXCL | os.O_TRUNC | os.O_APPEND | os.O_NOFOLLOW | os.O_SYNC | os.O_DSYNC
 
 xattr_max_revisions_name = RevFS.xattr_max_revisions_name
 xattr_revisions_name     = RevFS.xattr_revisions_name
+xattr_revisions_stored_name = RevFS.xattr_revisions_stored_name
 xattr_max_revision_age   = RevFS.xattr_max_revision_age
 xattr_min_revisions_age  = RevFS.xattr_min_revisions_age
+xattr_storage_name       = RevFS.xattr_storage_name
+xattr_coalesce_name      = RevFS.xattr_coalesce_name
+xattr_restore_name       = RevFS.xattr_restore_name
+xattr_info_name          = RevFS.xattr_info_name
+xattr_space_name         = RevFS.xattr_space_name
+
+# the policy settings removexattr drops again
+policy_xattr_keywords = {xattr_max_revisions_name: 'revisions', xattr_max_revision_age: 'max_age',
+                         xattr_min_revisions_age: 'min_revisions', xattr_storage_name: 'storage',
+                         xattr_coalesce_name: 'coalesce'}
 
 log_file = None
 if "HOME" in os.environ:
@@ -37,11 +102,24 @@ else:
 log_file = os.path.join (log_file, ".revision_fs.log")
 
 class FileInfo:
+    __slots__ = ('copy_on_write', 'revisions', 'max_age', 'min_revisions', 'storage', 'coalesce', 'delta', 'handles')
+
     def __init__ (self):
         self.copy_on_write = True
+        self.setDefaults ()
+        # RevDelta.DeltaWriter or RevCopy.BackgroundCopy of the newest
+        # revision, it is told about every change before it is made
+        self.delta = None
+        # number of open handles of the file
+        self.handles = 0
+
+    def setDefaults (self):
         self.revisions = max_revisions
         self.max_age = max_revision_age
         self.min_revisions = min_revisions_age
+        self.storage = revision_storage
+        # seconds after a revision in which changes do not create another one
+        self.coalesce = revision_coalesce
         
     def setMaxRevisions (self, revisions):
         self.revisions = revisions
@@ -56,95 +134,993 @@ class FileInfo:
     def setMaxRevisionAge (self, max_age):
         self.max_age = max_age
         
-    def loadFileInfo (self, src_path):
-        (head, tail) = os.path.split (src_path)
-        
-        info_file_name = os.path.join (head, revision_info_prefix + tail)
-        if not os.path.exists (info_file_name):
+    def setStorage (self, storage):
+        self.storage = storage
+
+    def setCoalesce (self, coalesce):
+        self.coalesce = coalesce
+
+    def closeDelta (self):
+        if self.delta != None:
+            delta = self.delta
+            delta.close ()
+            self.delta = None
+            if isinstance (delta, RevDelta.DeltaWriter):
+                # the stored size of the revision is only known now
+                (src_dir, name) = os.path.split (delta.delta_path)
+                (rev_id, kind, base) = ParseRevisionName (name)
+                src_path = os.path.join (src_dir, base)
+                revisions = revision_index.getRevisions (src_path)
+                if rev_id in revisions:
+                    (mtime, size, kind, stored) = revisions[rev_id]
+                    revision_index.addRevision (src_path, rev_id, mtime, size, kind, delta.size)
+
+    def loadFileInfo (self, src_path, is_dir = False):
+        '''
+        Applies the policy of src_path, see PolicyCache. With is_dir the
+        policy the entries of the directory src_path inherit is used.
+        '''
+        self.setDefaults ()
+        for (keyword, value) in policy_cache.getPolicy (src_path, is_dir).items ():
+            setattr (self, keyword, value)
+
+        if self.min_revisions >= self.revisions:
+            self.revisions = self.min_revisions
+
+    def saveFileInfo (self, src_path, is_dir = False):
+        '''
+        Writes the policy of the file src_path to its sidecar or, with
+        is_dir, the policy of the whole directory tree src_path. Only the
+        settings that differ from the current policy are added, all others
+        are still inherited.
+        '''
+        info_file_name = GetPolicyFileName (src_path, is_dir)
+        current = FileInfo ()
+        current.loadFileInfo (src_path, is_dir)
+        changed = [keyword for keyword in policy_keywords if getattr (self, keyword) != getattr (current, keyword)]
+        if len (changed) == 0:
+            # already inherited, no file is written
             return
-        
-        f = open (info_file_name, 'r')
+
+        policy = {}
+        if os.path.exists (info_file_name):
+            policy = ReadPolicyFile (info_file_name)
+        for keyword in changed:
+            policy[keyword] = getattr (self, keyword)
+
+        StorePolicy (src_path, is_dir, policy)
+
+    def removeSetting (self, src_path, keyword, is_dir = False):
+        '''
+        Drops keyword from the sidecar of src_path or, with is_dir, from the
+        policy of the directory src_path, so it is inherited again, and
+        applies the policy that results.
+        '''
+        info_file_name = GetPolicyFileName (src_path, is_dir)
+        if os.path.exists (info_file_name):
+            policy = ReadPolicyFile (info_file_name)
+            if keyword in policy:
+                del policy[keyword]
+                StorePolicy (src_path, is_dir, policy)
+
+        self.loadFileInfo (src_path, is_dir)
+
+def GetPolicyFileName (src_path, is_dir = False):
+    if is_dir:
+        return os.path.join (src_path, revision_policy_name)
+
+    (head, tail) = os.path.split (src_path)
+    return os.path.join (head, revision_info_prefix + tail)
+
+def StorePolicy (src_path, is_dir, policy):
+    'Writes the own settings of src_path, a policy file without any is deleted.'
+    info_file_name = GetPolicyFileName (src_path, is_dir)
+    if len (policy) > 0:
+        WritePolicyFile (info_file_name, policy)
+    elif os.path.exists (info_file_name):
+        os.unlink (info_file_name)
+
+    if catalog != None:
+        catalog.setPolicy (src_path, policy, is_dir)
+    if is_dir:
+        policy_cache.invalidateTree (src_path)
+    else:
+        policy_cache.setOverride (src_path, policy)
+    
+def ReadPolicyFile (path):
+    'Returns the settings found in a policy file as dictionary.'
+    policy = {}
+    with open (path, 'r') as f:
         for line in f:
-            (keyword, value) = line.strip ().split ('=', maxsplit=1)
+            try:
+                (keyword, value) = line.strip ().split ('=', maxsplit=1)
+            except ValueError:
+                continue
+
             keyword = keyword.strip ()
             value = value.strip ()
             
-            if keyword == 'revisions':
-                try:
-                    revisions = int (value)
-                    self.revisions = revisions
-                except ValueError:
-                    pass
-                
-            elif keyword == 'max_age':
-                try:
-                    max_age = int (value)
-                    self.max_age = max_age
-                except ValueError:
-                    pass
-                
-            elif keyword == 'min_revisions':
+            if keyword == 'storage':
+                if value in storage_modes:
+                    policy[keyword] = value
+
+            elif keyword in policy_keywords:
                 try:
-                    min_revisions = int (value)
-                    self.min_revisions = min_revisions
+                    policy[keyword] = int (value)
                 except ValueError:
                     pass
-                
-        if self.min_revisions >= self.revisions:
-            self.revisions = self.min_revisions
 
-        f.close ()
-    
-    def saveFileInfo (self, src_path):
-        (head, tail) = os.path.split (src_path)
-        
-        info_file_name = os.path.join (head, revision_info_prefix + tail)
-        f = open (info_file_name, 'w')
-        #logging.debug ("saveFileInfo: revisions: %s", repr (self.revisions))
-        f.write ("{0}={1}\n".format ('revisions', self.revisions))
-        f.write ("{0}={1}\n".format ('max_age', self.max_age))
-        f.write ("{0}={1}\n".format ('min_revisions', self.min_revisions))
+    return policy
+
+def WritePolicyFile (path, policy):
+    with open (path, 'w') as f:
+        #logging.debug ("WritePolicyFile: %s", repr (policy))
+        for keyword in policy_keywords:
+            if keyword in policy:
+                f.write ("{0}={1}\n".format (keyword, policy[keyword]))
+
+def ParseRevisionName (name):
+    '''
+    Splits a revision file name into (id, kind, base).
+
+    Revisions are stored as .rev_<kind><id>_<base>, where id grows with every
+    new revision of base and kind tells how the revision is stored.
+    Revisions written by older versions are named .rev_<n>_<base> with n = 1
+    being the newest one. They get the id -n, so they sort below all new ones.
+    Returns None for all other names, including escaped and info files.
+    '''
+    if not name.startswith (revision_prefix):
+        return None
+
+    i = name.find ('_', len (revision_prefix))
+    if i < 0:
+        return None
+
+    token = name[len (revision_prefix):i]
+    if token.isdigit ():
+        num = int (token)
+        if num < 1:
+            return None
+        return (-num, revision_kind_full, name[i+1:])
+
+    kind = token[:1]
+    snum = token[1:]
+    if kind not in revision_kinds or not snum.isdigit ():
+        return None
+
+    rev_id = int (snum)
+    if rev_id < 1:
+        return None
+
+    return (rev_id, kind, name[i+1:])
+
+def RevisionFileName (rev_id, kind, name):
+    if rev_id < 0:
+        return revision_prefix + str (-rev_id) + '_' + name
+
+    return revision_prefix + kind + str (rev_id) + '_' + name
+
+def GetRevisionSize (rev_path, kind, sr):
+    'Returns the size of the file content stored in a revision.'
+    try:
+        if kind == revision_kind_delta:
+            return RevDelta.GetOriginalLength (rev_path)
+
+        if kind == revision_kind_manifest:
+            return RevStore.GetManifestSize (rev_path)
+
+        if kind == revision_kind_compressed:
+            return RevCompress.GetLogicalSize (rev_path)
+    except ValueError:
+        logging.error ("%s is no valid revision", rev_path)
+
+    return sr.st_size
+
+class RevisionIndex:
+    '''
+    Maps each source directory to the revisions stored in it:
+    base name -> {revision id: (mtime, size, kind, stored size)}
+
+    A directory is scanned once when it is first needed and is then kept up to
+    date by the operations that create, rename or delete revisions. At most
+    max_dirs directories are kept, the least recently used one is dropped first.
+    Directories are scanned without holding the lock, so lookups in other
+    directories do not wait for them. With a catalog, directories are loaded
+    from it instead of being listed and all changes are written through to
+    it. With a space budget, every directory that is loaded and every change
+    is counted there.
+    '''
+    def __init__ (self, max_dirs = revision_index_size):
+        self.max_dirs = max_dirs
+        self.dirs = collections.OrderedDict ()
+        # src_dir -> [changes, threads] of the directories read right now
+        self.loading = {}
+        self.lock = threading.RLock ()
+
+    def scanDir (self, src_dir):
+        stats.add ('revision_dir_scans')
+        entries = {}
+        for name in os.listdir (src_dir):
+            res = ParseRevisionName (name)
+            if res == None:
+                continue
 
-        f.close ()
-    
+            (rev_id, kind, base) = res
+            try:
+                sr = os.lstat (os.path.join (src_dir, name))
+                size = GetRevisionSize (os.path.join (src_dir, name), kind, sr)
+            except FileNotFoundError:
+                continue
+
+            entries.setdefault (base, {})[rev_id] = (sr.st_mtime, size, kind, sr.st_size)
+
+        return entries
+
+    def readDir (self, src_dir):
+        'Returns the revisions of src_dir and whether they came from the catalog.'
+        if catalog != None:
+            entries = catalog.getDir (src_dir)
+            if entries != None:
+                return (entries, True)
+        return (self.scanDir (src_dir), False)
+
+    def getDir (self, src_dir, keep = True):
+        '''
+        Returns the revisions of src_dir. A directory that is not kept yet is
+        read without holding the lock, only if revisions in it changed in the
+        meantime it is read again while holding it. With keep the directory
+        is kept afterwards.
+        '''
+        with self.lock:
+            entries = self.dirs.get (src_dir)
+            if entries != None:
+                self.dirs.move_to_end (src_dir)
+                return entries
+
+            loading = self.loading.setdefault (src_dir, [0, 0])
+            loading[1] += 1
+            changes = loading[0]
+
+        try:
+            (entries, cataloged) = self.readDir (src_dir)
+            with self.lock:
+                kept = self.dirs.get (src_dir)
+                if kept != None:
+                    # loaded by another thread
+                    self.dirs.move_to_end (src_dir)
+                    return kept
+
+                if loading[0] != changes:
+                    (entries, cataloged) = self.readDir (src_dir)
+                if catalog != None and not cataloged:
+                    catalog.putDir (src_dir, entries)
+                if space_budget != None:
+                    space_budget.setDir (src_dir, entries)
+
+                if keep:
+                    self.dirs[src_dir] = entries
+                    while len (self.dirs) > self.max_dirs:
+                        self.dirs.popitem (last=False)
+                return entries
+        finally:
+            with self.lock:
+                loading[1] -= 1
+                if loading[1] == 0:
+                    del self.loading[src_dir]
+
+    def noteChange (self, src_dir):
+        'Called with the lock held before revisions of src_dir change.'
+        loading = self.loading.get (src_dir)
+        if loading != None:
+            loading[0] += 1
+
+    def noteTreeChange (self, prefixes):
+        for (src_dir, loading) in self.loading.items ():
+            if os.path.join (src_dir, '').startswith (prefixes):
+                loading[0] += 1
+
+    def countDir (self, src_dir):
+        'Counts the revisions of src_dir for the space budget, without keeping the directory.'
+        with self.lock:
+            entries = self.dirs.get (src_dir)
+            if entries != None:
+                space_budget.setDir (src_dir, entries)
+                return
+        self.getDir (src_dir, keep=False)
+
+    def getRevisions (self, src_path):
+        'Returns a copy, so callers can iterate while other threads add revisions.'
+        (src_dir, src_name) = os.path.split (src_path)
+        entries = self.getDir (src_dir)
+        with self.lock:
+            # the kept entries are up to date, also if they were dropped and loaded again
+            return dict (self.dirs.get (src_dir, entries).get (src_name, {}))
+
+    def addRevision (self, src_path, rev_id, mtime, size, kind = None, stored = None):
+        if kind == None:
+            kind = revision_kind_full
+        if stored == None:
+            stored = size
+
+        (src_dir, src_name) = os.path.split (src_path)
+        if space_budget != None:
+            # counted before the change
+            self.getDir (src_dir)
+        with self.lock:
+            self.noteChange (src_dir)
+            entries = self.dirs.get (src_dir)
+            if entries == None and space_budget != None:
+                # dropped again since, rarely
+                entries = self.getDir (src_dir)
+            if entries != None:
+                revisions = entries.setdefault (src_name, {})
+                if space_budget != None:
+                    space_budget.add (src_dir, stored - revisions.get (rev_id, (0, 0, None, 0))[3])
+                revisions[rev_id] = (mtime, size, kind, stored)
+            if catalog != None:
+                catalog.addRevision (src_path, rev_id, mtime, size, kind, stored)
+
+    def moveRevision (self, src_path, old_id, new_id):
+        (src_dir, src_name) = os.path.split (src_path)
+        with self.lock:
+            self.noteChange (src_dir)
+            revisions = self.dirs.get (src_dir, {}).get (src_name)
+            if revisions != None and old_id in revisions:
+                revisions[new_id] = revisions.pop (old_id)
+            if catalog != None:
+                catalog.moveRevision (src_path, old_id, new_id)
+
+    def removeRevision (self, src_path, rev_id):
+        (src_dir, src_name) = os.path.split (src_path)
+        if space_budget != None:
+            # counted before the change
+            self.getDir (src_dir)
+        with self.lock:
+            self.noteChange (src_dir)
+            entries = self.dirs.get (src_dir)
+            if entries == None and space_budget != None:
+                # dropped again since, rarely
+                entries = self.getDir (src_dir)
+            if catalog != None:
+                catalog.removeRevision (src_path, rev_id)
+
+            if entries == None or src_name not in entries:
+                return
+
+            removed = entries[src_name].pop (rev_id, None)
+            if removed != None and space_budget != None:
+                space_budget.add (src_dir, -removed[3])
+            if len (entries[src_name]) == 0:
+                del entries[src_name]
+
+    def invalidateTree (self, src_path):
+        '''
+        Drops src_path and every directory below it, used when a directory is
+        renamed or moved into a revision.
+        '''
+        prefix = os.path.join (src_path, '')
+        with self.lock:
+            self.noteTreeChange ((prefix,))
+            for src_dir in [d for d in self.dirs if d == src_path or d.startswith (prefix)]:
+                del self.dirs[src_dir]
+            if catalog != None:
+                catalog.invalidateTree (src_path)
+            if space_budget != None:
+                space_budget.dropTree (src_path)
+
+    def moveTree (self, old_path, new_path):
+        'Called after old_path was renamed to new_path.'
+        prefixes = (os.path.join (old_path, ''), os.path.join (new_path, ''))
+        with self.lock:
+            self.noteTreeChange (prefixes)
+            for src_dir in [d for d in self.dirs if d in (old_path, new_path) or d.startswith (prefixes)]:
+                del self.dirs[src_dir]
+            if catalog != None:
+                catalog.moveTree (old_path, new_path)
+            if space_budget != None:
+                space_budget.moveTree (old_path, new_path)
+
+class PathLocks:
+    '''
+    Hands out one lock per source path. Everything that creates, converts or
+    deletes revisions of a file or changes its policy holds the lock of the
+    file, operations on different files run in parallel. Locks are dropped
+    again when no thread uses them.
+    '''
+    def __init__ (self):
+        self.lock = threading.Lock ()
+        self.locks = {}
+
+    def acquire (self, src_path):
+        with self.lock:
+            entry = self.locks.get (src_path)
+            if entry == None:
+                entry = [threading.RLock (), 0]
+                self.locks[src_path] = entry
+            entry[1] += 1
+
+        entry[0].acquire ()
+
+    def release (self, src_path):
+        with self.lock:
+            entry = self.locks[src_path]
+            entry[0].release ()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[src_path]
+
+    @contextlib.contextmanager
+    def locked (self, *src_paths):
+        'Locks several paths in sorted order, so two renames cannot deadlock.'
+        src_paths = sorted (set (src_paths))
+        for src_path in src_paths:
+            self.acquire (src_path)
+        try:
+            yield
+        finally:
+            for src_path in reversed (src_paths):
+                self.release (src_path)
+
+def StatToAttrs (r):
+    'Converts an os.stat_result to the dictionary returned by getattr.'
+    res = dict (st_mode=r.st_mode, st_nlink=r.st_nlink, st_ino=r.st_ino, st_dev=r.st_dev, st_uid=r.st_uid, st_gid=r.st_gid,
+                st_size=r.st_size, st_atime=r.st_atime, st_mtime=r.st_mtime, st_ctime=r.st_ctime)
+    try:
+        res["st_blocks"] = r.st_blocks
+    except:
+        res["st_blocks"] = (r.st_size + 511) / 512
+
+    try:
+        res["st_blksize"] = r.st_blksize
+    except:
+        res["st_blksize"] = 512
+
+    return res
+
+class AttrCache:
+    '''
+    Caches the attributes returned by getattr per source path for ttl
+    seconds, paths without file and without revisions are remembered as
+    missing for negative_ttl seconds. A ttl of 0 disables that part.
+    Attributes of existing files are kept as os.stat_result, which is much
+    smaller than the dictionary given to fusepy.
+
+    Operations of the file system drop the entries they change. Changes made
+    directly in the source directory are seen once the entry expired, like
+    the kernel does with attr_timeout and negative_timeout.
+    '''
+    missing = 'missing'
+
+    def __init__ (self, ttl = attr_timeout, negative_ttl = negative_timeout, max_entries = attr_cache_size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict ()
+        self.lock = threading.Lock ()
+        # counts invalidations, results read before one are not stored
+        self.generation = 0
+
+    def get (self, src_path):
+        'Returns the attributes, AttrCache.missing or None if nothing is cached.'
+        entry = self.entries.get (src_path)
+        if entry == None:
+            return None
+
+        if entry[0] < time.monotonic ():
+            with self.lock:
+                if self.entries.get (src_path) is entry:
+                    del self.entries[src_path]
+            return None
+
+        return entry[1]
+
+    def put (self, src_path, attrs, generation):
+        ttl = self.ttl
+        if attrs is AttrCache.missing:
+            ttl = self.negative_ttl
+        if ttl <= 0:
+            return
+
+        # no lock, a single dict operation is atomic. If an invalidation ran
+        # since the attributes were read, it either came before this store
+        # and changed the generation or it drops the entry itself.
+        self.entries[src_path] = (time.monotonic () + ttl, attrs)
+        if generation != self.generation:
+            self.entries.pop (src_path, None)
+
+        if len (self.entries) > self.max_entries:
+            with self.lock:
+                while len (self.entries) > self.max_entries:
+                    self.entries.popitem (last=False)
+
+    def invalidate (self, *src_paths):
+        with self.lock:
+            self.generation += 1
+            for src_path in src_paths:
+                self.entries.pop (src_path, None)
+
+    def invalidateName (self, *src_paths):
+        'Drops src_paths and the directories containing them.'
+        self.invalidate (*(src_paths + tuple (os.path.dirname (p) for p in src_paths)))
+
+    def invalidateTree (self, src_path):
+        prefix = os.path.join (src_path, '')
+        with self.lock:
+            self.generation += 1
+            for p in [p for p in list (self.entries) if p.startswith (prefix)]:
+                self.entries.pop (p, None)
+
+class PolicyCache:
+    '''
+    Resolves the revision policies. A directory can hold a policy file
+    .rev_policy, which applies to everything below it unless a deeper
+    directory has its own. A file can still have its own sidecar
+    .rev_i_<name> next to it, which overrides single settings.
+
+    For each directory the inherited policy and the sidecars in it are read
+    once and cached, the least recently used directory is dropped first.
+    Opening a file in a known directory does not touch any policy file.
+    Policies are only inherited below root, the mounted source directory.
+    With a catalog, the policy files of a directory are only read once and
+    taken from the catalog afterwards.
+    '''
+    def __init__ (self, max_dirs = policy_cache_size):
+        self.root = None
+        self.max_dirs = max_dirs
+        self.dirs = collections.OrderedDict ()
+        self.lock = threading.Lock ()
+        self.generation = 0
+
+    def setRoot (self, root):
+        with self.lock:
+            self.root = root
+            self.generation += 1
+            self.dirs.clear ()
+
+    def scanDir (self, src_dir):
+        'Reads the policy files in src_dir, returns None if it does not exist.'
+        policy = {}
+        overrides = {}
+        try:
+            with os.scandir (src_dir) as it:
+                for entry in it:
+                    if not entry.name.startswith (revision_prefix):
+                        continue
+
+                    try:
+                        if entry.name == revision_policy_name:
+                            policy.update (ReadPolicyFile (entry.path))
+                        elif entry.name.startswith (revision_info_prefix):
+                            overrides[entry.name[len (revision_info_prefix):]] = ReadPolicyFile (entry.path)
+                    except OSError as e:
+                        logging.error ("Cannot read policy %s: %s", entry.path, e)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        return (policy, overrides)
+
+    def loadDir (self, src_dir):
+        policy = {}
+        if self.root != None and src_dir.startswith (os.path.join (self.root, '')):
+            policy = dict (self.getDir (os.path.dirname (src_dir))[0])
+
+        own = None
+        if catalog != None:
+            own = catalog.getPolicies (src_dir)
+        if own == None:
+            own = self.scanDir (src_dir)
+            if own == None:
+                return (policy, {})
+            if catalog != None:
+                catalog.putPolicies (src_dir, own[0], own[1])
+
+        policy.update (own[0])
+        return (policy, own[1])
+
+    def getDir (self, src_dir):
+        'Returns the policy inherited by the entries of src_dir and their sidecars.'
+        with self.lock:
+            entry = self.dirs.get (src_dir)
+            if entry != None:
+                self.dirs.move_to_end (src_dir)
+                return entry
+            generation = self.generation
+
+        entry = self.loadDir (src_dir)
+        with self.lock:
+            # not stored if a policy was changed while it was read
+            if generation == self.generation:
+                self.dirs[src_dir] = entry
+                while len (self.dirs) > self.max_dirs:
+                    self.dirs.popitem (last=False)
+
+        return entry
+
+    def getPolicy (self, src_path, is_dir = False):
+        '''
+        Returns the settings that differ from the defaults for the file
+        src_path or, with is_dir, for the entries of the directory src_path.
+        '''
+        if is_dir:
+            return self.getDir (src_path)[0]
+
+        (src_dir, name) = os.path.split (src_path)
+        (policy, overrides) = self.getDir (src_dir)
+        override = overrides.get (name)
+        if override == None:
+            return policy
+
+        policy = dict (policy)
+        policy.update (override)
+        return policy
+
+    def setOverride (self, src_path, policy):
+        (src_dir, name) = os.path.split (src_path)
+        with self.lock:
+            self.generation += 1
+            entry = self.dirs.get (src_dir)
+            if entry != None:
+                entry[1][name] = dict (policy)
+
+    def invalidateTree (self, src_path):
+        'Drops the policies of src_path and every directory below it.'
+        prefix = os.path.join (src_path, '')
+        with self.lock:
+            self.generation += 1
+            for src_dir in [d for d in self.dirs if d == src_path or d.startswith (prefix)]:
+                del self.dirs[src_dir]
+
+class RecentRevisions:
+    '''
+    Remembers the files whose newest revision was created less than their
+    coalescing window ago. Changes in that time are added to this revision
+    instead of creating another one, even when the file was closed in
+    between. Unlike FileInfo the entries survive the release of the file.
+    '''
+    def __init__ (self, max_entries = recent_revisions_size):
+        self.max_entries = max_entries
+        # src_path -> (expiry, revision id), oldest first
+        self.entries = collections.OrderedDict ()
+        self.lock = threading.Lock ()
+
+    def add (self, src_path, window):
+        if window <= 0:
+            return
+
+        revisions = revision_index.getRevisions (src_path)
+        if len (revisions) == 0:
+            return
+
+        now = time.monotonic ()
+        with self.lock:
+            self.entries.pop (src_path, None)
+            self.entries[src_path] = (now + window, max (revisions))
+            # windows differ, but most entries are dropped here anyway
+            while len (self.entries) > 0:
+                (expiry, rev_id) = next (iter (self.entries.values ()))
+                if expiry >= now and len (self.entries) <= self.max_entries:
+                    break
+                self.entries.popitem (last=False)
+
+    def isRecent (self, src_path):
+        '''
+        Whether the newest revision of src_path is still the one created in
+        the window. Delta revisions are never reused, the changes of a new
+        session would not be saved in them.
+        '''
+        entry = self.entries.get (src_path)
+        if entry == None:
+            return False
+
+        (expiry, rev_id) = entry
+        if expiry < time.monotonic ():
+            with self.lock:
+                if self.entries.get (src_path) is entry:
+                    del self.entries[src_path]
+            return False
+
+        revisions = revision_index.getRevisions (src_path)
+        return len (revisions) > 0 and max (revisions) == rev_id and revisions[rev_id][2] != revision_kind_delta
+
+revision_index = RevisionIndex ()
+recent_revisions = RecentRevisions ()
+path_locks = PathLocks ()
+attr_cache = AttrCache ()
+policy_cache = PolicyCache ()
+copy_engine = RevCopy.CopyEngine ()
+chunk_store = RevStore.ChunkStore ()
+compressor = RevCompress.Compressor ()
+# RevCatalog.Catalog of the source directory, if enabled
+catalog = None
+# RevTrace.Tracer recording all calls, if enabled
+tracer = None
+# RevRules.Rules of the files without revisions, if given
+rules = None
+# SpaceBudget of all revisions, if enabled
+space_budget = None
+stats = RevStats.Stats ()
+
+def CatalogTransaction ():
+    'Collects the catalog changes of the calling thread and commits them at once.'
+    if catalog == None:
+        return contextlib.nullcontext ()
+    return catalog.transaction ()
+
+def MigrateRevisions (src_dir):
+    '''
+    Renames all revisions below src_dir that still use the old .rev_<n>_
+    numbering to the id based naming.
+    '''
+    count = 0
+    for (dirpath, dirnames, filenames) in os.walk (src_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith (revision_prefix) or d.startswith (revision_escape_prefix)]
+
+        bases = set ()
+        for name in dirnames + filenames:
+            res = ParseRevisionName (name)
+            if res != None and res[0] < 0:
+                bases.add (res[2])
+
+        for base in bases:
+            count += File (os.path.join (dirpath, base), False).migrateRevisions ()
+
+    return count
+
+def RebuildCatalog (src_dir):
+    '''
+    Fills the catalog with the revisions and policy files found below src_dir.
+    Returns the number of revisions.
+    '''
+    catalog.clear ()
+    count = 0
+    for (dirpath, dirnames, filenames) in os.walk (src_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith (revision_prefix) or d.startswith (revision_escape_prefix)]
+
+        entries = revision_index.scanDir (dirpath)
+        catalog.putDir (dirpath, entries)
+        count += sum ([len (revisions) for revisions in entries.values ()])
+
+        policies = policy_cache.scanDir (dirpath)
+        if policies != None:
+            catalog.putPolicies (dirpath, policies[0], policies[1])
+
+    catalog.setComplete (True)
+    return count
 
 class File:
+    __slots__ = ('src_path', 'is_dir', 'fd', 'open_flags', 'dir_iter', 'dir_offset', 'dir_window', 'dir_eof')
+
     def __init__ (self, src_path, is_dir, open_flags = None):
         self.src_path = src_path
         self.is_dir = is_dir
-        self.file = None
+        self.fd = None
         self.open_flags = open_flags
+        # state of a directory listing, see readdir
+        self.dir_iter = None
+        self.dir_offset = 0
+        self.dir_window = []
+        self.dir_eof = False
         
-    def getRevisionName (self, revision):
+    def getRevisionPath (self, rev_id, kind = None):
+        if kind == None:
+            kind = revision_index.getRevisions (self.src_path)[rev_id][2]
+
         (src_dir, src_name) = os.path.split (self.src_path)
-        return os.path.join (src_dir, revision_prefix + str (revision) + '_' + src_name) 
+        return os.path.join (src_dir, RevisionFileName (rev_id, kind, src_name))
+
+    def getRevisionIds (self):
+        'Returns the ids of all revisions, newest first.'
+        return sorted (revision_index.getRevisions (self.src_path), reverse=True)
 
     def getAvailableRevisions (self):
-        (src_dir, src_name) = os.path.split (self.src_path)
-        dirlist = os.listdir (src_dir)
-        revisions = []
-        for dir in dirlist:
-            #print ("check ", repr (dir))
-            if dir.startswith (revision_prefix) and not dir.startswith (revision_escape_prefix):
-                snum = ''
-                i = len (revision_prefix)
-                
-                while i < len (dir) and dir[i] != '_':
-                    snum += dir[i]
-                    i += 1
-                
-                #print ("  found revision: ", repr (dir[i:]))
-                if dir[i+1:] == src_name:
-                    try:
-                        num = int (snum)
-                        if num >= 1:
-                            #print ("found revision ", num, " of file ", self.src_path)
-                            revisions.append (num)
-                    except ValueError:
-                        pass
+        'Returns the user visible revision numbers, 1 is the newest revision.'
+        return list (range (1, len (revision_index.getRevisions (self.src_path)) + 1))
+
+    def getRevisionMTime (self, rev_id):
+        return revision_index.getRevisions (self.src_path)[rev_id][0]
+
+    def getNextRevisionId (self):
+        ids = revision_index.getRevisions (self.src_path)
+        if len (ids) == 0:
+            return 1
+
+        # ids of old style revisions are negative, new ids continue above them
+        return max (max (ids), -min (ids)) + 1
+
+    def removeRevision (self, rev_id):
+        'Returns the number of bytes freed in the chunk store.'
+        freed = 0
+        revisions = revision_index.getRevisions (self.src_path)
+        older_ids = [i for i in revisions if i < rev_id]
+        if len (older_ids) > 0 and revisions[max (older_ids)][2] == revision_kind_delta:
+            # the next older revision is stored relative to this one
+            older_id = max (older_ids)
+            if revisions[rev_id][2] == revision_kind_delta:
+                self.mergeDeltaRevisions (older_id, rev_id)
+            else:
+                self.convertToFull (older_id)
+
+        rev_name = self.getRevisionPath (rev_id)
+        copy_engine.wait (rev_name)
+        logging.info ("delete revision %d (%s)", rev_id, rev_name)
+        if revisions[rev_id][2] == revision_kind_manifest:
+            freed = chunk_store.removeManifest (rev_name)
+            if space_budget != None:
+                space_budget.add (chunk_store.store_dir, -freed)
+        else:
+            self.removeRecursiv (rev_name)
+        revision_index.removeRevision (self.src_path, rev_id)
+        revision_index.invalidateTree (rev_name)
+        stats.add ('revisions_deleted')
+        # a deleted file is only shown while it has revisions
+        attr_cache.invalidate (self.src_path)
+        return freed
+
+    def removeRevisions (self, rev_ids):
+        # oldest first, so no delta has to be merged into a revision that is
+        # deleted right afterwards
+        freed = 0
+        with CatalogTransaction ():
+            for rev_id in sorted (rev_ids):
+                freed += self.removeRevision (rev_id)
+        return freed
+
+    def createTempName (self):
+        (fd, tmp_name) = tempfile.mkstemp (prefix=revision_tmp_prefix, dir=os.path.dirname (self.src_path))
+        os.close (fd)
+        return tmp_name
+
+    def materializeRevision (self, rev_id, dest_path):
+        '''
+        Writes the content of a revision to dest_path. Delta revisions are
+        rebuilt from the next newer revision or the current file.
+        '''
+        revisions = revision_index.getRevisions (self.src_path)
+        ids = self.getRevisionIds ()
+        i = ids.index (rev_id)
+        chain = []
+        while i >= 0 and revisions[ids[i]][2] == revision_kind_delta:
+            chain.append (ids[i])
+            i -= 1
+
+        base = self.src_path
+        if i >= 0:
+            base = self.getRevisionPath (ids[i])
+            copy_engine.wait (base)
+
+        if not os.path.isfile (base) or os.path.islink (base):
+            logging.error ("Restore of %s not implemented, no regular file", base)
+            raise fuse.FuseOSError (errno.ENOSYS)
+
+        if i >= 0 and revisions[ids[i]][2] == revision_kind_manifest:
+            chunk_store.restoreFile (base, dest_path)
+            shutil.copystat (base, dest_path)
+        elif i >= 0 and revisions[ids[i]][2] == revision_kind_compressed:
+            RevCompress.DecompressFile (base, dest_path)
+            shutil.copystat (base, dest_path)
+        else:
+            copy_engine.copy (base, dest_path)
+        if len (chain) > 0:
+            fd = os.open (dest_path, os.O_WRONLY)
+            try:
+                for delta_id in reversed (chain):
+                    RevDelta.ApplyDelta (self.getRevisionPath (delta_id), fd)
+            finally:
+                os.close (fd)
+
+            mtime = revisions[rev_id][0]
+            os.utime (dest_path, (mtime, mtime))
+
+    def convertToFull (self, rev_id):
+        'Replaces a delta revision by a full copy of its content.'
+        delta_name = self.getRevisionPath (rev_id)
+        tmp_name = self.createTempName ()
+        try:
+            self.materializeRevision (rev_id, tmp_name)
+            os.rename (tmp_name, self.getRevisionPath (rev_id, revision_kind_full))
+        except:
+            os.unlink (tmp_name)
+            raise
+
+        os.unlink (delta_name)
+        (mtime, size, kind, stored) = revision_index.getRevisions (self.src_path)[rev_id]
+        revision_index.addRevision (self.src_path, rev_id, mtime, size, revision_kind_full)
+
+    def mergeDeltaRevisions (self, older_id, rev_id):
+        'Makes the delta older_id independent of the delta rev_id.'
+        older_name = self.getRevisionPath (older_id)
+        tmp_name = self.createTempName ()
+        try:
+            RevDelta.MergeDeltas (older_name, self.getRevisionPath (rev_id), tmp_name)
+            sr = os.stat (older_name)
+            os.utime (tmp_name, ns=(sr.st_atime_ns, sr.st_mtime_ns))
+            os.rename (tmp_name, older_name)
+        except:
+            os.unlink (tmp_name)
+            raise
+
+    def compressRevisions (self):
+        'Starts compressing the full copy revisions that are old enough.'
+        if compress_rank <= 0 and compress_age <= 0:
+            return
+
+        revisions = revision_index.getRevisions (self.src_path)
+        old_date = time.time () - compress_age * 24 * 60 * 60
+        for (rev, rev_id) in enumerate (self.getRevisionIds (), 1):
+            (mtime, size, kind, stored) = revisions[rev_id]
+            # old style revisions have no name for other kinds, see --migrate
+            if kind != revision_kind_full or rev_id < 0:
+                continue
+
+            if (compress_rank > 0 and rev > compress_rank) or (compress_age > 0 and mtime < old_date):
+                self.compressRevision (rev_id)
+
+    def compressRevision (self, rev_id):
+        rev_name = self.getRevisionPath (rev_id)
+        if os.path.islink (rev_name) or not os.path.isfile (rev_name) or copy_engine.isPending (rev_name):
+            # a revision that is still copied is compressed next time
+            return
+
+        tmp_name = self.createTempName ()
+
+        def done (stored):
+            self.finishCompression (rev_id, tmp_name, stored)
+
+        if not compressor.submit ((self.src_path, rev_id), rev_name, tmp_name, done):
+            os.unlink (tmp_name)
+
+    def finishCompression (self, rev_id, tmp_name, stored):
+        with path_locks.locked (self.src_path):
+            self.replaceByCompressed (rev_id, tmp_name, stored)
+
+    def replaceByCompressed (self, rev_id, tmp_name, stored):
+        revisions = revision_index.getRevisions (self.src_path)
+        if stored == None or rev_id not in revisions or revisions[rev_id][2] != revision_kind_full:
+            # failed or the revision was changed in the meantime
+            os.unlink (tmp_name)
+            return
+
+        (mtime, size, kind, old_stored) = revisions[rev_id]
+        rev_name = self.getRevisionPath (rev_id)
+        shutil.copystat (rev_name, tmp_name)
+        os.rename (tmp_name, self.getRevisionPath (rev_id, revision_kind_compressed))
+        os.unlink (rev_name)
+        revision_index.addRevision (self.src_path, rev_id, mtime, size, revision_kind_compressed, stored)
+        stats.add ('revisions_compressed')
+        logging.info ("compressed revision %s from %d to %d bytes", rev_name, size, stored)
+
+    def detachRevisions (self):
+        '''
+        Has to be called before the file is moved away, the newest delta
+        revision would refer to a file that no longer exists otherwise.
+        '''
+        ids = self.getRevisionIds ()
+        if len (ids) > 0 and revision_index.getRevisions (self.src_path)[ids[0]][2] == revision_kind_delta:
+            self.convertToFull (ids[0])
+
+    def migrateRevisions (self):
+        '''
+        Renames old style revisions .rev_<n>_ of this file to ids below all
+        revisions that already use ids. Returns the number of renamed revisions.
+        '''
+        revisions = revision_index.getRevisions (self.src_path)
+        old_ids = sorted ([i for i in revisions if i < 0])
+        if len (old_ids) == 0:
+            return 0
+
+        new_ids = [i for i in revisions if i > 0]
+        if len (new_ids) > 0 and min (new_ids) <= len (old_ids):
+            logging.warning ("Cannot migrate revisions of %s, ids are already in use", self.src_path)
+            return 0
+
+        # the oldest revision gets id 1
+        for (new_id, old_id) in enumerate (old_ids, 1):
+            os.rename (self.getRevisionPath (old_id), self.getRevisionPath (new_id, revision_kind_full))
+            revision_index.moveRevision (self.src_path, old_id, new_id)
+
+        logging.info ("migrated %d revisions of %s", len (old_ids), self.src_path)
+        return len (old_ids)
 
-        return revisions
-    
     def removeRecursiv (self, path):
         if not os.path.islink (path) and os.path.isdir (path):
             for (dirpath, dirnames, filenames) in os.walk (path, topdown=False):
@@ -156,53 +1132,73 @@ class File:
         else:
             os.unlink (path)
         
-    def limitRevisions (self, file_info):
-        if os.path.lexists (self.src_path):
-            existing_revisions = self.getAvailableRevisions ()
+    def getExpiredRevisions (self, file_info):
+        existing_revisions = self.getRevisionIds ()
 
-            del_date = datetime.datetime.now () - datetime.timedelta (days=file_info.max_age)
+        del_date = datetime.datetime.now () - datetime.timedelta (days=file_info.max_age)
 
-            for rev in existing_revisions:
-                if rev > file_info.min_revisions:
-                    if rev <= file_info.revisions:
-                        mtime = datetime.datetime.fromtimestamp (os.stat (self.getRevisionName (rev), follow_symlinks=False).st_mtime)
-                    
-                        if mtime >= del_date:
-                            continue
+        del_revisions = []
+        for (rev, rev_id) in enumerate (existing_revisions, 1):
+            if rev > file_info.min_revisions:
+                if rev <= file_info.revisions:
+                    mtime = datetime.datetime.fromtimestamp (self.getRevisionMTime (rev_id))
+                
+                    if mtime >= del_date:
+                        continue
 
-                    logging.info ("delete revision %d (%s)", rev, self.getRevisionName (rev))
-                    self.removeRecursiv (self.getRevisionName (rev))
+                del_revisions.append (rev_id)
+
+        return del_revisions
+
+    def limitRevisions (self, file_info):
+        if os.path.lexists (self.src_path):
+            self.removeRevisions (self.getExpiredRevisions (file_info))
         
-    def createRevisionCopy (self, file_info, use_rename = False):
+    def createRevisionCopy (self, file_info, use_rename = False, delta = False, append_at = None):
+        '''
+        Saves the current content of the file as new revision. With use_rename
+        the file itself is moved into the revision. With delta the caller
+        reports all changes to file_info.delta, which is then used for files
+        with delta storage. It is also used with any storage, when the first
+        change is at append_at at or after the end of the file: the revision
+        is then the current file cut at its old length and costs nothing.
+        '''
         if os.path.lexists (self.src_path):
-            existing_revisions = self.getAvailableRevisions ()
+            existing_revisions = self.getRevisionIds ()
             
             logging.info ("Creating new revision for %s, now having %d of %d revisions",
                           self.src_path, min (len (existing_revisions)+1, file_info.revisions), file_info.revisions)
             
             del_date = datetime.datetime.now () - datetime.timedelta (days=file_info.max_age)
             
-            if file_info.revisions in existing_revisions:
-                self.removeRecursiv (self.getRevisionName (file_info.revisions))
-        
-            for i in range (file_info.revisions-1, 0, -1):
-                if i in existing_revisions:
-
-                    if i > file_info.min_revisions:
-                        mtime = datetime.datetime.fromtimestamp (os.stat (self.getRevisionName (i), follow_symlinks=False).st_mtime)
+            # existing revision i becomes revision i+1 once the new one exists
+            del_revisions = []
+            for (i, rev_id) in enumerate (existing_revisions, 1):
+                if i >= file_info.revisions:
+                    del_revisions.append (rev_id)
+
+                elif i > file_info.min_revisions:
+                    mtime = datetime.datetime.fromtimestamp (self.getRevisionMTime (rev_id))
                     
-                        if mtime < del_date:
-                            logging.info ("delete revision %d (%s)", i, self.getRevisionName (i))
-                            self.removeRecursiv (self.getRevisionName (i))
-                            continue
-                        
-                    os.rename (self.getRevisionName (i), self.getRevisionName (i+1))
+                    if mtime < del_date:
+                        del_revisions.append (rev_id)
+
+            self.removeRevisions (del_revisions)
 
             if file_info.revisions == 0:
                 logging.info ("should not copy/rename original file (%s)", self.src_path)
                 
+            new_id = self.getNextRevisionId ()
+            rev_name = self.getRevisionPath (new_id, revision_kind_full)
+
             if use_rename:
-                os.rename (self.src_path, self.getRevisionName (1))
+                os.rename (self.src_path, rev_name)
+                revision_index.invalidateTree (self.src_path)
+                # nothing is copied
+                sr = os.lstat (rev_name)
+                revision_index.addRevision (self.src_path, new_id, sr.st_mtime, sr.st_size)
+                stats.add ('revisions_created')
+                return
             elif os.path.islink (self.src_path):
                 logging.error ("Copy of symbolic link not implemented")
                 raise fuse.FuseOSError (errno.ENOSYS)
@@ -210,112 +1206,764 @@ class File:
                 logging.error ("Copy of directory not implemented")
                 raise fuse.FuseOSError (errno.ENOSYS)
             elif os.path.isfile (self.src_path):
-                shutil.copy2 (self.src_path, self.getRevisionName (1))
+                sr = os.stat (self.src_path)
+                appending = append_at != None and append_at >= sr.st_size
+                if delta and (file_info.storage == storage_delta or appending) and sr.st_nlink == 1:
+                    # writes through other hard links could not be tracked
+                    rev_name = self.getRevisionPath (new_id, revision_kind_delta)
+                    file_info.delta = RevDelta.DeltaWriter (rev_name, sr.st_size, self.src_path,
+                                                            (sr.st_atime_ns, sr.st_mtime_ns))
+                    revision_index.addRevision (self.src_path, new_id, sr.st_mtime, sr.st_size, revision_kind_delta,
+                                                file_info.delta.size)
+                    stats.add ('revisions_created')
+                    if appending and file_info.storage != storage_delta:
+                        stats.add ('append_revisions')
+                    return
+
+                if delta and sr.st_nlink == 1 and file_info.storage == storage_full and copy_engine.canCopyInBackground (sr.st_size):
+                    # writers only wait for the ranges they change
+                    file_info.delta = copy_engine.copyInBackground (self.src_path, rev_name)
+                    revision_index.addRevision (self.src_path, new_id, sr.st_mtime, sr.st_size)
+                    stats.add ('revisions_created')
+                    stats.add ('revisions_copied_in_background')
+                    stats.add ('revision_bytes_copied', sr.st_size)
+                    return
+
+                if file_info.storage == storage_dedup:
+                    rev_name = self.getRevisionPath (new_id, revision_kind_manifest)
+                    (size, stored) = chunk_store.storeFile (self.src_path, rev_name)
+                    # the manifest keeps mode and times of the file like a copy does
+                    shutil.copystat (self.src_path, rev_name)
+                    logging.debug ("stored %d of %d bytes for %s", stored, size, rev_name)
+                    # stored like a scan of the directory finds it, the chunks are counted by the store
+                    revision_index.addRevision (self.src_path, new_id, sr.st_mtime, size, revision_kind_manifest,
+                                                os.lstat (rev_name).st_size)
+                    if space_budget != None:
+                        space_budget.add (chunk_store.store_dir, stored)
+                    stats.add ('revisions_created')
+                    stats.add ('revision_bytes_copied', stored)
+                    return
+
+                copy_engine.copy (self.src_path, rev_name)
             else:
                 logging.error ("Copy of not regular file not implemented")
                 raise fuse.FuseOSError (errno.ENOSYS)
 
+            sr = os.lstat (rev_name)
+            revision_index.addRevision (self.src_path, new_id, sr.st_mtime, sr.st_size)
+            stats.add ('revisions_created')
+            stats.add ('revision_bytes_copied', sr.st_size)
+
+    def replaceByEmpty (self, file_info):
+        '''
+        Moves the file into a new revision and creates an empty file with the
+        same mode, owner and extended attributes in its place. An open
+        handle is moved to the new file.
+        '''
+        sr = os.lstat (self.src_path)
+        xattrs = []
+        for name in os.listxattr (self.src_path, follow_symlinks=False):
+            try:
+                xattrs.append ((name, os.getxattr (self.src_path, name, follow_symlinks=False)))
+            except OSError:
+                pass
+
+        self.createRevisionCopy (file_info, use_rename=True)
+        fd = os.open (self.src_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+        try:
+            os.fchmod (fd, stat.S_IMODE (sr.st_mode))
+            try:
+                os.fchown (fd, sr.st_uid, sr.st_gid)
+            except PermissionError:
+                pass
+            for (name, value) in xattrs:
+                try:
+                    os.setxattr (fd, name, value)
+                except OSError as e:
+                    logging.debug ("cannot copy %s of %s: %s", name, self.src_path, e)
+
+            if self.fd != None:
+                flags = self.open_flags & open_flags_passed & ~(os.O_CREAT | os.O_EXCL | os.O_TRUNC)
+                new_fd = os.open (self.src_path, flags | os.O_CLOEXEC)
+                os.dup2 (new_fd, self.fd, inheritable=False)
+                os.close (new_fd)
+        finally:
+            os.close (fd)
+
+        stats.add ('revisions_replaced')
+
     def open (self, mode = None):
-        if self.file != None:
+        if self.fd != None:
             raise fuse.FuseOSError (errno.EIO)
 
-        open_mode = ''
-        
-        m = self.open_flags & os.O_ACCMODE
-        trunc = (self.open_flags & os.O_TRUNC) == os.O_TRUNC
-        create = (self.open_flags & os.O_CREAT) == os.O_CREAT
-        append = (self.open_flags & os.O_APPEND) == os.O_APPEND
-        exclusive = (self.open_flags & os.O_EXCL) == os.O_EXCL
-        opener = os.open
-        if mode != None:
-            opener = lambda path, flags, dir_fd=None: os.open (path, flags, mode, dir_fd = dir_fd)
-        
-        if os.path.exists (self.src_path):
-            if create and exclusive:
-                raise fuse.FuseOSError (errno.EEXIST)
-        else:
-            if not create:
-                raise fuse.FuseOSError (errno.ENOENT)
-            
-            self.need_copy_on_write = False
-            
-        if m == os.O_RDWR:
-            if trunc or create:
-                open_mode = 'w+b'
-            elif append:
-                open_mode = 'a+b'
-            else:
-                open_mode = 'r+b'
-        elif m == os.O_RDONLY:
-            open_mode = 'rb'
-        elif m == os.O_WRONLY:
-            if append:
-                open_mode = 'ab'
-            else:
-                open_mode = 'wb'
+        if mode == None:
+            mode = 0o666
 
+        flags = self.open_flags & open_flags_passed
         try:
-            self.file = open (self.src_path, open_mode, opener = opener)
+            self.fd = os.open (self.src_path, flags | os.O_CLOEXEC, mode)
         except OSError as e:
-            print (repr (e))
-            self.file = None
+            self.fd = None
             raise fuse.FuseOSError (e.errno)
         
     def close (self):
         if self.is_dir:
+            self.closeDir ()
             return
         
-        if self.file == None:
+        if self.fd == None:
             raise fuse.FuseOSError (errno.EIO)
         
-        self.file.close ()
-        self.file = None
+        os.close (self.fd)
+        self.fd = None
         
-    def readdir (self):
+    def closeDir (self):
+        if self.dir_iter != None:
+            self.dir_iter.close ()
+            self.dir_iter = None
+
+    def nextDirEntry (self, generation):
+        'Returns the next visible (name, attrs, offset) or None at the end.'
+        if self.dir_offset < 2:
+            self.dir_offset += 1
+            return (['.', '..'][self.dir_offset-1], None, self.dir_offset)
+
+        for entry in self.dir_iter:
+            name = entry.name
+            if name.startswith (revision_prefix):
+                if not name.startswith (revision_escape_prefix):
+                    continue
+                name = revision_prefix + name[len (revision_escape_prefix):]
+
+            if not name.isascii ():
+                try:
+                    name.encode ("utf-8")
+                except UnicodeEncodeError:
+                    logging.error ("Cannot encode %s: File name is no valid UTF-8. Ignoring file.", repr (entry.path))
+                    continue
+
+            try:
+                r = entry.stat (follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+
+            # ls -l asks for the attributes of every entry right afterwards,
+            # the kernel only takes the type and inode from the listing
+            attr_cache.put (entry.path, r, generation)
+            self.dir_offset += 1
+            return (name, dict (st_mode=r.st_mode, st_ino=r.st_ino), self.dir_offset)
+
+        return None
+
+    def readdir (self, offset = 0):
+        '''
+        Yields (name, attrs, offset) for the entries after offset, the
+        offset of an entry is its position in the listing.
+
+        The kernel asks for the entries after the last one it used, it drops
+        the ones that did not fit into the buffer of the caller. So the scan
+        stays open between calls and the entries yielded by the last call are
+        kept to be yielded again. Only for an offset before them, after a
+        seekdir, the directory is scanned again from the start.
+        '''
         if not self.is_dir:
             raise fuse.FuseOSError(errno.EIO)
-        
-        dirs = ['.', '..']
-        dirlist = os.listdir (self.src_path)
-        for dir in dirlist:
-            try:
-                encoded_dir = dir.encode ("utf-8")
-            except Exception as e:
-                logging.error ("Cannot encode %s: File name is no valid UTF-8. Ignoring file.",
-                               repr (os.path.join (self.src_path, dir)))
+
+        window = self.dir_window
+        if self.dir_iter == None and not self.dir_eof or \
+           offset < self.dir_offset and (len (window) == 0 or window[0][2] > offset + 1):
+            self.closeDir ()
+            self.dir_iter = os.scandir (self.src_path)
+            self.dir_offset = 0
+            self.dir_eof = False
+            window = []
+
+        # the entries of this call, those after offset of the last one first
+        self.dir_window = [entry for entry in window if entry[2] > offset]
+        yield from list (self.dir_window)
+
+        generation = attr_cache.generation
+        while not self.dir_eof:
+            entry = self.nextDirEntry (generation)
+            if entry == None:
+                self.closeDir ()
+                self.dir_eof = True
+                break
+
+            if entry[2] <= offset:
+                # seekdir to a later entry
                 continue
-                
-            if dir.startswith (revision_prefix):
-                if dir.startswith (revision_escape_prefix):
-                    dirs.append (revision_escape_prefix + dir[len(revision_escape_prefix):])
-            else:
-                dirs.append (dir)
-        #print ("  result: ", repr (dirs))
-        return dirs
+
+            self.dir_window.append (entry)
+            yield entry
 
     def read (self, size, offset):
         if self.is_dir:
             raise fuse.FuseOSError(errno.EIO)
 
-        f = self.file
-        f.seek (offset)
-        return f.read (size)
+        return os.pread (self.fd, size, offset)
 
     def write (self, data, offset):
         if self.is_dir:
             raise fuse.FuseOSError(errno.EIO)
 
-        f = self.file
-        f.seek (offset)
-        return f.write (data)
+        return os.pwrite (self.fd, data, offset)
+
+def GetNextExpiry (file_info, revisions):
+    '''
+    Returns the time when the next revision expires or None if none of the
+    revisions can expire with this policy.
+    '''
+    expiry = None
+    ids = sorted (revisions, reverse=True)
+    for (rev, rev_id) in enumerate (ids, 1):
+        if rev <= file_info.min_revisions:
+            continue
+
+        if rev > file_info.revisions:
+            return 0
+
+        t = revisions[rev_id][0] + file_info.max_age * 24 * 60 * 60
+        if expiry == None or t < expiry:
+            expiry = t
+
+    return expiry
+
+class RetentionScheduler:
+    '''
+    Deletes expired revisions in the background, also of files that are not
+    written any more.
+
+    Every file with revisions that can expire is kept in a priority queue
+    ordered by the time its next revision expires. The queue is filled by a
+    slow scan of the source tree, a few directories at a time, and updated
+    whenever revisions are created or a policy is changed. Deletions are
+    limited to purge_rate revisions per second. A complete catalog replaces
+    the scan of the tree.
+    '''
+    def __init__ (self, src_dir, purge_rate = purge_rate):
+        self.src_dir = src_dir
+        self.purge_rate = purge_rate
+        self.queue = []
+        self.next_expiry = {}
+        self.queue_lock = threading.Lock ()
+        self.wakeup = threading.Event ()
+        self.stopped = False
+        self.thread = None
+        self.scan_dirs = []
+
+    def start (self):
+        if self.purge_rate <= 0 or self.thread != None:
+            return
+
+        logging.info ("Start purging expired revisions in %s", self.src_dir)
+        self.stopped = False
+        self.scan_dirs = [self.src_dir]
+        self.thread = threading.Thread (target=self.run, name='RevisionPurge', daemon=True)
+        self.thread.start ()
+
+    def stop (self):
+        if self.thread == None:
+            return
+
+        self.stopped = True
+        self.wakeup.set ()
+        self.thread.join ()
+        self.thread = None
+
+    def update (self, src_path, file_info, revisions = None):
+        'Recomputes when the next revision of src_path expires.'
+        if revisions == None:
+            revisions = revision_index.getRevisions (src_path)
+
+        expiry = GetNextExpiry (file_info, revisions)
+        with self.queue_lock:
+            if expiry == None:
+                self.next_expiry.pop (src_path, None)
+                return
+
+            if self.next_expiry.get (src_path) == expiry:
+                return
+
+            self.next_expiry[src_path] = expiry
+            heapq.heappush (self.queue, (expiry, src_path))
+
+        if expiry <= time.time ():
+            self.wakeup.set ()
+
+    def rescan (self, src_dir):
+        'Schedules the tree src_dir again, after its policy was changed.'
+        if self.thread == None:
+            return
+
+        self.scan_dirs.append (src_dir)
+        self.wakeup.set ()
+
+    def popExpired (self, now, count):
+        res = []
+        with self.queue_lock:
+            while len (self.queue) > 0 and len (res) < count and self.queue[0][0] <= now:
+                (expiry, src_path) = heapq.heappop (self.queue)
+                # skip entries that were replaced by a later update
+                if self.next_expiry.get (src_path) == expiry:
+                    del self.next_expiry[src_path]
+                    res.append (src_path)
+
+        return res
+
+    def scanStep (self):
+        'Schedules the files of the next directory of the source tree.'
+        if len (self.scan_dirs) == 0:
+            return False
+
+        src_dir = self.scan_dirs.pop ()
+        if catalog != None and catalog.isComplete ():
+            for (src_path, revisions) in catalog.iterFiles (src_dir):
+                file_info = FileInfo ()
+                file_info.loadFileInfo (src_path)
+                self.update (src_path, file_info, revisions)
+            return True
+
+        try:
+            with os.scandir (src_dir) as it:
+                for entry in it:
+                    if entry.is_dir (follow_symlinks=False) and \
+                       (not entry.name.startswith (revision_prefix) or entry.name.startswith (revision_escape_prefix)):
+                        self.scan_dirs.append (entry.path)
+
+            entries = revision_index.scanDir (src_dir)
+        except OSError as e:
+            logging.debug ("purge scan of %s failed: %s", src_dir, e)
+            return True
+
+        for (base, revisions) in entries.items ():
+            src_path = os.path.join (src_dir, base)
+            file_info = FileInfo ()
+            file_info.loadFileInfo (src_path)
+            self.update (src_path, file_info, revisions)
+
+        return True
+
+    def purge (self, src_path):
+        '''
+        Deletes up to purge_rate of the oldest expired revisions of src_path.
+        Returns the number of deleted revisions.
+        '''
+        with path_locks.locked (src_path):
+            file_info = FileInfo ()
+            file_info.loadFileInfo (src_path)
+            f = File (src_path, False)
+            expired = sorted (f.getExpiredRevisions (file_info))[:self.purge_rate]
+            f.removeRevisions (expired)
+            stats.add ('revisions_purged', len (expired))
+            self.update (src_path, file_info)
+            return len (expired)
+
+    def run (self):
+        while not self.stopped:
+            scanning = self.scanStep ()
+
+            deleted = 0
+            for src_path in self.popExpired (time.time (), max (1, self.purge_rate)):
+                try:
+                    deleted += self.purge (src_path)
+                except OSError as e:
+                    logging.error ("purging revisions of %s failed: %s", src_path, e)
+
+            if deleted > 0:
+                logging.info ("purged %d expired revisions", deleted)
+
+            timeout = max (1.0, deleted / self.purge_rate)
+            if not scanning:
+                with self.queue_lock:
+                    if len (self.queue) > 0:
+                        timeout = max (timeout, self.queue[0][0] - time.time ())
+                    else:
+                        timeout = purge_idle_interval
+                timeout = min (timeout, purge_idle_interval)
+            elif deleted == 0:
+                # keep the scan in the background
+                timeout = purge_scan_pause
+
+            self.wakeup.wait (timeout)
+            self.wakeup.clear ()
+
+evict_oldest = 'oldest'
+evict_largest = 'largest'
+evict_policies = [evict_oldest, evict_largest]
+
+class SpaceBudget:
+    '''
+    Counts the bytes stored in revisions below the source directory and
+    deletes revisions anywhere in the tree when they use more than limit
+    bytes (0: only count). The revision index reports the stored size of
+    every directory it loads and every revision it adds or removes, a
+    background scan counts all directories once after mounting and again
+    every budget_rescan_interval seconds. Until the first scan is complete
+    the total is too low and nothing is deleted. The chunks of dedup
+    revisions are counted under the directory of the chunk store, the
+    manifests with their directories.
+
+    Each file loses its oldest revision first and never more than its
+    min_revisions allow. With evict_oldest the oldest of these revisions in
+    the whole tree is deleted first, with evict_largest the largest one.
+    '''
+    def __init__ (self, src_dir, limit = 0, policy = evict_oldest):
+        self.src_dir = src_dir
+        self.limit = limit
+        self.policy = policy
+        self.lock = threading.Lock ()
+        # src_dir -> stored bytes of the directories with revisions
+        self.dirs = {}
+        self.used = 0
+        self.complete = False
+        self.wakeup = threading.Event ()
+        self.stopped = False
+        self.thread = None
+
+    def setDir (self, src_dir, entries):
+        total = 0
+        for revisions in entries.values ():
+            for (mtime, size, kind, stored) in revisions.values ():
+                total += stored
+        self.setSize (src_dir, total)
+
+    def setSize (self, path, total):
+        with self.lock:
+            self.used += total - self.dirs.pop (path, 0)
+            if total != 0:
+                self.dirs[path] = total
+
+    def add (self, src_dir, stored):
+        with self.lock:
+            total = self.dirs.get (src_dir, 0) + stored
+            self.used += stored
+            if total != 0:
+                self.dirs[src_dir] = total
+            else:
+                self.dirs.pop (src_dir, None)
+
+            if self.isExceeded ():
+                self.wakeup.set ()
+
+    def dropTree (self, src_path):
+        '''
+        Forgets src_path and everything below it, these directories are
+        counted again when they are loaded or scanned.
+        '''
+        prefix = os.path.join (src_path, '')
+        with self.lock:
+            for src_dir in [d for d in self.dirs if d == src_path or d.startswith (prefix)]:
+                self.used -= self.dirs.pop (src_dir)
+
+    def moveTree (self, old_path, new_path):
+        self.dropTree (new_path)
+        prefix = os.path.join (old_path, '')
+        with self.lock:
+            for src_dir in [d for d in self.dirs if d == old_path or d.startswith (prefix)]:
+                self.dirs[new_path + src_dir[len (old_path):]] = self.dirs.pop (src_dir)
+
+    def isExceeded (self):
+        return self.limit > 0 and self.complete and self.used > self.limit
+
+    def getUsage (self):
+        with self.lock:
+            return {'used': self.used, 'limit': self.limit, 'headroom': self.limit - self.used if self.limit > 0 else None,
+                    'complete': self.complete, 'policy': self.policy}
+
+    def start (self):
+        if self.thread != None:
+            return
+
+        self.stopped = False
+        self.thread = threading.Thread (target=self.run, name='RevisionBudget', daemon=True)
+        self.thread.start ()
+
+    def stop (self):
+        if self.thread == None:
+            return
+
+        self.stopped = True
+        self.wakeup.set ()
+        self.thread.join ()
+        self.thread = None
+
+    def iterDirs (self):
+        'Yields every directory of the source tree that can hold revisions.'
+        dirs = [self.src_dir]
+        while len (dirs) > 0 and not self.stopped:
+            src_dir = dirs.pop ()
+            try:
+                with os.scandir (src_dir) as it:
+                    for entry in it:
+                        if entry.is_dir (follow_symlinks=False) and \
+                           (not entry.name.startswith (revision_prefix) or entry.name.startswith (revision_escape_prefix)):
+                            dirs.append (entry.path)
+            except OSError as e:
+                logging.debug ("space scan of %s failed: %s", src_dir, e)
+                continue
+
+            yield src_dir
+
+    def scan (self):
+        for src_dir in self.iterDirs ():
+            try:
+                revision_index.countDir (src_dir)
+            except OSError as e:
+                logging.debug ("space scan of %s failed: %s", src_dir, e)
+
+        try:
+            self.setSize (chunk_store.store_dir, chunk_store.getStoredSize ())
+        except OSError as e:
+            logging.debug ("space scan of %s failed: %s", chunk_store.store_dir, e)
+
+        if not self.stopped:
+            self.complete = True
+            logging.info ("revisions in %s use %d bytes", self.src_dir, self.used)
+
+    def iterFiles (self):
+        'Yields (src_path, revisions) of every file with revisions.'
+        if catalog != None and catalog.isComplete ():
+            yield from catalog.iterFiles (self.src_dir)
+            return
+
+        for src_dir in self.iterDirs ():
+            try:
+                entries = revision_index.scanDir (src_dir)
+            except OSError:
+                continue
+            for (base, revisions) in entries.items ():
+                yield (os.path.join (src_dir, base), revisions)
+
+    def getKey (self, revision):
+        (mtime, size, kind, stored) = revision
+        if self.policy == evict_largest:
+            return -stored
+        return mtime
+
+    def evict (self):
+        '''
+        Deletes revisions until the low water mark is reached, returns the
+        number of freed bytes.
+        '''
+        # (key, src_path, ids that may be deleted, oldest first)
+        candidates = []
+        for (src_path, revisions) in self.iterFiles ():
+            file_info = FileInfo ()
+            file_info.loadFileInfo (src_path)
+            ids = sorted (revisions, reverse=True)[file_info.min_revisions:]
+            if len (ids) > 0:
+                ids.reverse ()
+                candidates.append ((self.getKey (revisions[ids[0]]), src_path, ids))
+        heapq.heapify (candidates)
+
+        freed = 0
+        target = self.limit * budget_low_water
+        while len (candidates) > 0 and self.used > target and not self.stopped:
+            (key, src_path, ids) = heapq.heappop (candidates)
+            rev_id = ids.pop (0)
+            with path_locks.locked (src_path):
+                file_info = FileInfo ()
+                file_info.loadFileInfo (src_path)
+                revisions = revision_index.getRevisions (src_path)
+                if rev_id not in sorted (revisions, reverse=True)[file_info.min_revisions:]:
+                    # changed in the meantime
+                    continue
+
+                stored = revisions[rev_id][3]
+                logging.info ("evicting revision %d of %s, %d bytes", rev_id, src_path, stored)
+                stored += File (src_path, False).removeRevisions ([rev_id])
+                stats.add ('revisions_evicted')
+                stats.add ('revision_bytes_evicted', stored)
+                freed += stored
+                if len (ids) > 0 and ids[0] in revisions:
+                    heapq.heappush (candidates, (self.getKey (revisions[ids[0]]), src_path, ids))
+
+        return freed
+
+    def run (self):
+        next_scan = 0
+        next_evict = 0
+        while not self.stopped:
+            if time.monotonic () >= next_scan:
+                self.scan ()
+                next_scan = time.monotonic () + budget_rescan_interval
+
+            if self.isExceeded () and time.monotonic () >= next_evict:
+                try:
+                    freed = self.evict ()
+                    logging.info ("evicted %d bytes of revisions, %d of %d bytes used", freed, self.used, self.limit)
+                except OSError as e:
+                    logging.error ("evicting revisions failed: %s", e)
+
+                if self.used > self.limit:
+                    logging.warning ("revisions use %d bytes, more than the budget of %d bytes", self.used, self.limit)
+                    next_evict = time.monotonic () + budget_evict_pause
+
+            timeout = next_scan - time.monotonic ()
+            if self.isExceeded ():
+                timeout = min (timeout, next_evict - time.monotonic ())
+
+            self.wakeup.wait (max (0, timeout))
+            self.wakeup.clear ()
+
+class HandleTable:
+    '''
+    The open file handles, split into stripes with a lock each, so threads
+    opening and closing files rarely wait for each other. Handle fh is kept
+    in stripe fh % stripes. Released handle numbers are reused from a free
+    list, new numbers are only taken from the counter when it is empty.
+    '''
+    def __init__ (self, stripes = handle_stripes):
+        self.stripes = [({}, threading.Lock ()) for i in range (stripes)]
+        self.next_fh = itertools.count ()
+        # append and pop of a deque are atomic
+        self.free = collections.deque ()
+
+    def __len__ (self):
+        return sum (len (handles) for (handles, lock) in self.stripes)
+
+    def getStripe (self, fh):
+        return self.stripes[fh % len (self.stripes)]
+
+    def __contains__ (self, fh):
+        return fh in self.getStripe (fh)[0]
+
+    def get (self, fh):
+        return self.getStripe (fh)[0].get (fh)
+
+    def add (self, file):
+        try:
+            fh = self.free.pop ()
+        except IndexError:
+            fh = next (self.next_fh)
+
+        (handles, lock) = self.getStripe (fh)
+        with lock:
+            handles[fh] = file
+        return fh
+
+    def remove (self, fh, file):
+        'Removes fh if it still belongs to file, returns whether it did.'
+        (handles, lock) = self.getStripe (fh)
+        with lock:
+            if handles.get (fh) is not file:
+                return False
+            del handles[fh]
+
+        self.free.append (fh)
+        return True
+
+class StatsFile:
+    'An open statistics file, see RevisionFS.statsCall.'
+    __slots__ = ('data',)
+
+    def __init__ (self, data):
+        self.data = data
 
 class RevisionFS (fuse.Operations):
-    def __init__ (self, src_dir):
+    def __init__ (self, src_dir, copy_strategy = None, use_catalog = False, rules_file = None, budget = None, evict_policy = evict_oldest):
+        global catalog, rules, space_budget
+
         self.src_dir = src_dir
-        self.file_handles = {}
+        self.scheduler = RetentionScheduler (src_dir, purge_rate)
+        policy_cache.setRoot (src_dir)
+        catalog = None
+        catalog_path = os.path.join (src_dir, RevCatalog.catalog_name)
+        if use_catalog:
+            catalog = RevCatalog.Catalog (src_dir)
+        elif os.path.exists (catalog_path):
+            # changes made without the catalog would not be in it
+            logging.warning ("Clearing the catalog of %s, it is not used by this mount", src_dir)
+            old_catalog = RevCatalog.Catalog (src_dir)
+            old_catalog.clear ()
+            old_catalog.close ()
+        rules = None
+        if rules_file != None:
+            rules = RevRules.Rules (rules_file, src_dir)
+        space_budget = None
+        if budget != None:
+            space_budget = SpaceBudget (src_dir, budget, evict_policy)
+        chunk_store.open (os.path.join (src_dir, revision_store_name))
+        if copy_strategy == None:
+            copy_engine.detect (src_dir)
+        else:
+            copy_engine.strategy = copy_strategy
+            logging.info ("Using %s to create revision copies in %s", copy_strategy, src_dir)
+        self.file_handles = HandleTable ()
         self.files = {}
+        # content of the statistics files as last seen by getattr
+        self.stats_data = {}
+
+    def __call__ (self, op, *args):
+        start = time.perf_counter_ns ()
+        try:
+            if len (args) > 0 and args[0] in stats_names:
+                res = self.statsCall (op, *args)
+            elif tracer == None:
+                res = super ().__call__ (op, *args)
+            else:
+                res = tracer.call (super ().__call__, op, args)
+        except OSError:
+            stats.addCall (op, time.perf_counter_ns () - start, True)
+            raise
+
+        stats.addCall (op, time.perf_counter_ns () - start)
+        return res
+
+    def statsCall (self, op, path, *args):
+        '''
+        Serves the hidden read only files with the statistics. Their content
+        is taken by getattr, so the size the kernel knows and the content
+        read after open match.
+        '''
+        if op == 'getattr':
+            if path == stats_json_name:
+                data = stats.toJSON ().encode ('ASCII')
+            else:
+                data = stats.toText ().encode ('ASCII')
+            self.stats_data[path] = data
+            now = time.time ()
+            return dict (st_mode=stat.S_IFREG | 0o444, st_nlink=1, st_ino=0, st_uid=os.getuid (), st_gid=os.getgid (),
+                         st_size=len (data), st_atime=now, st_mtime=now, st_ctime=now)
+
+        if op == 'open':
+            if (args[0] & os.O_ACCMODE) != os.O_RDONLY:
+                raise fuse.FuseOSError (errno.EACCES)
+            if path not in self.stats_data:
+                self.statsCall ('getattr', path)
+            return self.file_handles.add (StatsFile (self.stats_data[path]))
+
+        if op == 'read':
+            (size, offset, fh) = args
+            f = self.file_handles.get (fh)
+            if f == None:
+                raise fuse.FuseOSError (errno.EIO)
+            return f.data[offset:offset+size]
+
+        if op == 'release':
+            f = self.file_handles.get (args[0])
+            if f != None:
+                self.file_handles.remove (args[0], f)
+            return 0
+
+        if op in ('access', 'flush'):
+            return 0
+        if op == 'listxattr':
+            return []
+        if op == 'getxattr':
+            raise fuse.FuseOSError (errno.ENODATA)
+
+        raise fuse.FuseOSError (errno.EACCES)
         
     def getSource (self, path):
+        rel_path = path.strip ('/')
+        if revision_prefix not in rel_path:
+            # nothing to escape, the usual case
+            if rel_path == '':
+                return self.src_dir
+            return os.path.join (self.src_dir, rel_path)
+
         parts = []
         dir = path.lstrip ('/')
         while path != '':
@@ -332,34 +1980,208 @@ class RevisionFS (fuse.Operations):
             src_path = os.path.join (src_path, part)
         return src_path
 
-    def copyOnWrite (self, file, use_rename=False):
-        file_info = FileInfo ()
-        if file.src_path in self.files:
-            file_info = self.files[file.src_path]
-            if not file_info.copy_on_write:
-                return
-            
+    def copyOnWrite (self, file, use_rename=False, delta=False, replace_handles=None, append_at=None):
+        '''
+        Creates the revision before the first change of file. replace_handles
+        is set by callers that truncate the file to 0 and hold that many of
+        its handles, then the file itself can become the revision, see
+        canReplace. append_at is the offset of the first change, see
+        createRevisionCopy.
+        '''
+        file_info = self.files.get (file.src_path)
+        if file_info != None and not file_info.copy_on_write and not use_rename:
+            return file_info
+
+        if rules != None and not file.is_dir and rules.isExcluded (file.src_path):
+            return self.skipRevision (file, use_rename)
+
+        if file_info != None and not file_info.copy_on_write:
+            return file_info
+
+        # time the writer waits for the revision, also for another thread
+        start = time.perf_counter_ns ()
+        try:
+            with path_locks.locked (file.src_path):
+                file_info = self.files.get (file.src_path)
+                if file_info == None:
+                    file_info = FileInfo ()
+                    file_info.loadFileInfo (file.src_path)
+                elif not file_info.copy_on_write:
+                    # another thread created the revision in the meantime
+                    return file_info
+
+                if not use_rename and recent_revisions.isRecent (file.src_path):
+                    # still part of the newest revision
+                    file_info.copy_on_write = False
+                    stats.add ('revisions_coalesced')
+                    try:
+                        stats.add ('revision_bytes_not_copied', os.lstat (file.src_path).st_size)
+                    except FileNotFoundError:
+                        pass
+                    return file_info
+
+                try:
+                    with CatalogTransaction ():
+                        if replace_handles != None and self.canReplace (file, file_info, replace_handles):
+                            file.replaceByEmpty (file_info)
+                        else:
+                            file.createRevisionCopy (file_info, use_rename, delta, append_at)
+                finally:
+                    # writes of other threads wait until the revision exists
+                    file_info.copy_on_write = False
+
+                recent_revisions.add (file.src_path, file_info.coalesce)
+                file.compressRevisions ()
+                self.scheduler.update (file.src_path, file_info)
+        finally:
+            stats.add ('copy_on_write_wait_us', (time.perf_counter_ns () - start) // 1000)
+
+        return file_info
+
+    def skipRevision (self, file, use_rename):
+        '''
+        For files excluded by the rules: nothing is copied and no policy is
+        looked up, with use_rename the file is simply deleted.
+        '''
+        with path_locks.locked (file.src_path):
+            file_info = self.files.get (file.src_path)
+            if file_info == None:
+                file_info = FileInfo ()
+            elif not file_info.copy_on_write and not use_rename:
+                return file_info
             file_info.copy_on_write = False
-        else:
-            file_info.loadFileInfo (file.src_path)
-            
-        file.createRevisionCopy (file_info, use_rename)
+
+            try:
+                sr = os.lstat (file.src_path)
+            except FileNotFoundError:
+                return file_info
+
+            stats.add ('revisions_excluded')
+            if stat.S_ISREG (sr.st_mode):
+                stats.add ('revision_bytes_excluded', sr.st_size)
+            if use_rename:
+                os.unlink (file.src_path)
+                attr_cache.invalidate (file.src_path)
+
+        return file_info
+
+    def canReplace (self, file, file_info, own_handles):
+        '''
+        Whether the content of file can be moved into the revision as a
+        whole instead of being copied. Not for other hard links or handles,
+        which would then see the revision, and not for dedup storage.
+        '''
+        if file_info.storage == storage_dedup or file_info.handles > own_handles:
+            return False
+
+        try:
+            sr = os.lstat (file.src_path)
+        except FileNotFoundError:
+            return False
+
+        return stat.S_ISREG (sr.st_mode) and sr.st_nlink == 1
+
+    def getPolicy (self, src_path, is_dir):
+        '''
+        Returns the FileInfo of the open file src_path or a new one with its
+        policy. For a directory the policy of the tree below it.
+        '''
+        if not is_dir and src_path in self.files:
+            return self.files[src_path]
+
+        file_info = FileInfo ()
+        file_info.loadFileInfo (src_path, is_dir)
+        return file_info
+
+    def savePolicy (self, src_path, is_dir, file_info):
+        file_info.saveFileInfo (src_path, is_dir)
+        self.applyPolicy (src_path, is_dir, file_info)
+
+    def applyPolicy (self, src_path, is_dir, file_info):
+        'Called after the policy of src_path was changed.'
+        if not is_dir:
+            self.scheduler.update (src_path, file_info)
+            return
+
+        # open files below the directory follow the new policy at once, the
+        # others when they are opened or scanned again
+        prefix = os.path.join (src_path, '')
+        for (path, open_info) in list (self.files.items ()):
+            if path.startswith (prefix):
+                open_info.loadFileInfo (path)
+        self.scheduler.rescan (src_path)
+
+    def limitRevisions (self, src_path, is_dir, file_info):
+        '''
+        Deletes the revisions of src_path that a stricter policy does not
+        allow. For a directory the scheduler does this in the background.
+        '''
+        if not is_dir:
+            File (src_path, False).limitRevisions (file_info)
         
+    def restoreRevision (self, src_path, value):
+        try:
+            revision = int (value)
+        except ValueError:
+            raise fuse.FuseOSError (errno.EINVAL)
+
+        with path_locks.locked (src_path):
+            if src_path in self.files:
+                raise fuse.FuseOSError (errno.EBUSY)
+
+            f = File (src_path, False)
+            ids = f.getRevisionIds ()
+            if revision < 1 or revision > len (ids):
+                raise fuse.FuseOSError (errno.EINVAL)
+
+            logging.info ("restore revision %d of %s", revision, src_path)
+            tmp_name = f.createTempName ()
+            try:
+                f.materializeRevision (ids[revision-1], tmp_name)
+                if os.path.lexists (src_path):
+                    self.copyOnWrite (f, use_rename=True)
+                os.rename (tmp_name, src_path)
+                attr_cache.invalidateName (src_path)
+            except:
+                if os.path.lexists (tmp_name):
+                    os.unlink (tmp_name)
+                raise
+
     def createFileHandle (self, file):
-        if file.src_path not in self.files:
-            #logging.debug ("add file %s to copy on write list", file.src_path)
-            self.files[file.src_path] = FileInfo ()
-            self.files[file.src_path].loadFileInfo (file.src_path)
-            
-        free_fh = 0
-        while free_fh in self.file_handles:
-            free_fh += 1
-            
-        self.file_handles[free_fh] = file
-        return (free_fh, file)
+        with path_locks.locked (file.src_path):
+            file_info = self.files.get (file.src_path)
+            if file_info == None:
+                #logging.debug ("add file %s to copy on write list", file.src_path)
+                file_info = FileInfo ()
+                file_info.loadFileInfo (file.src_path)
+                self.files[file.src_path] = file_info
+
+            file_info.handles += 1
+            fh = self.file_handles.add (file)
+
+        return (fh, file)
+
+    def releaseFileHandle (self, fh):
+        file = self.file_handles.get (fh)
+        if file == None:
+            return
+
+        with path_locks.locked (file.src_path):
+            if not self.file_handles.remove (fh, file):
+                # released by another thread in the meantime
+                return
+
+            file_info = self.files[file.src_path]
+            file_info.handles -= 1
+            if file_info.handles == 0:
+                #logging.debug ("remove file %s from copy on write list", file.src_path)
+                del self.files[file.src_path]
+                file_info.closeDelta ()
+
+        file.close ()
     
     def access(self, path, amode):
-        logging.debug ("access: %s", repr ((path, amode)))
+        logging.debug ("access: %r", (path, amode))
         src_path = self.getSource (path)
         
         if not os.path.lexists (src_path):
@@ -373,22 +2195,24 @@ class RevisionFS (fuse.Operations):
     bmap = None
 
     def chmod(self, path, mode):
-        logging.debug ("chmod: %s", repr ((path, mode)))
+        logging.debug ("chmod: %r", (path, mode))
         src_path = self.getSource (path)
         
         if not os.path.lexists (src_path):
             raise fuse.FuseOSError (errno.ENOENT)
         
         os.chmod (src_path, mode)
+        attr_cache.invalidate (src_path)
 
     def chown(self, path, uid, gid):
-        logging.debug ("chown: %s", repr ((path, uid, gid)))
+        logging.debug ("chown: %r", (path, uid, gid))
         src_path = self.getSource (path)
         
         if not os.path.lexists (src_path):
             raise fuse.FuseOSError (errno.ENOENT)
         
         os.chown (src_path, uid, gid)
+        attr_cache.invalidate (src_path)
 
     def create(self, path, mode, fi=None):
         '''
@@ -400,36 +2224,49 @@ class RevisionFS (fuse.Operations):
         '''
 
         (fh, file) = self.createFileHandle (File (self.getSource (path), False, os.O_CREAT | os.O_WRONLY | os.O_TRUNC))
-        self.copyOnWrite (file)
+        file_info = self.copyOnWrite (file, replace_handles=1)
+        if file_info.delta != None:
+            file_info.delta.truncate (0)
         file.open (mode)
+        attr_cache.invalidateName (file.src_path)
         return fh
 
     def destroy(self, path):
         'Called on filesystem destruction. Path is always /'
 
         #logging.debug ("destroy: %s", repr (path))
-        logging.info ("Unmount %s", repr (self.src_dir))
+        logging.info ("Unmount %r", self.src_dir)
+        self.scheduler.stop ()
+        if space_budget != None:
+            space_budget.stop ()
+        copy_engine.shutdown ()
+        compressor.shutdown ()
+        chunk_store.close ()
+        if catalog != None:
+            catalog.close ()
 
     def flush(self, path, fh):
-        logging.debug ("flush: %s", repr ((path, fh)))
-        
-        if fh not in self.file_handles:
-            raise fuse.FuseOSError (errno.ENOENT)
-        
-        f = self.file_handles[fh]
+        logging.debug ("flush: %r", (path, fh))
         
-        if f.file == None:
+        f = self.file_handles.get (fh)
+        if f == None or f.fd == None:
             raise fuse.FuseOSError (errno.ENOENT)
 
-        f.file.flush ()
+        # writes go directly to the file, there is no buffer to flush
         return 0
 
     def fsync(self, path, datasync, fh):
-        logging.warning ("fsync: %s - not implemented", repr ((path, datasync, fh)))
+        logging.debug ("fsync: %r", (path, datasync, fh))
+        f = self.file_handles.get (fh)
+        if f != None:
+            # the revision has to be complete before the changes are durable
+            file_info = self.files.get (f.src_path)
+            if file_info != None and isinstance (file_info.delta, RevCopy.BackgroundCopy):
+                file_info.delta.wait ()
         return 0
 
     def fsyncdir(self, path, datasync, fh):
-        logging.warning ("fsyncdir: %s - not implemented", repr ((path, datasync, fh)))
+        logging.warning ("fsyncdir: %r - not implemented", (path, datasync, fh))
         return 0
 
     def getattr(self, path, fh=None):
@@ -443,11 +2280,26 @@ class RevisionFS (fuse.Operations):
         concerning st_nlink of directories. Mac OS X counts all files inside
         the directory, while Linux counts only the subdirectories.
         '''
-        logging.debug ("getattr: %s", repr ((path, fh)))
+        logging.debug ("getattr: %r", (path, fh))
         
         src_path = self.getSource (path)
         #logging.debug ("  src_path: %s", repr (src_path))
 
+        res = attr_cache.get (src_path)
+        if res == None:
+            stats.add ('attr_cache_misses')
+            generation = attr_cache.generation
+            res = self.readAttributes (src_path)
+            attr_cache.put (src_path, res, generation)
+
+        if res is AttrCache.missing:
+            raise fuse.FuseOSError (errno.ENOENT)
+
+        if isinstance (res, os.stat_result):
+            return StatToAttrs (res)
+        return res
+
+    def readAttributes (self, src_path):
         if not os.path.lexists (src_path):
             #logging.debug ("  path %s missing", src_path)
             f = File (src_path, False)
@@ -458,53 +2310,48 @@ class RevisionFS (fuse.Operations):
                             st_size=0, st_atime=0, st_mtime=0, st_ctime=0)
                 return res
             
-            raise fuse.FuseOSError (errno.ENOENT)
+            return AttrCache.missing
         
         #r = os.stat (src_path, follow_symlinks=False)
         try:
             r = os.lstat (src_path)
-        except IOError as e:
-            #logging.debug ("  exception: %s", repr (e))
-            raise e
+        except FileNotFoundError:
+            return AttrCache.missing
         
         #logging.debug ("  result: %s", repr (r))
-        res = dict (st_mode=r.st_mode, st_nlink=r.st_nlink, st_ino=r.st_ino, st_dev=r.st_dev, st_uid=r.st_uid, st_gid=r.st_gid,
-                    st_size=r.st_size, st_atime=r.st_atime, st_mtime=r.st_mtime, st_ctime=r.st_ctime)
-        try:
-            res["st_blocks"] = r.st_blocks
-        except:
-            res["st_blocks"] = (r.st_size + 511) / 512
-
-        try:
-            res["st_blksize"] = r.st_blksize
-        except:
-            res["st_blksize"] = 512
-            
-        #logging.debug ("  result: %s", repr (res))
-        
-        return res
+        return r
 
     def getxattr(self, path, name, position=0):
-        logging.debug ("getxattr: %s", repr ((path, name, position)))
+        logging.debug ("getxattr: %r", (path, name, position))
         src_path = self.getSource (path)
 
+        if name == xattr_space_name and path == '/':
+            if space_budget == None:
+                raise fuse.FuseOSError (errno.ENODATA)
+            return json.dumps (space_budget.getUsage (), separators=(',', ':')).encode ('ASCII')
+
         if name == xattr_revisions_name:
             f = File (src_path, is_dir=False)
             revisions = f.getAvailableRevisions ()
             res = []
             revisions.sort ()
-            for rev in revisions:
-                fn = f.getRevisionName (rev)
-                sr = os.stat (fn, follow_symlinks=False)
-                res.append ("({0},{1},{2})".format (rev, str (datetime.datetime.fromtimestamp (sr.st_mtime)), sr.st_size).encode ('ASCII'))
+            rev_infos = revision_index.getRevisions (src_path)
+            for (rev, rev_id) in zip (revisions, f.getRevisionIds ()):
+                (mtime, size, kind, stored) = rev_infos[rev_id]
+                res.append ("({0},{1},{2})".format (rev, str (datetime.datetime.fromtimestamp (mtime)), size).encode ('ASCII'))
 
             return b",".join (res)
 
-        file_info = FileInfo ()
-        if src_path in self.files:
-            file_info = self.files
-        else:
-            file_info.loadFileInfo (src_path)
+        if name == xattr_revisions_stored_name:
+            f = File (src_path, is_dir=False)
+            rev_infos = revision_index.getRevisions (src_path)
+            res = []
+            for (rev, rev_id) in enumerate (f.getRevisionIds (), 1):
+                res.append ("({0},{1})".format (rev, rev_infos[rev_id][3]).encode ('ASCII'))
+
+            return b",".join (res)
+
+        file_info = self.getPolicy (src_path, not os.path.islink (src_path) and os.path.isdir (src_path))
                 
         if name == xattr_max_revisions_name:
             #logging.debug ("  result: %s", repr (bytes (str (file_info.revisions), "ASCII")))
@@ -516,6 +2363,25 @@ class RevisionFS (fuse.Operations):
         if name == xattr_min_revisions_age:
             return bytes (str (file_info.min_revisions), "ASCII")
         
+        if name == xattr_storage_name:
+            return bytes (file_info.storage, "ASCII")
+
+        if name == xattr_coalesce_name:
+            return bytes (str (file_info.coalesce), "ASCII")
+
+        if name == xattr_info_name:
+            # settings and revisions in one call, see RevFS.ParseInfo
+            rev_infos = revision_index.getRevisions (src_path)
+            revisions = []
+            for (rev, rev_id) in enumerate (sorted (rev_infos, reverse=True), 1):
+                (mtime, size, kind, stored) = rev_infos[rev_id]
+                revisions.append ((rev, mtime, size, stored))
+
+            info = {'max_revisions': file_info.revisions, 'max_age': file_info.max_age,
+                    'min_revisions': file_info.min_revisions, 'storage': file_info.storage,
+                    'coalesce': file_info.coalesce, 'revisions': revisions}
+            return json.dumps (info, separators=(',', ':')).encode ('ASCII')
+        
         res = os.getxattr (src_path, name, follow_symlinks=False)
         #logging.debug ("  result: %s", repr (res))
         return res
@@ -527,17 +2393,24 @@ class RevisionFS (fuse.Operations):
         Use it instead of __init__ if you start threads on initialization.
         '''
 
-        logging.debug ("init: %s", repr (path))
-        pass
+        logging.debug ("init: %r", path)
+        self.scheduler.start ()
+        if space_budget != None:
+            space_budget.start ()
+        stats.startLogging (stats_interval)
 
     def link(self, target, source):
         'creates a hard link `target -> source` (e.g. ln source target)'
 
-        logging.debug ("link: %s", repr ((target, source)))
-        os.link (self.getSource (source), self.getSource (target))
+        logging.debug ("link: %r", (target, source))
+        src_source = self.getSource (source)
+        src_target = self.getSource (target)
+        os.link (src_source, src_target)
+        # the link count of the source changes as well
+        attr_cache.invalidateName (src_target, src_source)
 
     def listxattr(self, path):
-        logging.debug ("listxattr: %s", repr (path))
+        logging.debug ("listxattr: %r", path)
         src_path = self.getSource (path)
         
         res = []
@@ -553,21 +2426,25 @@ class RevisionFS (fuse.Operations):
             
         res.append (xattr_revisions_name)
         res.append (xattr_max_revisions_name)
+        res.append (xattr_info_name)
+        if path == '/' and space_budget != None:
+            res.append (xattr_space_name)
         #logging.debug ("  result: %s", repr (res))
         return res
 
     lock = None
 
     def mkdir(self, path, mode):
-        logging.debug ("mkdir: %s", repr ((path, mode)))
+        logging.debug ("mkdir: %r", (path, mode))
         src_path = self.getSource (path)
         if os.path.lexists (src_path):
             raise fuse.FuseOSError (errno.EEXIST)
 
         os.mkdir (src_path, mode)
+        attr_cache.invalidateName (src_path)
 
     def mknod(self, path, mode, dev):
-        logging.warning ("mknod: %s - not implemented", repr ((path, mode, dev)))
+        logging.warning ("mknod: %r - not implemented", (path, mode, dev))
         raise fuse.FuseOSError(errno.ENOSYS)
 
     def open(self, path, flags):
@@ -581,146 +2458,109 @@ class RevisionFS (fuse.Operations):
         and the file handle should be set directly.
         '''
 
-        logging.debug ("open: %s", repr ((path, flags)))
+        logging.debug ("open: %r", (path, flags))
         
         (fh, file) = self.createFileHandle (File (self.getSource (path), False, flags))
         if (flags & os.O_TRUNC) == os.O_TRUNC:
-            self.copyOnWrite (file)
+            file_info = self.copyOnWrite (file, replace_handles=1)
+            if file_info.delta != None:
+                file_info.delta.truncate (0)
         file.open ()
+        if (flags & (os.O_TRUNC | os.O_CREAT)) != 0:
+            attr_cache.invalidateName (file.src_path)
         return fh
 
     def opendir(self, path):
         'Returns a numerical file handle.'
 
-        logging.debug ("opendir: %s", repr (path))
+        logging.debug ("opendir: %r", path)
         (fh, file) = self.createFileHandle (File (self.getSource (path), True))
         return fh
 
     def read(self, path, size, offset, fh):
         'Returns a string containing the data requested.'
 
-        logging.debug ("read: %s", repr ((path, size, offset, fh)))
+        logging.debug ("read: %r", (path, size, offset, fh))
 
-        if fh not in self.file_handles:
+        f = self.file_handles.get (fh)
+        if f == None:
             raise fuse.FuseOSError(errno.EIO)
 
-        return self.file_handles[fh].read (size, offset)
+        return f.read (size, offset)
 
-    def readdir(self, path, fh):
+    def readdir(self, path, fh, offset = 0):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
-        tuples. attrs is a dict as in getattr.
+        tuples. attrs is a dict as in getattr. RevisionFUSE passes the offset
+        of the last entry the kernel used.
         '''
 
-        logging.debug ("readdir: %s", repr ((path, fh)))
+        logging.debug ("readdir: %r", (path, fh, offset))
 
-        if fh not in self.file_handles:
+        f = self.file_handles.get (fh)
+        if f == None or not f.is_dir:
             raise fuse.FuseOSError(errno.EIO)
         
-        return self.file_handles[fh].readdir ()
+        return f.readdir (offset)
         
     def readlink(self, path):
-        logging.debug ("readlink: %s", repr (path))
+        logging.debug ("readlink: %r", path)
         return os.readlink (self.getSource (path))
 
     def release(self, path, fh):
-        logging.debug ("release: %s", repr ((path, fh)))
-        if fh in self.file_handles:
-            file = self.file_handles[fh]
-            found_other = False
-            for f2 in self.file_handles:
-                if f2 != fh and self.file_handles[f2].src_path == file.src_path:
-                    found_other = True
-                    break
-                
-            if not found_other:
-                #logging.debug ("remove file %s from copy on write list", file.src_path)
-                del self.files[file.src_path]
-
-            file.close ()
-            del self.file_handles[fh]
-
+        logging.debug ("release: %r", (path, fh))
+        self.releaseFileHandle (fh)
         return 0
 
     def releasedir(self, path, fh):
-        logging.debug ("releasedir: %s", repr ((path, fh)))
-        if fh in self.file_handles:
-            file = self.file_handles[fh]
-            found_other = False
-            for f2 in self.file_handles:
-                if f2 != fh and self.file_handles[f2].src_path == file.src_path:
-                    found_other = True
-                    break
-                
-            if not found_other:
-                del self.files[file.src_path]
-
-            file.close ()
-            del self.file_handles[fh]
-
+        logging.debug ("releasedir: %r", (path, fh))
+        self.releaseFileHandle (fh)
         return 0
 
     def removexattr(self, path, name):
-        logging.debug ("removexattr: %s", repr ((path, name)))
+        logging.debug ("removexattr: %r", (path, name))
         src_path = self.getSource (path)
         
-        if name == xattr_revisions_name:
+        if name in (xattr_revisions_name, xattr_revisions_stored_name, xattr_space_name):
             raise (fuse.FuseOSError (errno.EACCES))
 
-        file_info = FileInfo ()
-        if src_path in self.files:
-            file_info = self.files
-        else:
-            file_info.loadFileInfo (src_path)
-            
-        if name == xattr_max_revisions_name:
-            if file_info.revisions != max_revisions:
-                if max_revisions < file_info.revisions:
-                    file_info.setMaxRevisions (revisions)
-                    f = File (src_path, os.path.isdir (src_path, follow_symlinks=False))
-                    f.limitRevisions (file_info)
-                else:
-                    file_info.setMaxRevisions (revisions)
-                        
-                file_info.saveFileInfo (src_path)
-            return
-
-        if name == xattr_max_revision_age:
-            if file_info.max_age != max_revision_age:
-                if max_revision_age < file_info.max_age:
-                    file_info.setMaxRevisionAge (max_revision_age)
-                    f = File (src_path, os.path.isdir (src_path, follow_symlinks=False))
-                    f.limitRevisions (file_info)
-                else:
-                    file_info.setMaxRevisionAge (max_revision_age)
-
-                file_info.saveFileInfo (src_path)
-            return
-
-        if name == xattr_min_revisions_age:
-            if file_info.min_revisions != min_revisions_age:
-                if min_revisions_age < file_info.min_revisions:
-                    file_info.setMinRevisionsAge (min_revisions_age)
-                    f = File (src_path, os.path.isdir (src_path, follow_symlinks=False))
-                    f.limitRevisions (file_info)
-                else:
-                    file_info.setMinRevisionsAge (min_revisions_age)
-                    
-                file_info.saveFileInfo (src_path)
-            return
+        src_is_dir = not os.path.islink (src_path) and os.path.isdir (src_path)
+        with path_locks.locked (src_path):
+            file_info = self.getPolicy (src_path, src_is_dir)
+
+            keyword = policy_xattr_keywords.get (name)
+            if keyword != None:
+                # the setting is inherited again
+                (revisions, max_age, min_revisions) = (file_info.revisions, file_info.max_age, file_info.min_revisions)
+                file_info.removeSetting (src_path, keyword, src_is_dir)
+                if file_info.revisions < revisions or file_info.max_age < max_age or file_info.min_revisions < min_revisions:
+                    self.limitRevisions (src_path, src_is_dir, file_info)
+                self.applyPolicy (src_path, src_is_dir, file_info)
+                return
 
-        os.removexattr (src_path, name, follow_symlinks=False)
+            os.removexattr (src_path, name, follow_symlinks=False)
+            attr_cache.invalidate (src_path)
 
     def rename(self, old, new):
-        logging.debug ("rename: %s", repr ((old, new)))
+        logging.debug ("rename: %r", (old, new))
         src_new = self.getSource (new)
-        if os.path.lexists (src_new):
-            self.copyOnWrite (File (src_new, is_dir=not os.path.islink (src_new) and os.path.isdir (src_new)), use_rename = True)
-            
-        os.rename (self.getSource (old), src_new)
+        src_old = self.getSource (old)
+        with path_locks.locked (src_old, src_new):
+            File (src_old, False).detachRevisions ()
+            if os.path.lexists (src_new):
+                self.copyOnWrite (File (src_new, is_dir=not os.path.islink (src_new) and os.path.isdir (src_new)), use_rename = True)
+
+            os.rename (src_old, src_new)
+            revision_index.moveTree (src_old, src_new)
+            attr_cache.invalidateName (src_old, src_new)
+            if not os.path.islink (src_new) and os.path.isdir (src_new):
+                attr_cache.invalidateTree (src_old)
+                attr_cache.invalidateTree (src_new)
+                policy_cache.invalidateTree (src_old)
+                policy_cache.invalidateTree (src_new)
 
     def rmdir(self, path):
-        logging.debug ("rmdir: %s", repr (path))
+        logging.debug ("rmdir: %r", path)
 
         src_path = self.getSource (path)
         
@@ -739,73 +2579,98 @@ class RevisionFS (fuse.Operations):
         f = File (src_path, True)
         self.copyOnWrite (f, use_rename=True)
         #os.rmdir (src_path)
+        attr_cache.invalidateName (src_path)
+        attr_cache.invalidateTree (src_path)
+        policy_cache.invalidateTree (src_path)
 
     def setxattr(self, path, name, value, options, position=0):
-        logging.debug ("setxattr: %s", repr ((path, name, value, options, position)))
+        logging.debug ("setxattr: %r", (path, name, value, options, position))
         src_path = self.getSource (path)
         
-        if name == xattr_revisions_name:
+        if name in (xattr_revisions_name, xattr_revisions_stored_name, xattr_space_name):
             raise fuse.FuseOSError (errno.EACCES)
 
-        v = 0
-        try:
-            v = int (value)
-        except ValueError:
-            raise fuse.FuseOSError (errno.EINVAL)
-        
-        file_info = FileInfo ()
-        if src_path in self.files:
-            file_info = self.files
-        else:
-            file_info.loadFileInfo (src_path)
-        
+        if name == xattr_restore_name:
+            self.restoreRevision (src_path, value)
+            return
+
         src_is_dir = not os.path.islink (src_path) and os.path.isdir (src_path)
-        if name == xattr_max_revisions_name:
-            if file_info.revisions != v:
-                logging.debug ("  changing number of revisions for %s from %d to %d", repr (path), file_info.revisions, v)                    
+        with path_locks.locked (src_path):
+            file_info = self.getPolicy (src_path, src_is_dir)
 
-                if v < file_info.revisions:
-                    file_info.setMaxRevisions (v)
-                    f = File (src_path, src_is_dir)
-                    f.limitRevisions (file_info)
-                else:
-                    file_info.setMaxRevisions (v)
+            if name == xattr_storage_name:
+                storage = value.decode ('ASCII', errors='replace')
+                if storage not in storage_modes:
+                    raise fuse.FuseOSError (errno.EINVAL)
 
-                file_info.saveFileInfo (src_path)
-                
-            return
+                if file_info.storage != storage:
+                    logging.debug ("  changing revision storage for %r from %s to %s", path, file_info.storage, storage)
+                    file_info.setStorage (storage)
+                    self.savePolicy (src_path, src_is_dir, file_info)
 
-        if name == xattr_max_revision_age:
-            if file_info.max_age != v:
-                logging.debug ("  changing maximal revision age for %s from %d to %d days", repr (path), file_info.max_age, v)                    
-
-                if v < file_info.max_age:
-                    file_info.setMaxRevisionAge (v)
-                    f = File (src_path, src_is_dir)
-                    f.limitRevisions (file_info)
-                else:
-                    file_info.setMaxRevisionAge (v)
-                    
-                file_info.saveFileInfo (src_path)
-                
-            return
+                return
 
-        if name == xattr_min_revisions_age:
-            if file_info.min_revisions != v:
-                logging.debug ("  changing minimal number of revisions for %s from %d to %d", repr (path), file_info.min_revisions, v)                    
+            v = 0
+            try:
+                v = int (value)
+            except ValueError:
+                raise fuse.FuseOSError (errno.EINVAL)
 
-                if v < file_info.min_revisions:
-                    file_info.setMinRevisionsAge (v)
-                    f = File (src_path, src_is_dir)
-                    f.limitRevisions (file_info)
-                else:
-                    file_info.setMinRevisionsAge (v)
+            if name == xattr_max_revisions_name:
+                if file_info.revisions != v:
+                    logging.debug ("  changing number of revisions for %r from %d to %d", path, file_info.revisions, v)                    
 
-                file_info.saveFileInfo (src_path)
-                
-            return
+                    if v < file_info.revisions:
+                        file_info.setMaxRevisions (v)
+                        self.limitRevisions (src_path, src_is_dir, file_info)
+                    else:
+                        file_info.setMaxRevisions (v)
+
+                    self.savePolicy (src_path, src_is_dir, file_info)
 
-        os.setxattr (src_path, name, value, options, follow_symlinks=False)
+                return
+
+            if name == xattr_max_revision_age:
+                if file_info.max_age != v:
+                    logging.debug ("  changing maximal revision age for %r from %d to %d days", path, file_info.max_age, v)                    
+
+                    if v < file_info.max_age:
+                        file_info.setMaxRevisionAge (v)
+                        self.limitRevisions (src_path, src_is_dir, file_info)
+                    else:
+                        file_info.setMaxRevisionAge (v)
+
+                    self.savePolicy (src_path, src_is_dir, file_info)
+
+                return
+
+            if name == xattr_min_revisions_age:
+                if file_info.min_revisions != v:
+                    logging.debug ("  changing minimal number of revisions for %r from %d to %d", path, file_info.min_revisions, v)                    
+
+                    if v < file_info.min_revisions:
+                        file_info.setMinRevisionsAge (v)
+                        self.limitRevisions (src_path, src_is_dir, file_info)
+                    else:
+                        file_info.setMinRevisionsAge (v)
+
+                    self.savePolicy (src_path, src_is_dir, file_info)
+
+                return
+
+            if name == xattr_coalesce_name:
+                if v < 0:
+                    raise fuse.FuseOSError (errno.EINVAL)
+
+                if file_info.coalesce != v:
+                    logging.debug ("  changing coalescing window for %r from %d to %d seconds", path, file_info.coalesce, v)
+                    file_info.setCoalesce (v)
+                    self.savePolicy (src_path, src_is_dir, file_info)
+
+                return
+
+            os.setxattr (src_path, name, value, options, follow_symlinks=False)
+            attr_cache.invalidate (src_path)
 
     def statfs(self, path):
         '''
@@ -816,7 +2681,7 @@ class RevisionFS (fuse.Operations):
         (minimum 512).
         '''
 
-        logging.debug ("statfs: %s", repr (path))
+        logging.debug ("statfs: %r", path)
         r = os.statvfs (self.getSource (path))
         #logging.debug ("  result: %s", repr (r))
         return {"f_bsize"  : r.f_bsize,    # Filesystem block size
@@ -833,13 +2698,17 @@ class RevisionFS (fuse.Operations):
     def symlink(self, target, source):
         'creates a symlink `target -> source` (e.g. ln -s source target)'
 
-        logging.debug ("symlink: %s", repr ((target, source)))
-        os.symlink (source, self.getSource (target))
+        logging.debug ("symlink: %r", (target, source))
+        src_target = self.getSource (target)
+        os.symlink (source, src_target)
+        attr_cache.invalidateName (src_target)
 
     def truncate(self, path, length, fh=None):
-        logging.debug ("truncate: %s", repr ((path, length, fh)))
+        logging.debug ("truncate: %r", (path, length, fh))
         
         f = None
+        # handles held by this call, for truncating by rename
+        own_handles = 0
         
         if fh == None:
             #print ("  closed file")
@@ -854,19 +2723,29 @@ class RevisionFS (fuse.Operations):
             f = File (src_path, False)
         else:
             #print ("  file handle ", fh)
-            if fh not in self.file_handles:
+            f = self.file_handles.get (fh)
+            if f == None:
                 raise fuse.FuseOSError (errno.ENOENT)
             
-            f = self.file[fh]
             if f.is_dir:
                 raise fuse.FuseOSError (errno.EISDIR)
+            own_handles = 1
         
-        self.copyOnWrite (f)
-        #print ("truncate file ", repr (f.src_path))
-        os.truncate (f.src_path, length)
+        with path_locks.locked (f.src_path):
+            if length == 0:
+                file_info = self.copyOnWrite (f, delta=True, replace_handles=own_handles)
+            else:
+                file_info = self.copyOnWrite (f, delta=True, append_at=length)
+            if file_info.delta != None:
+                file_info.delta.truncate (length)
+                if f.src_path not in self.files:
+                    file_info.closeDelta ()
+            #print ("truncate file ", repr (f.src_path))
+            os.truncate (f.src_path, length)
+            attr_cache.invalidate (f.src_path)
 
     def unlink(self, path):
-        logging.debug ("unlink: %s", repr (path))
+        logging.debug ("unlink: %r", path)
         src_path = self.getSource (path)
         
         if not os.path.lexists (src_path):
@@ -878,31 +2757,58 @@ class RevisionFS (fuse.Operations):
         f = File (src_path, False)
         self.copyOnWrite (f, use_rename=True)
         #os.unlink (src_path, follow_symlinks=False)
+        attr_cache.invalidateName (src_path)
         
     def utimens(self, path, times=None):
         'Times is a (atime, mtime) tuple. If None use current time.'
 
-        logging.debug ("utimens: %s", repr ((path, times)))
+        logging.debug ("utimens: %r", (path, times))
+        src_path = self.getSource (path)
         if times == None: 
-            os.utime (self.getSource (path))
+            os.utime (src_path)
         else:
             (atime, mtime) = times
-            os.utime (self.getSource (path), (atime, mtime), follow_symlinks=False)
+            os.utime (src_path, (atime, mtime), follow_symlinks=False)
+        attr_cache.invalidate (src_path)
         return 0
 
     def write(self, path, data, offset, fh):
-        logging.debug ("write: %s", repr ((path, data, offset, fh)))
+        logging.debug ("write: %r", (path, len (data), offset, fh))
 
-        if fh not in self.file_handles:
+        f = self.file_handles.get (fh)
+        if f == None:
             raise fuse.FuseOSError(errno.EIO)
 
-        f = self.file_handles[fh]
-        
-        self.copyOnWrite (f)
+        file_info = self.copyOnWrite (f, delta=True, append_at=offset)
+        if file_info.delta != None:
+            file_info.delta.saveRange (offset, len (data))
 
-        return f.write (data, offset)
+        res = f.write (data, offset)
+        attr_cache.invalidate (f.src_path)
+        return res
+
+class RevisionFUSE (fuse.FUSE):
+    '''
+    fusepy does not pass the offset of FUSE_READDIR to readdir, so a listing
+    that did not fit into the buffer of the caller could not be continued
+    at the right entry.
+    '''
+    def readdir (self, path, buf, filler, offset, fip):
+        for (name, attrs, entry_offset) in self.operations ('readdir', self._decode_optional_path (path),
+                                                             fip.contents.fh, offset):
+            st = None
+            if attrs:
+                st = fuse.c_stat ()
+                fuse.set_st_attrs (st, attrs, use_ns=self.use_ns)
+
+            if filler (buf, name.encode (self.encoding), st, entry_offset) != 0:
+                break
+
+        return 0
 
 def StartFuseFS ():
+    global revision_storage, revision_coalesce, compress_rank, compress_age, purge_rate, tracer, stats_interval
+
     parser = argparse.ArgumentParser ( #prog='FuseMirrorFS.py',
                                       description='A revisioned filesystem which stores all content and revisions in another directory.')
     parser.add_argument ('source_dir', metavar='source',
@@ -915,6 +2821,46 @@ def StartFuseFS ():
                          help='show more information, can be used several times to get even more information')
     parser.add_argument ('-l', dest='log_file',
                          help='log file. Default: {0} or stderr when -f is given'.format (log_file))
+    parser.add_argument ('--copy', dest='copy_strategy', choices=RevCopy.strategies,
+                         help='method used to copy files into revisions. Default: the fastest one supported by the source file system')
+    parser.add_argument ('--storage', dest='storage', choices=storage_modes, default=storage_full,
+                         help='how revisions of files without own setting are stored: full copies, only the changed blocks or deduplicated chunks. Default: full')
+    parser.add_argument ('--coalesce', dest='coalesce', type=int, default=0,
+                         help='changes of files without own setting within this many seconds after their newest revision was created are added to it. Default: 0 (off)')
+    parser.add_argument ('--compress-rank', dest='compress_rank', type=int, default=0,
+                         help='compress revisions in the background when they are older than this revision number. Default: 0 (off)')
+    parser.add_argument ('--compress-age', dest='compress_age', type=int, default=0,
+                         help='compress revisions in the background when they are older than this number of days. Default: 0 (off)')
+    parser.add_argument ('--compress-codec', dest='compress_codec', choices=RevCompress.codecs, default=RevCompress.default_codec,
+                         help='compression used for old revisions. Default: {0}'.format (RevCompress.default_codec))
+    parser.add_argument ('--compress-workers', dest='compress_workers', type=int,
+                         help='number of compression processes. Default: number of CPUs')
+    parser.add_argument ('--purge-rate', dest='purge_rate', type=int, default=purge_rate,
+                         help='maximum number of expired revisions deleted per second in the background, 0 disables it. Default: {0}'.format (purge_rate))
+    parser.add_argument ('--attr-timeout', dest='attr_timeout', type=float, default=attr_timeout,
+                         help='seconds the attributes of a file are cached, also passed to the kernel. Default: {0}'.format (attr_timeout))
+    parser.add_argument ('--negative-timeout', dest='negative_timeout', type=float, default=negative_timeout,
+                         help='seconds a missing file is cached, also passed to the kernel. Default: {0}'.format (negative_timeout))
+    parser.add_argument ('--catalog', dest='catalog', action='store_true',
+                         help='keep a catalog of all revisions and policies in the source directory ({0})'.format (RevCatalog.catalog_name))
+    parser.add_argument ('--rebuild-catalog', dest='rebuild_catalog', action='store_true',
+                         help='build the catalog from the revisions in the source directory before mounting, implies --catalog')
+    parser.add_argument ('--rules', dest='rules_file',
+                         help='files matching the exclude rules in this file get no revisions, see RevRules.py. Changes are read while mounted')
+    parser.add_argument ('--space-budget', dest='space_budget', type=RevRules.ParseSize,
+                         help='maximum bytes used by all revisions (K, M, G, T), older revisions are deleted in the background when it is exceeded')
+    parser.add_argument ('--evict', dest='evict_policy', choices=evict_policies, default=evict_oldest,
+                         help='which revisions are deleted first when the space budget is exceeded. Default: {0}'.format (evict_oldest))
+    parser.add_argument ('--trace', dest='trace_file',
+                         help='record all calls to this file, see RevTrace.py')
+    parser.add_argument ('--trace-ring', dest='trace_ring', type=int, default=0,
+                         help='only keep the last N calls in memory and write them to the trace file when unmounting')
+    parser.add_argument ('--trace-data', dest='trace_data', action='store_true',
+                         help='also record the written data')
+    parser.add_argument ('--stats-interval', dest='stats_interval', type=float, default=0,
+                         help='write the statistics of {0} to the log every N seconds, needs -vv. Default: 0 (off)'.format (stats_file_name))
+    parser.add_argument ('--migrate', dest='migrate', action='store_true',
+                         help='rename revisions of older versions (.rev_<n>_<name>) to the current naming before mounting')
 
     args = parser.parse_args()
     
@@ -944,10 +2890,47 @@ def StartFuseFS ():
     if args.foreground:
         logger.info ("Running in foreground...")
 
-    logger.info ("Mounting %s on %s", args.source_dir, args.mount_dir)
+    revision_storage = args.storage
+    revision_coalesce = args.coalesce
+    purge_rate = args.purge_rate
+    stats_interval = args.stats_interval
+    compress_rank = args.compress_rank
+    compress_age = args.compress_age
+    compressor.codec = args.compress_codec
+    compressor.workers = args.compress_workers
+    attr_cache.ttl = args.attr_timeout
+    attr_cache.negative_ttl = args.negative_timeout
+
+    rules_file = None
+    if args.rules_file != None:
+        # the working directory changes when running in background
+        rules_file = os.path.abspath (args.rules_file)
+    try:
+        rev_fs = RevisionFS (args.source_dir, args.copy_strategy, args.catalog or args.rebuild_catalog, rules_file,
+                             args.space_budget, args.evict_policy)
+    except (OSError, ValueError) as e:
+        # an invalid rule or a rule file that cannot be read
+        parser.error (str (e))
+
+    if args.migrate:
+        logger.info ("Migrating revisions in %s", args.source_dir)
+        count = MigrateRevisions (args.source_dir)
+        logger.info ("%d revisions migrated", count)
+
+    if args.rebuild_catalog:
+        logger.info ("Rebuilding the catalog of %s", args.source_dir)
+        count = RebuildCatalog (args.source_dir)
+        logger.info ("%d revisions in the catalog", count)
 
-    rev_fs = RevisionFS (args.source_dir)
-    fuse.FUSE (rev_fs, args.mount_dir, foreground=args.foreground)
+    logger.info ("Mounting %s on %s", args.source_dir, args.mount_dir)
+    if args.trace_file != None:
+        tracer = RevTrace.Tracer (args.trace_file, args.trace_ring, args.trace_data)
+    try:
+        RevisionFUSE (rev_fs, args.mount_dir, foreground=args.foreground,
+                      attr_timeout=args.attr_timeout, negative_timeout=args.negative_timeout)
+    finally:
+        if tracer != None:
+            tracer.close ()
 
 if __name__ == "__main__":
     StartFuseFS ()
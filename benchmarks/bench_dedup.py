@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Compares the space used by revisions and the write throughput of full copy
+# and deduplicated revision storage. The file system operations are called
+# directly, no FUSE mount is needed.
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import importlib
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+RevisionFS = importlib.import_module ('Revision-FS')
+
+def MakeText (rnd, size):
+    words = [b'return', b'self', b'value', b'import', b'def', b'class', b'for', b'in', b'if', b'else']
+    lines = []
+    length = 0
+    while length < size:
+        line = b' '.join (rnd.choice (words) for i in range (rnd.randint (2, 10))) + b'\n'
+        lines.append (line)
+        length += len (line)
+    return lines
+
+def EditText (rnd, lines):
+    'Changes, inserts and deletes a few lines like an editor session does.'
+    lines = list (lines)
+    for i in range (rnd.randint (1, 5)):
+        pos = rnd.randrange (len (lines))
+        op = rnd.randint (0, 2)
+        if op == 0:
+            lines[pos] = b'changed ' + lines[pos]
+        elif op == 1:
+            lines.insert (pos, b'inserted line %d\n' % rnd.randint (0, 1000000))
+        elif len (lines) > 1:
+            del lines[pos]
+    return lines
+
+def WriteFile (fs, path, data, block_size = 128 * 1024):
+    fh = fs.create (path, 0o644)
+    for offset in range (0, len (data), block_size):
+        fs.write (path, data[offset:offset+block_size], offset, fh)
+    fs.release (path, fh)
+
+def GetStoredBytes (src_dir):
+    'Sums the size of all revisions and the chunk store.'
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk (src_dir):
+        in_store = RevisionFS.revision_store_name in dirpath
+        for name in filenames:
+            if in_store or name.startswith (RevisionFS.revision_prefix):
+                total += os.lstat (os.path.join (dirpath, name)).st_size
+    return total
+
+def RunWorkload (storage, files, saves, file_size, seed):
+    src_dir = tempfile.mkdtemp (prefix='revfs_bench_')
+    try:
+        RevisionFS.revision_storage = storage
+        fs = RevisionFS.RevisionFS (src_dir)
+        rnd = random.Random (seed)
+
+        contents = {}
+        for i in range (files):
+            path = '/file{0}.txt'.format (i)
+            contents[path] = MakeText (rnd, file_size)
+            WriteFile (fs, path, b''.join (contents[path]))
+
+        logical = 0
+        written = 0
+        start = time.perf_counter ()
+        for n in range (saves):
+            for (path, lines) in contents.items ():
+                # every second save rewrites the file unchanged like a build does
+                if n % 2 == 0:
+                    lines = EditText (rnd, lines)
+                    contents[path] = lines
+                data = b''.join (lines)
+                logical += fs.getattr (path)['st_size']
+                WriteFile (fs, path, data)
+                written += len (data)
+        elapsed = time.perf_counter () - start
+
+        stored = GetStoredBytes (src_dir)
+        fs.destroy ('/')
+        return dict (storage=storage, logical=logical, stored=stored, written=written, seconds=elapsed)
+    finally:
+        shutil.rmtree (src_dir)
+
+def Benchmark ():
+    parser = argparse.ArgumentParser (description='Compare full copy and deduplicated revision storage.')
+    parser.add_argument ('-n', dest='files', type=int, default=20,
+                         help='number of files. Default: 20')
+    parser.add_argument ('-s', dest='saves', type=int, default=10,
+                         help='number of saves per file. Default: 10')
+    parser.add_argument ('-b', dest='file_size', type=int, default=256 * 1024,
+                         help='size of each file in bytes. Default: 256 KB')
+    parser.add_argument ('--seed', dest='seed', type=int, default=1)
+
+    args = parser.parse_args ()
+
+    # keep all revisions, so both modes store the same history
+    RevisionFS.max_revisions = args.saves + 1
+
+    for storage in [RevisionFS.storage_full, RevisionFS.storage_dedup]:
+        res = RunWorkload (storage, args.files, args.saves, args.file_size, args.seed)
+        ratio = res['logical'] / max (res['stored'], 1)
+        throughput = res['written'] / res['seconds'] / (1024 * 1024)
+        print ('{0:>6}: revisions {1:>12} bytes, stored {2:>12} bytes, dedup ratio {3:6.2f}, write {4:8.1f} MB/s'
+               .format (storage, res['logical'], res['stored'], ratio, throughput))
+
+if __name__ == "__main__":
+    Benchmark ()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Measures the latency of open and release while many other files are open
+# and the memory used per open handle. The file system operations are called
+# directly, no FUSE mount is needed.
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import tracemalloc
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+RevisionFS = importlib.import_module ('Revision-FS')
+
+def Benchmark ():
+    parser = argparse.ArgumentParser (description='Measure open/release latency and memory per open handle.')
+    parser.add_argument ('-n', dest='open_files', type=int, nargs='+', default=[10, 1000, 10000],
+                         help='numbers of files kept open. Default: 10 1000 10000')
+    parser.add_argument ('-r', dest='rounds', type=int, default=10000,
+                         help='open/release pairs measured. Default: 10000')
+
+    args = parser.parse_args ()
+
+    src_dir = tempfile.mkdtemp (prefix='revfs_bench_')
+    try:
+        fs = RevisionFS.RevisionFS (src_dir)
+        for i in range (max (args.open_files) + 1):
+            open (os.path.join (src_dir, 'f{0}'.format (i)), 'w').close ()
+
+        for count in args.open_files:
+            tracemalloc.start ()
+            before = tracemalloc.get_traced_memory ()[0]
+            handles = [(path, fs.open (path, os.O_RDONLY)) for path in ['/f{0}'.format (i) for i in range (count)]]
+            used = tracemalloc.get_traced_memory ()[0] - before
+            tracemalloc.stop ()
+
+            path = '/f{0}'.format (max (args.open_files))
+            start = time.perf_counter ()
+            for i in range (args.rounds):
+                fs.release (path, fs.open (path, os.O_RDONLY))
+            elapsed = time.perf_counter () - start
+
+            for (p, fh) in handles:
+                fs.release (p, fh)
+
+            print ('{0:>6} open files: open+release {1:8.1f} us, {2:6.0f} bytes per handle'
+                   .format (count, elapsed / args.rounds * 1e6, used / count))
+
+        fs.destroy ('/')
+    finally:
+        shutil.rmtree (src_dir)
+
+if __name__ == "__main__":
+    Benchmark ()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Measures the read and write throughput of open files for sequential and
+# random access with small and large requests, like the kernel sends them
+# through FUSE. The file system operations are called directly, no FUSE
+# mount is needed.
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import importlib
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+RevisionFS = importlib.import_module ('Revision-FS')
+
+def GetOffsets (pattern, file_size, block_size, count, rnd):
+    blocks = file_size // block_size
+    if pattern == 'seq':
+        return [(i % blocks) * block_size for i in range (count)]
+    return [rnd.randrange (blocks) * block_size for i in range (count)]
+
+def RunPattern (fs, path, op, pattern, block_size, args):
+    rnd = random.Random (args.seed)
+    count = max (1, args.total // block_size)
+    offsets = GetOffsets (pattern, args.file_size, block_size, count, rnd)
+    data = os.urandom (block_size)
+
+    if op == 'read':
+        fh = fs.open (path, os.O_RDONLY)
+    else:
+        fh = fs.open (path, os.O_RDWR)
+        # the revision copy is made by the first write, it is not measured
+        fs.write (path, data, 0, fh)
+    start = time.perf_counter ()
+    if op == 'read':
+        for offset in offsets:
+            fs.read (path, block_size, offset, fh)
+    else:
+        for offset in offsets:
+            fs.write (path, data, offset, fh)
+    elapsed = time.perf_counter () - start
+    fs.release (path, fh)
+
+    return (count / elapsed, count * block_size / elapsed / (1024 * 1024))
+
+def Benchmark ():
+    parser = argparse.ArgumentParser (description='Measure read and write throughput of open files.')
+    parser.add_argument ('-s', dest='file_size', type=int, default=64 * 1024 * 1024,
+                         help='size of the test file in bytes. Default: 64 MB')
+    parser.add_argument ('-t', dest='total', type=int, default=256 * 1024 * 1024,
+                         help='bytes moved per test. Default: 256 MB')
+    parser.add_argument ('-b', dest='block_sizes', type=int, nargs='+', default=[4096, 128 * 1024],
+                         help='request sizes. Default: 4096 131072')
+    parser.add_argument ('--seed', dest='seed', type=int, default=1)
+
+    args = parser.parse_args ()
+
+    src_dir = tempfile.mkdtemp (prefix='revfs_bench_')
+    try:
+        fs = RevisionFS.RevisionFS (src_dir)
+        path = '/data'
+        with open (os.path.join (src_dir, 'data'), 'wb') as f:
+            f.write (os.urandom (args.file_size))
+
+        for op in ['read', 'write']:
+            for pattern in ['seq', 'rand']:
+                for block_size in args.block_sizes:
+                    (iops, throughput) = RunPattern (fs, path, op, pattern, block_size, args)
+                    print ('{0:>5} {1:>4} {2:>7}: {3:10.0f} ops/s {4:8.1f} MB/s'
+                           .format (op, pattern, block_size, iops, throughput))
+
+        fs.destroy ('/')
+    finally:
+        shutil.rmtree (src_dir)
+
+if __name__ == "__main__":
+    Benchmark ()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Stress test for the multithreaded mode of fusepy: several threads save,
+# read and stat their own files and read one shared file at the same time.
+# Reports the throughput for each thread count. The file system operations
+# are called directly, no FUSE mount is needed.
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import threading
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+RevisionFS = importlib.import_module ('Revision-FS')
+
+def WriteFile (fs, path, data, block_size):
+    fh = fs.create (path, 0o644)
+    for offset in range (0, len (data), block_size):
+        fs.write (path, data[offset:offset+block_size], offset, fh)
+    fs.release (path, fh)
+
+def ReadFile (fs, path, size, block_size):
+    fh = fs.open (path, os.O_RDONLY)
+    for offset in range (0, size, block_size):
+        fs.read (path, block_size, offset, fh)
+    fs.release (path, fh)
+
+def Worker (fs, n, args, shared, errors):
+    try:
+        data = os.urandom (args.file_size)
+        for i in range (args.rounds):
+            path = '/t{0}_f{1}'.format (n, i % args.files)
+            WriteFile (fs, path, data, args.block_size)
+            fs.getattr (path)
+            fs.getxattr (path, RevisionFS.xattr_revisions_name)
+            ReadFile (fs, path, args.file_size, args.block_size)
+            ReadFile (fs, shared, args.file_size, args.block_size)
+    except Exception as e:
+        errors.append (e)
+
+def RunThreads (threads, args):
+    src_dir = tempfile.mkdtemp (prefix='revfs_bench_')
+    try:
+        RevisionFS.revision_storage = args.storage
+        fs = RevisionFS.RevisionFS (src_dir)
+        shared = '/shared'
+        WriteFile (fs, shared, os.urandom (args.file_size), args.block_size)
+
+        errors = []
+        workers = [threading.Thread (target=Worker, args=(fs, n, args, shared, errors)) for n in range (threads)]
+        start = time.perf_counter ()
+        for t in workers:
+            t.start ()
+        for t in workers:
+            t.join ()
+        elapsed = time.perf_counter () - start
+
+        fs.destroy ('/')
+        if len (errors) > 0:
+            raise errors[0]
+
+        # every round writes one file and reads two
+        moved = threads * args.rounds * args.file_size * 3
+        return (threads * args.rounds / elapsed, moved / elapsed / (1024 * 1024))
+    finally:
+        shutil.rmtree (src_dir)
+
+def Benchmark ():
+    parser = argparse.ArgumentParser (description='Measure how the throughput scales with the number of threads.')
+    parser.add_argument ('-t', dest='threads', type=int, nargs='+', default=[1, 2, 4, 8],
+                         help='thread counts to test. Default: 1 2 4 8')
+    parser.add_argument ('-r', dest='rounds', type=int, default=50,
+                         help='saves per thread. Default: 50')
+    parser.add_argument ('-n', dest='files', type=int, default=4,
+                         help='files per thread. Default: 4')
+    parser.add_argument ('-s', dest='file_size', type=int, default=256 * 1024,
+                         help='size of each file in bytes. Default: 256 KB')
+    parser.add_argument ('-b', dest='block_size', type=int, default=128 * 1024,
+                         help='size of each read and write. Default: 128 KB')
+    parser.add_argument ('--storage', dest='storage', choices=RevisionFS.storage_modes, default=RevisionFS.storage_full)
+
+    args = parser.parse_args ()
+
+    base = None
+    for threads in args.threads:
+        (saves, throughput) = RunThreads (threads, args)
+        if base == None:
+            base = saves / threads
+        print ('{0:>3} threads: {1:8.1f} saves/s, {2:8.1f} MB/s, speedup {3:5.2f}'
+               .format (threads, saves, throughput, saves / base))
+
+if __name__ == "__main__":
+    Benchmark ()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Runs a set of standard workloads against a RevisionFS over a temporary
+# source directory and reports operations per second, latency percentiles and
+# the bytes added to the revision storage. By default the file system
+# operations are called directly, no FUSE mount is needed. With --mount the
+# same workloads run through a real mount, if FUSE is available.
+#
+# --json writes the results to a file, --compare shows the change against
+# such a file, e.g. one written by an older commit.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import importlib
+import subprocess
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+RevisionFS = importlib.import_module ('Revision-FS')
+
+class InProcess:
+    'Calls the Operations methods of a RevisionFS directly.'
+    name = 'in-process'
+
+    def __init__ (self, src_dir):
+        self.fs = RevisionFS.RevisionFS (src_dir)
+
+    def create (self, path):
+        return self.fs.create (path, 0o644)
+
+    def open (self, path, flags):
+        return self.fs.open (path, flags)
+
+    def write (self, path, fh, data, offset):
+        self.fs.write (path, data, offset, fh)
+
+    def read (self, path, fh, size, offset):
+        return self.fs.read (path, size, offset, fh)
+
+    def release (self, path, fh):
+        self.fs.release (path, fh)
+
+    def getattr (self, path):
+        return self.fs.getattr (path)
+
+    def readdir (self, path):
+        fh = self.fs.opendir (path)
+        names = [entry[0] for entry in self.fs.readdir (path, fh)]
+        self.fs.releasedir (path, fh)
+        return names
+
+    def setxattr (self, path, name, value):
+        self.fs.setxattr (path, name, value, 0)
+
+    def getxattr (self, path, name):
+        return self.fs.getxattr (path, name)
+
+    def mkdir (self, path):
+        self.fs.mkdir (path, 0o755)
+
+    def close (self):
+        self.fs.destroy ('/')
+
+class Mounted:
+    'Mounts the source directory with Revision-FS.py and uses plain system calls.'
+    name = 'mount'
+
+    def __init__ (self, src_dir):
+        self.mount_dir = tempfile.mkdtemp (prefix='revfs_mnt_')
+        script = os.path.join (os.path.dirname (os.path.dirname (os.path.abspath (__file__))), 'Revision-FS.py')
+        self.process = subprocess.Popen ([sys.executable, script, '-f', src_dir, self.mount_dir])
+        for i in range (100):
+            if os.path.ismount (self.mount_dir):
+                return
+            if self.process.poll () != None:
+                break
+            time.sleep (0.1)
+
+        self.close ()
+        raise RuntimeError ("mounting {0} failed".format (src_dir))
+
+    @staticmethod
+    def available ():
+        return os.path.exists ('/dev/fuse') and (shutil.which ('fusermount3') != None or shutil.which ('fusermount') != None)
+
+    def path (self, path):
+        return self.mount_dir + path
+
+    def create (self, path):
+        return os.open (self.path (path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def open (self, path, flags):
+        return os.open (self.path (path), flags)
+
+    def write (self, path, fh, data, offset):
+        os.pwrite (fh, data, offset)
+
+    def read (self, path, fh, size, offset):
+        return os.pread (fh, size, offset)
+
+    def release (self, path, fh):
+        os.close (fh)
+
+    def getattr (self, path):
+        return os.lstat (self.path (path))
+
+    def readdir (self, path):
+        return os.listdir (self.path (path))
+
+    def setxattr (self, path, name, value):
+        os.setxattr (self.path (path), name, value)
+
+    def getxattr (self, path, name):
+        return os.getxattr (self.path (path), name)
+
+    def mkdir (self, path):
+        os.mkdir (self.path (path))
+
+    def close (self):
+        if os.path.ismount (self.mount_dir):
+            subprocess.call ([shutil.which ('fusermount3') or 'fusermount', '-u', self.mount_dir])
+        self.process.wait ()
+        os.rmdir (self.mount_dir)
+
+def GetRevisionBytes (src_dir):
+    'Returns the bytes used by revisions and the chunk store below src_dir.'
+    total = 0
+    for (dirpath, dirnames, filenames) in os.walk (src_dir):
+        in_store = RevisionFS.revision_store_name in dirpath
+        for name in filenames:
+            if in_store or RevisionFS.ParseRevisionName (name) != None:
+                try:
+                    total += os.lstat (os.path.join (dirpath, name)).st_size
+                except FileNotFoundError:
+                    pass
+
+    return total
+
+class Timer:
+    'Collects the latency of each unit of work of a workload.'
+    def __init__ (self):
+        self.latencies = []
+
+    def __enter__ (self):
+        self.start = time.perf_counter ()
+        return self
+
+    def __exit__ (self, *exc):
+        self.latencies.append (time.perf_counter () - self.start)
+
+def SaveFile (ops, path, data, block_size = 128 * 1024):
+    fh = ops.create (path)
+    for offset in range (0, len (data), block_size):
+        ops.write (path, fh, data[offset:offset+block_size], offset)
+    ops.release (path, fh)
+
+def SmallFileStorm (ops, timer, args, rnd):
+    'Many small files saved again and again, like a build or an editor.'
+    data = os.urandom (4096)
+    files = max (1, int (200 * args.scale))
+    for i in range (5):
+        for n in range (files):
+            with timer:
+                SaveFile (ops, '/small{0}'.format (n), data)
+
+def LargeRewrite (ops, timer, args, rnd):
+    'A large file rewritten sequentially in place, each write is a unit.'
+    size = max (1, int (64 * args.scale)) * 1024 * 1024
+    block = 128 * 1024
+    SaveFile (ops, '/large', os.urandom (size))
+    data = os.urandom (block)
+    for i in range (3):
+        fh = ops.open ('/large', os.O_RDWR)
+        for offset in range (0, size, block):
+            with timer:
+                ops.write ('/large', fh, data, offset)
+        ops.release ('/large', fh)
+
+def RandomUpdates (ops, timer, args, rnd):
+    'Small writes at random offsets of a database like file, in several sessions.'
+    size = max (1, int (32 * args.scale)) * 1024 * 1024
+    SaveFile (ops, '/db', os.urandom (size))
+    ops.setxattr ('/db', RevisionFS.xattr_storage_name, b'delta')
+    data = os.urandom (4096)
+    for i in range (10):
+        fh = ops.open ('/db', os.O_RDWR)
+        for n in range (max (1, int (500 * args.scale))):
+            with timer:
+                ops.write ('/db', fh, data, rnd.randrange (size // 4096) * 4096)
+        ops.release ('/db', fh)
+
+def ManyRevisions (ops, timer, args, rnd):
+    'A directory with thousands of revisions, the units are listings and lookups.'
+    ops.mkdir ('/revs')
+    ops.setxattr ('/revs', RevisionFS.xattr_max_revisions_name, b'100')
+    files = max (1, int (50 * args.scale))
+    for i in range (40):
+        for n in range (files):
+            SaveFile (ops, '/revs/f{0}'.format (n), b'%d' % i)
+
+    for i in range (20):
+        with timer:
+            ops.readdir ('/revs')
+        for n in range (files):
+            with timer:
+                ops.getattr ('/revs/f{0}'.format (n))
+                ops.getxattr ('/revs/f{0}'.format (n), RevisionFS.xattr_info_name)
+
+def DeepPaths (ops, timer, args, rnd):
+    'Files at the end of a deep directory chain, saved and looked up.'
+    path = ''
+    for i in range (32):
+        path += '/level{0}'.format (i)
+        ops.mkdir (path)
+
+    data = os.urandom (1024)
+    for i in range (max (1, int (500 * args.scale))):
+        name = '{0}/f{1}'.format (path, i % 20)
+        with timer:
+            SaveFile (ops, name, data)
+            ops.getattr (name)
+
+workloads = {
+    'small_file_storm': SmallFileStorm,
+    'large_rewrite': LargeRewrite,
+    'random_updates': RandomUpdates,
+    'many_revisions': ManyRevisions,
+    'deep_paths': DeepPaths,
+}
+
+def Percentile (values, p):
+    index = min (len (values) - 1, int (len (values) * p / 100))
+    return values[index]
+
+def RunWorkload (name, mode, args):
+    src_dir = tempfile.mkdtemp (prefix='revfs_bench_')
+    try:
+        ops = mode (src_dir)
+        timer = Timer ()
+        try:
+            before = GetRevisionBytes (src_dir)
+            start = time.perf_counter ()
+            workloads[name] (ops, timer, args, random.Random (args.seed))
+            elapsed = time.perf_counter () - start
+        finally:
+            ops.close ()
+
+        latencies = sorted (timer.latencies)
+        return {
+            'units': len (latencies),
+            'seconds': elapsed,
+            'units_per_sec': len (latencies) / elapsed,
+            'p50_us': Percentile (latencies, 50) * 1e6,
+            'p95_us': Percentile (latencies, 95) * 1e6,
+            'p99_us': Percentile (latencies, 99) * 1e6,
+            'max_us': latencies[-1] * 1e6,
+            'revision_bytes': GetRevisionBytes (src_dir) - before,
+        }
+    finally:
+        shutil.rmtree (src_dir)
+
+def GetCommit ():
+    try:
+        return subprocess.check_output (['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                        cwd=os.path.dirname (os.path.abspath (__file__))).decode ('ASCII').strip ()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def Benchmark ():
+    parser = argparse.ArgumentParser (description='Run standard workloads against RevisionFS.')
+    parser.add_argument ('-w', dest='workloads', nargs='+', choices=sorted (workloads), default=list (workloads),
+                         help='workloads to run. Default: all')
+    parser.add_argument ('-s', dest='scale', type=float, default=1.0,
+                         help='scales the number of files and the file sizes. Default: 1')
+    parser.add_argument ('--mount', dest='mount', action='store_true',
+                         help='also run the workloads through a FUSE mount, if available')
+    parser.add_argument ('--json', dest='json_file',
+                         help='write the results to this file')
+    parser.add_argument ('--compare', dest='compare_file',
+                         help='show the change against the results in this file')
+    parser.add_argument ('--seed', dest='seed', type=int, default=1)
+
+    args = parser.parse_args ()
+
+    modes = [InProcess]
+    if args.mount:
+        if Mounted.available ():
+            modes.append (Mounted)
+        else:
+            print ('FUSE is not available, only running in-process')
+
+    base = {}
+    if args.compare_file != None:
+        with open (args.compare_file) as f:
+            base = json.load (f)['results']
+
+    results = {}
+    for mode in modes:
+        for name in args.workloads:
+            key = '{0}/{1}'.format (mode.name, name)
+            res = RunWorkload (name, mode, args)
+            results[key] = res
+            line = '{0:>28}: {1:10.1f} units/s  p50 {2:9.1f} us  p95 {3:9.1f} us  p99 {4:9.1f} us  {5:>12} revision bytes' \
+                   .format (key, res['units_per_sec'], res['p50_us'], res['p95_us'], res['p99_us'], res['revision_bytes'])
+            if key in base:
+                line += '  ({0:+.1f}% units/s)'.format ((res['units_per_sec'] / base[key]['units_per_sec'] - 1) * 100)
+            print (line)
+
+    if args.json_file != None:
+        with open (args.json_file, 'w') as f:
+            json.dump ({'commit': GetCommit (), 'time': time.time (), 'scale': args.scale, 'results': results}, f, indent=2)
+
+if __name__ == "__main__":
+    Benchmark ()
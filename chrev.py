@@ -3,49 +3,106 @@
 #
 
 import os
+import sys
 import argparse
 import RevFS
 
 
+def ChangeRevisions (fname, args, name):
+    '''
+    Shows and changes the revision parameters of fname, returns the lines to
+    print, so parallel calls do not mix their output.
+    '''
+    info = RevFS.GetInfo (fname)
+    if info == None:
+        return ["{0} is not on a RevisionFS.py".format (fname)]
+
+    lines = []
+    max_rev = info.max_revisions
+    if args.max_revisions != None:
+        RevFS.SetMaxRevisions (fname, args.max_revisions)
+        lines.append ('{0}: changing max. revisions from {1} to {2}'.format (name, max_rev, args.max_revisions))
+    else:
+        lines.append ('{0}: max. revisions {1}'.format (name, max_rev))
+
+    min_rev = info.min_revisions
+    if args.min_revisions != None:
+        RevFS.SetMinRevisionsAge (fname, args.min_revisions)
+        lines.append ('{0}: changing min. revisions from {1} to {2}'.format (name, min_rev, args.min_revisions))
+    else:
+        lines.append ('{0}: min. revisions {1}'.format (name, min_rev))
+
+    max_age = info.max_age
+    if args.max_age != None:
+        RevFS.SetMaxRevisionAge (fname, args.max_age)
+        lines.append ('{0}: changing max. age from {1} to {2} days'.format (name, max_age, args.max_age))
+    else:
+        lines.append ('{0}: max. age {1} days'.format (name, max_age))
+
+    storage = info.storage
+    if args.storage != None:
+        RevFS.SetStorage (fname, args.storage)
+        lines.append ('{0}: changing storage from {1} to {2}'.format (name, storage, args.storage))
+    else:
+        lines.append ('{0}: storage {1}'.format (name, storage))
+
+    coalesce = info.coalesce
+    if args.coalesce != None:
+        RevFS.SetCoalesce (fname, args.coalesce)
+        lines.append ('{0}: changing coalescing window from {1} to {2} seconds'.format (name, coalesce, args.coalesce))
+    else:
+        lines.append ('{0}: coalescing window {1} seconds'.format (name, coalesce))
+
+    return lines
+
 def ShowRevisions ():
-    parser = argparse.ArgumentParser (description='Change the revision parameters of a file stored on RevisionFS.py.')
+    parser = argparse.ArgumentParser (description='Change the revision parameters of a file stored on RevisionFS.py.',
+                                      epilog='Parameters of a directory apply to all files below it that do not have their own. '
+                                             'With -r each directory is changed before the entries in it, so these only get '
+                                             'own parameters where they had different ones before.')
     parser.add_argument ('file_name', nargs='+',
-                         help='the files to change')
+                         help='the files or directories to change')
     parser.add_argument ('-m', dest='max_revisions', type=int,
                          help='maximum revisions stored for this file')
     parser.add_argument ('-a', dest='max_age', type=int,
                          help='maximum age of stored revisions for this file in days')
     parser.add_argument ('-n', dest='min_revisions', type=int,
                          help='minimum number of revisions stored for this file even if oder than max_age')
+    parser.add_argument ('-s', dest='storage', choices=['full', 'delta', 'dedup'],
+                         help='store new revisions as full copies, only the changed blocks or deduplicated chunks')
+    parser.add_argument ('-c', dest='coalesce', type=int,
+                         help='changes within this many seconds after a revision was created do not create another one (0: off)')
+    parser.add_argument ('-r', dest='recursive', action='store_true',
+                         help='also show or change everything below the given directories')
+    parser.add_argument ('-t', dest='threads', type=int, default=16,
+                         help='number of parallel requests with -r. Default: 16')
 
     args = parser.parse_args()
 
     for fname in args.file_name:
-        if not RevFS.IsOnRevisionFS (fname):
-            print ("{0} is not on a RevisionFS.py".format (fname))
+        if not args.recursive:
+            for line in ChangeRevisions (fname, args, os.path.basename (fname)):
+                print (line)
             continue
-        
-        max_rev = RevFS.GetMaxRevisions (fname)
-        if args.max_revisions != None:
-            RevFS.SetMaxRevisions (fname, args.max_revisions)
-            print ('{0}: changing max. revisions from {1} to {2}'.format (os.path.basename (fname), max_rev, args.max_revisions))
-        else:
-            print ('{0}: max. revisions {1}'.format (os.path.basename (fname), max_rev))
-        
-        min_rev = RevFS.GetMinRevisionsAge (fname)
-        if args.min_revisions != None:
-            RevFS.SetMinRevisionsAge (fname, args.min_revisions)
-            print ('{0}: changing max. revisions from {1} to {2}'.format (os.path.basename (fname), min_rev, args.min_revisions))
-        else:
-            print ('{0}: max. revisions {1}'.format (os.path.basename (fname), min_rev))
-        
-        max_age = RevFS.GetMaxRevisionAge (fname)
-        if args.max_age != None:
-            RevFS.SetMaxRevisionAge (fname, args.max_age)
-            print ('{0}: changing max. age from {1} to {2} days'.format (os.path.basename (fname), max_age, args.max_age))
-        else:
-            print ('{0}: max. age {1} days'.format (os.path.basename (fname), max_age))
+
+        def files ():
+            # directories are changed at once, before their entries are listed
+            for path in RevFS.WalkTree (fname):
+                if not os.path.islink (path) and os.path.isdir (path):
+                    try:
+                        for line in ChangeRevisions (path, args, path):
+                            print (line)
+                    except OSError as e:
+                        print ("{0}: {1}".format (path, e.strerror), file=sys.stderr)
+                else:
+                    yield path
+
+        for (path, lines, error) in RevFS.MapParallel (lambda path: ChangeRevisions (path, args, path), files (), args.threads):
+            if error != None:
+                print ("{0}: {1}".format (path, error.strerror), file=sys.stderr)
+                continue
+            for line in lines:
+                print (line)
 
 if __name__ == "__main__":
     ShowRevisions ()
-
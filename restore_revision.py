@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+
+import os
+import argparse
+import RevFS
+
+
+def RestoreRevision ():
+    parser = argparse.ArgumentParser (description='Restore an old revision of a file stored on RevisionFS.py. The current content is kept as newest revision.')
+    parser.add_argument ('file_name',
+                         help='the file to restore')
+    parser.add_argument ('revision', type=int,
+                         help='the revision to restore as shown by show_revisions.py')
+
+    args = parser.parse_args()
+
+    fname = args.file_name
+    if not RevFS.IsOnRevisionFS (fname):
+        print ("{0} is not on a RevisionFS.py".format (fname))
+        return
+
+    try:
+        RevFS.RestoreRevision (fname, args.revision)
+    except OSError as e:
+        print ("{0}: cannot restore revision {1}: {2}".format (os.path.basename (fname), args.revision, e.strerror))
+        return
+
+    print ('{0}: restored revision {1}'.format (os.path.basename (fname), args.revision))
+
+if __name__ == "__main__":
+    RestoreRevision ()
@@ -3,6 +3,8 @@
 #
 
 import os
+import sys
+import json
 import argparse
 import RevFS
 
@@ -31,54 +33,119 @@ def HumanReadable (v):
 
     return "{0:.0f} GB".format (v)
     
+def FormatRevisions (name, info, human_readable):
+    if info.revisions == []:
+        return '{0}: max. revisions {1}, max. age {2} days, min. revisions {3}, no revisions exist' \
+               .format (name, info.max_revisions, info.max_age, info.min_revisions)
+
+    rev_nr_len = 0
+    date_len = 0
+    size_len = 0
+    rev_list = []
+    for rev in info.revisions:
+        s_revision = str (rev.revision)
+        s_size = str (rev.size)
+        if human_readable:
+            s_size = HumanReadable (rev.size)
+
+        if rev.stored_size != rev.size:
+            if human_readable:
+                s_size += " ({0} stored)".format (HumanReadable (rev.stored_size))
+            else:
+                s_size += " ({0} stored)".format (rev.stored_size)
+
+        s_date = rev.date.strftime ('%c')
+        rev_nr_len = max (rev_nr_len, len (s_revision))
+        size_len = max (size_len, len (s_size))
+        date_len = max (date_len, len (s_date))
+        rev_list.append ((s_revision, s_size, s_date))
+
+    lines = ['{0}: max. revisions {1}, max. age {2} days, min. revisions {3}' \
+             .format (name, info.max_revisions, info.max_age, info.min_revisions)]
+    for rev in rev_list:
+        lines.append ('  {0:>{align_id}}: {1:>{align_size}}  {2}'.format (rev[0], rev[1], rev[2],
+                                                                          align_id=rev_nr_len, align_size=size_len))
+    return '\n'.join (lines)
+
+def InfoToJSON (path, info):
+    return json.dumps ({'path': path, 'max_revisions': info.max_revisions, 'max_age': info.max_age,
+                        'min_revisions': info.min_revisions, 'storage': info.storage, 'coalesce': info.coalesce,
+                        'revisions': [{'revision': rev.revision, 'mtime': rev.date.timestamp (),
+                                       'size': rev.size, 'stored_size': rev.stored_size} for rev in info.revisions]})
+
+class Totals:
+    __slots__ = ('entries', 'revisions', 'size', 'stored_size')
+
+    def __init__ (self):
+        self.entries = 0
+        self.revisions = 0
+        self.size = 0
+        self.stored_size = 0
+
+    def add (self, info):
+        self.entries += 1
+        self.revisions += len (info.revisions)
+        self.size += sum ([rev.size for rev in info.revisions])
+        self.stored_size += sum ([rev.stored_size for rev in info.revisions])
+
+    def format (self, path, human_readable, as_json):
+        if as_json:
+            return json.dumps ({'path': path, 'total': {'entries': self.entries, 'revisions': self.revisions,
+                                                        'size': self.size, 'stored_size': self.stored_size}})
+
+        size = str (self.size)
+        stored_size = str (self.stored_size)
+        if human_readable:
+            size = HumanReadable (self.size)
+            stored_size = HumanReadable (self.stored_size)
+        return '{0}: {1} entries, {2} revisions, {3} ({4} stored)'.format (path, self.entries, self.revisions, size, stored_size)
+
 def ShowRevisions ():
     parser = argparse.ArgumentParser (description='Show revisions of a file stored on RevisionFS.py.', add_help=False)
     parser.add_argument ('file_name', nargs='+',
                          help='the file name to check')
     parser.add_argument ('-h', dest='human_readable', action='store_true',
                          help='display sizes human readable')
+    parser.add_argument ('-r', dest='recursive', action='store_true',
+                         help='show all files below the given directories and their totals')
+    parser.add_argument ('-t', dest='threads', type=int, default=16,
+                         help='number of parallel requests with -r. Default: 16')
+    parser.add_argument ('--json', dest='json', action='store_true',
+                         help='print one JSON object per line')
+    parser.add_argument ('--help', action='help',
+                         help='show this help message and exit')
 
     args = parser.parse_args()
 
     human_readable = args.human_readable
 
     for fname in args.file_name:
-        if not RevFS.IsOnRevisionFS (fname):
-            print ("{0} is not on a RevisionFS.py".format (os.path.basename (fname)))
+        if not args.recursive:
+            info = RevFS.GetInfo (fname)
+            if info == None:
+                print ("{0} is not on a RevisionFS.py".format (os.path.basename (fname)))
+            elif args.json:
+                print (InfoToJSON (fname, info))
+            else:
+                print (FormatRevisions (os.path.basename (fname), info, human_readable))
             continue
-        
-        max_revisions = RevFS.GetMaxRevisions (fname)
-        max_revision_age = RevFS.GetMaxRevisionAge (fname)
-        min_revisions_age = RevFS.GetMinRevisionsAge (fname)
-
-        revisions = RevFS.GetRevisionInfos (fname)
-
-        if revisions == []:
-            print ('{0}: max. revisions {1}, max. age {2} days, min. revisions {3}, no revisions exist' \
-                   .format (os.path.basename (fname), max_revisions, max_revision_age, min_revisions_age))
-        else:
-            rev_nr_len = 0
-            date_len = 0
-            size_len = 0
-            rev_list = []
-            for rev in revisions:
-                s_revision = str (rev.revision)
-                s_size = str (rev.size)
-                if human_readable:
-                    s_size = HumanReadable (rev.size)
-    
-                s_date = rev.date.strftime ('%c')
-                rev_nr_len = max (rev_nr_len, len (s_revision))
-                size_len = max (size_len, len (s_size))
-                date_len = max (date_len, len (s_date))
-                rev_list.append ((s_revision, s_size, s_date))
-            
-            print ('{0}: max. revisions {1}, max. age {2} days, min. revisions {3}' \
-                   .format (os.path.basename (fname), max_revisions, max_revision_age, min_revisions_age))
-            for rev in rev_list:
-                print ('  {0:>{align_id}}: {1:>{align_size}}  {2}'.format (rev[0], rev[1], rev[2],
-                                                                          align_id=rev_nr_len, align_size=size_len))
+
+        totals = Totals ()
+        for (path, info, error) in RevFS.MapParallel (RevFS.GetInfo, RevFS.WalkTree (fname), args.threads):
+            if error != None:
+                print ("{0}: {1}".format (path, error.strerror), file=sys.stderr)
+                continue
+            if info == None:
+                print ("{0} is not on a RevisionFS.py".format (path))
+                continue
+
+            totals.add (info)
+            if args.json:
+                print (InfoToJSON (path, info))
+            else:
+                print (FormatRevisions (path, info, human_readable))
+
+        print (totals.format (fname, human_readable, args.json))
 
 if __name__ == "__main__":
     ShowRevisions ()
-
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Lists directories like the kernel does through FUSE: every getdents call
+# sends one FUSE_READDIR with the offset of the last entry it used, libfuse
+# fills one page and the kernel drops what does not fit into the buffer of
+# the caller.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import importlib
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+try:
+    RevisionFS = importlib.import_module ('Revision-FS')
+except (ImportError, OSError) as e:
+    # fusepy raises OSError without libfuse
+    raise unittest.SkipTest ("fusepy cannot be loaded: {0}".format (e))
+
+page_size = 4096
+
+class FileInfo:
+    def __init__ (self, fh):
+        self.fh = fh
+
+class FileInfoPointer:
+    def __init__ (self, fh):
+        self.contents = FileInfo (fh)
+
+def Align8 (n):
+    return (n + 7) & ~7
+
+class Directory:
+    'The kernel side of an open directory.'
+    def __init__ (self, ops, path):
+        self.ops = ops
+        self.path = path
+        self.fh = ops.operations ('opendir', path)
+        self.pos = 0
+
+    def readPage (self):
+        'Returns the (name, offset) libfuse sends for the current position.'
+        page = []
+        used = [0]
+        def filler (buf, name, st, offset):
+            size = Align8 (24 + len (name))
+            if used[0] + size > page_size:
+                return 1
+            used[0] += size
+            page.append ((name.decode ('utf-8'), offset))
+            return 0
+
+        self.ops.readdir (self.path.encode ('utf-8'), None, filler, self.pos, FileInfoPointer (self.fh))
+        return page
+
+    def getdents (self, buf_size):
+        'Returns the names that fit into a buffer of buf_size bytes, [] at the end.'
+        names = []
+        used = 0
+        for (name, offset) in self.readPage ():
+            size = Align8 (19 + len (name) + 1)
+            if used + size > buf_size:
+                break
+            used += size
+            names.append (name)
+            self.pos = offset
+        return names
+
+    def readAll (self, buf_size):
+        res = []
+        while True:
+            names = self.getdents (buf_size)
+            if len (names) == 0:
+                return res
+            res.extend (names)
+
+    def close (self):
+        self.ops.operations ('releasedir', self.path, self.fh)
+
+class ReaddirTest (unittest.TestCase):
+    def setUp (self):
+        self.src_dir = tempfile.mkdtemp ()
+        os.mkdir (os.path.join (self.src_dir, 'big'))
+        self.names = ['file-{0}-{1}'.format (i, 'x' * (i % 40)) for i in range (5000)]
+        for name in self.names:
+            open (os.path.join (self.src_dir, 'big', name), 'w').close ()
+        # revisions are not listed
+        open (os.path.join (self.src_dir, 'big', '.rev_r1_' + self.names[0]), 'w').close ()
+
+        self.ops = RevisionFS.RevisionFUSE.__new__ (RevisionFS.RevisionFUSE)
+        self.ops.operations = RevisionFS.RevisionFS (self.src_dir)
+        self.ops.encoding = 'utf-8'
+        self.ops.use_ns = False
+
+    def tearDown (self):
+        shutil.rmtree (self.src_dir)
+
+    def testSmallBuffer (self):
+        for buf_size in (100, 200, 1000, 32768):
+            d = Directory (self.ops, '/big')
+            names = d.readAll (buf_size)
+            d.close ()
+            self.assertEqual (len (names), len (self.names) + 2, buf_size)
+            self.assertEqual (sorted (names), sorted (self.names + ['.', '..']), buf_size)
+
+    def testSeek (self):
+        d = Directory (self.ops, '/big')
+        first = []
+        while len (first) < 1000:
+            first.extend (d.getdents (300))
+        pos = d.pos
+        rest = d.readAll (300)
+
+        # seekdir back to a position before the entries kept from the last call
+        d.pos = pos
+        self.assertEqual (d.readAll (300), rest)
+        # rewinddir
+        d.pos = 0
+        self.assertEqual (d.readAll (1000), first + rest)
+        d.close ()
+
+if __name__ == "__main__":
+    unittest.main ()